@@ -32,9 +32,13 @@ if __name__ == '__main__':
 	vocab.add_attribute_assignment_check()
 
 	print_dot = False
+	replay = False
 	if 'dot' in sys.argv[1:]:
 		print_dot = True
 		sys.argv[1:] = [a for a in sys.argv[1:] if a != 'dot']
+	if 'replay' in sys.argv[1:]:
+		replay = True
+		sys.argv[1:] = [a for a in sys.argv[1:] if a != 'replay']
 	parser = bonobo.get_argument_parser()
 	with bonobo.parse_args(parser) as options:
 		try:
@@ -49,6 +53,8 @@ if __name__ == '__main__':
 			)
 			if print_dot:
 				print(pipeline.get_graph()._repr_dot_())
+			elif replay:
+				pipeline.replay(**options)
 			else:
 				pipeline.run(**options)
 		except RuntimeError:
@@ -0,0 +1,147 @@
+'''
+Checkpointing of long pipeline runs, so that a run that is interrupted can be
+resumed from where it stopped instead of from the beginning.
+'''
+
+import os
+import sys
+import time
+from contextlib import suppress
+
+from pipeline.util import crom_dump, crom_load
+from pipeline.execution import replace_state
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
+
+class RunCheckpoint:
+	'''
+	Records the progress of a pipeline run, and saves it to `filename` every
+	`interval` seconds (at points between two input records, when the run is in a
+	consistent state).
+
+	The progress of a run is recorded as the number of the graph being run (counting
+	the graphs run by the pipeline), the nodes calls that have been completed (the
+	roots of the graph, and the reading of each input file), and the number of rows
+	of each input file that have been fully processed. A checkpoint also contains
+	the containers in `state` (e.g. the stateful services of the pipeline), and the
+	contents of the in-memory writers in `writers`.
+
+	If `resume` is true and a checkpoint has been saved to `filename`, it is loaded:
+	graphs that were completed are skipped, and the graph being run when the checkpoint
+	was saved restarts from the saved progress (with the saved state and writer
+	contents restored).
+	'''
+	def __init__(self, filename, interval, state, writers=(), resume=False):
+		self.filename = filename
+		self.interval = interval
+		self.state = state
+		self.writers = writers
+		self.graph = 0
+		self.completed = set()
+		self.offsets = {}
+		self.readers = {}
+		self.reader_counts = {}
+		self.next_save_time = time.time() + interval
+		self.saved = self.load() if resume else None
+
+	def load(self):
+		with suppress(FileNotFoundError):
+			with open(self.filename, 'rb') as fh:
+				return crom_load(fh)
+		return None
+
+	def memory_writers(self):
+		return [w for w in self.writers if isinstance(w, MergingMemoryWriter)]
+
+	def start_graph(self):
+		'''
+		Called before each graph of the pipeline is run. Returns `False` if the graph
+		was completed by the run being resumed, and should be skipped.
+		'''
+		self.graph += 1
+		self.completed = set()
+		self.offsets = {}
+		self.readers = {}
+		self.reader_counts = {}
+		saved = self.saved
+		if saved is None:
+			return True
+		if saved['graph'] > self.graph:
+			return False
+		print(f'Resuming graph {self.graph} from checkpoint {self.filename}', file=sys.stderr)
+		self.saved = None
+		self.completed = saved['completed']
+		self.offsets = saved['offsets']
+		self.reader_counts = saved['reader_counts']
+		for name, state in saved['state'].items():
+			replace_state(self.state[name], state)
+		for w, data in zip(self.memory_writers(), saved['writers']):
+			w.data = data
+		for w, (runs, spilled) in zip(self.memory_writers(), saved.get('writer_runs', ())):
+			# the run files the writers' stores had spilled to disk
+			w.store.runs = list(runs)
+			w.store.spilled = spilled
+		return True
+
+	def finish_graph(self):
+		'''Called after each graph is run, saving the state of the run at the start of the next graph.'''
+		self.save(graph=self.graph + 1, progress=False)
+
+	def attach_readers(self, readers):
+		'''
+		Set the reader nodes (a `dict` mapping node indexes to `CurriedCSVReader`
+		objects) of the graph being run, restoring the number of rows they had read (which
+		is used to apply their `limit`) if the graph is being resumed.
+		'''
+		self.readers = readers
+		for i, count in self.reader_counts.items():
+			if i in readers:
+				readers[i].count = count
+
+	def is_complete(self, i, input):
+		return (i, input) in self.completed
+
+	def complete(self, i, input):
+		self.completed.add((i, input))
+		self.offsets.pop((i, input), None)
+
+	def resume_offset(self, i, input):
+		return self.offsets.get((i, input), 0)
+
+	def advance(self, i, input):
+		'''
+		Record that another row read by node `i` from `input` has been processed, and
+		save the checkpoint if it is due.
+		'''
+		key = (i, input)
+		self.offsets[key] = self.offsets.get(key, 0) + 1
+		self.save_if_due()
+
+	def save_if_due(self):
+		if time.time() >= self.next_save_time:
+			self.save()
+
+	def save(self, graph=None, progress=True):
+		for w in self.writers:
+			if isinstance(w, SegmentWriter):
+				# the objects in a segment are only read once it is closed (and indexed)
+				w.close()
+		data = {
+			'graph': graph or self.graph,
+			'completed': self.completed if progress else set(),
+			'offsets': self.offsets if progress else {},
+			'reader_counts': {i: r.count for i, r in self.readers.items()} if progress else {},
+			'state': self.state,
+			'writers': [w.data for w in self.memory_writers()],
+			# reading the runs of a `RunStore` closes the one being written, so the runs saved are complete
+			'writer_runs': [(list(w.store.runs), w.store.spilled) for w in self.memory_writers()],
+		}
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'wb') as fh:
+			crom_dump(data, fh)
+		os.replace(tmp, self.filename)
+		self.next_save_time = time.time() + self.interval
+
+	def clear(self):
+		with suppress(FileNotFoundError):
+			os.remove(self.filename)
@@ -0,0 +1,170 @@
+'''
+A dead-letter queue for the records that fail to be processed by a graph, so that
+they can be replayed through the graph (e.g. once a modeling bug has been fixed)
+without re-running the whole pipeline.
+'''
+
+import json
+import traceback
+import warnings
+from functools import partial
+from collections.abc import Mapping
+from contextlib import suppress
+
+import lxml.etree
+from bonobo.util import get_name
+
+from pipeline.io.csv import ByteRange, CSVRowText, Row
+
+def _json_default(value):
+	if isinstance(value, CSVRowText):
+		return str(value)
+	raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def snapshot_record(value):
+	'''
+	Return a copy of the record `value` that is not changed when the nodes it is
+	passed to modify it in place (as `PreserveCSVFields` and `KeyManagement` do with
+	the rows of a CSV file), so that the record can be recorded as it was produced.
+	'''
+	if isinstance(value, Row):
+		return value.copy()
+	elif isinstance(value, dict):
+		return {k: snapshot_record(v) for k, v in value.items()}
+	elif isinstance(value, list):
+		return [snapshot_record(v) for v in value]
+	return value
+
+def encode_record(value):
+	'''Return a JSON-serializable encoding of the record `value`.'''
+	if isinstance(value, lxml.etree._Element):
+		return {'type': 'xml', 'value': lxml.etree.tostring(value, encoding='unicode')}
+	if isinstance(value, ByteRange):
+		return {'type': 'byte_range', 'value': list(value)}
+	if isinstance(value, tuple):
+		# e.g. a batch of input files (which a reader distinguishes from a single file)
+		return {'type': 'tuple', 'value': [encode_record(v) for v in value]}
+	if isinstance(value, Mapping) and not isinstance(value, dict):
+		# e.g. a `pipeline.io.csv.Row`
+		value = dict(value)
+	try:
+		return {'type': 'json', 'value': json.loads(json.dumps(value, default=_json_default))}
+	except (TypeError, ValueError):
+		return {'type': 'repr', 'value': repr(value)}
+
+def decode_record(data):
+	'''Return the record encoded by `encode_record`, or raise `ValueError` if it cannot be decoded.'''
+	kind = data['type']
+	if kind == 'json':
+		return data['value']
+	elif kind == 'xml':
+		return lxml.etree.fromstring(data['value'])
+	elif kind == 'byte_range':
+		return ByteRange(*data['value'])
+	elif kind == 'tuple':
+		return tuple(decode_record(v) for v in data['value'])
+	raise ValueError(f'Cannot replay a record of type {kind!r}')
+
+def node_name(node):
+	if isinstance(node, partial):
+		node = node.func
+	return get_name(node)
+
+class DeadLetterQueue:
+	'''
+	Write the records that failed to be processed by the graphs of a pipeline run to
+	a JSON-lines file at `filename`, with the name of the node that failed and the
+	exception raised.
+
+	A record is the value produced by one of the nodes at the start of a graph (the
+	roots of the graph, and their outputs, e.g. the rows produced by a
+	`CurriedCSVReader` from the filenames produced by a `MatchingFiles` node), and
+	is identified by the number of the graph being run (counting the graphs run by
+	the pipeline), and the index and name of the node that produced it.
+
+	The file is opened (replacing any previous file) when the first failure is
+	recorded. If its directory does not exist, failures are not recorded.
+	'''
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = None
+		self.graph = 0
+		self.count = 0
+
+	def start_graph(self):
+		self.graph += 1
+
+	def open(self):
+		if self.file is None:
+			with suppress(FileNotFoundError):
+				self.file = open(self.filename, 'w', buffering=1)
+		return self.file
+
+	def record(self, node, e, source):
+		'''
+		Record that `node` raised the exception `e` while processing the record
+		`source` (a tuple of the index and name of the node that produced the record,
+		and the record itself, as returned by `snapshot_record` when it was produced;
+		or `None` if the record is not known).
+		'''
+		self.count += 1
+		fh = self.open()
+		if fh is None:
+			return
+		data = {
+			'graph': self.graph,
+			'node': node_name(node),
+			'error': repr(e),
+			'traceback': ''.join(traceback.format_exception(type(e), e, e.__traceback__)),
+		}
+		if source is not None:
+			i, name, value = source
+			data.update({
+				'source': i,
+				'source_name': name,
+				'record': encode_record(value),
+			})
+		print(json.dumps(data), file=fh)
+
+	def extend(self, filename):
+		'''
+		Append the dead letters recorded by another queue (e.g. in a worker process)
+		in `filename`, if it exists.
+		'''
+		with suppress(FileNotFoundError), open(filename) as fh:
+			for line in fh:
+				self.count += 1
+				out = self.open()
+				if out is not None:
+					out.write(line)
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	@classmethod
+	def load(cls, filename):
+		'''
+		Return a `dict` mapping graph numbers to lists of the dead letters recorded
+		for the graph in `filename` that can be replayed. A record that caused more
+		than one failure is only returned once.
+		'''
+		entries = {}
+		seen = set()
+		with open(filename) as fh:
+			for line in fh:
+				data = json.loads(line)
+				if 'record' not in data:
+					continue
+				key = (data['graph'], data['source'], json.dumps(data['record'], sort_keys=True))
+				if key in seen:
+					continue
+				seen.add(key)
+				try:
+					data['record'] = decode_record(data['record'])
+				except ValueError as e:
+					warnings.warn(f'Skipping dead letter from node {data["node"]}: {e}')
+					continue
+				entries.setdefault(data['graph'], []).append(data)
+		return entries
@@ -3,10 +3,16 @@ import sys
 import pprint
 # import sys
 import traceback
+import warnings
+import copy
 import types
+import pickle
+import hashlib
+import tempfile
+import multiprocessing
 from functools import partial
 import time
-from collections import Counter, defaultdict, namedtuple
+from collections import Counter, defaultdict, deque, namedtuple
 from contextlib import suppress
 
 from bonobo.config import use, Option, Service, Configurable
@@ -14,51 +20,346 @@ from bonobo.constants import BEGIN, NOT_MODIFIED
 from bonobo.util import get_name, isconfigurabletype, isconfigurable
 import settings
 
+from pipeline.util import CromObjectMerger, crom_dump, crom_load
+from pipeline.metrics import LatencyHistogram, MetricsWriter, NodeProfiler
+from pipeline.linkedart import add_crom_data
+from pipeline.deadletters import DeadLetterQueue, snapshot_record
+from pipeline.io.csv import ByteRange, CurriedCSVReader, record_boundaries, skip_records
+from pipeline.io.compression import compression_suffix, find_input
+from pipeline.io.file import MergingFileWriter, filename_for
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
+
+def _is_counter(value):
+	return isinstance(value, Counter) or (isinstance(value, defaultdict) and value.default_factory is int)
+
+def _container_kind(value):
+	for kind in (dict, list, set):
+		if isinstance(value, kind):
+			return kind
+	return None
+
+def state_delta(before, after):
+	'''
+	Return the changes made to the state container `after` since `before` was copied
+	from it, in a form that can be applied to another copy of `before` with
+	`merge_state`. Lists are assumed to only ever be appended to.
+	'''
+	if _is_counter(after):
+		return {k: v - before.get(k, 0) for k, v in after.items() if v != before.get(k, 0)}
+	elif isinstance(after, dict):
+		delta = {}
+		for k, v in after.items():
+			if k not in before:
+				delta[k] = v
+			elif _container_kind(v) and _container_kind(v) is _container_kind(before[k]):
+				d = state_delta(before[k], v)
+				if d:
+					delta[k] = d
+			elif before[k] != v:
+				delta[k] = v
+		return delta
+	elif isinstance(after, list):
+		return after[len(before):]
+	elif isinstance(after, set):
+		return after - before
+	return after
+
+def merge_state(target, source):
+	'''
+	Merge the accumulated state in the container `source` into `target` (in place).
+
+	This is used to combine the mutable services (e.g. `post_sale_map` or `counts`)
+	that are populated independently by the worker processes of a
+	`ShardedGraphExecutor`. Dictionaries are merged recursively, lists are extended,
+	and sets are unioned. Values in integer-valued counters (`Counter` or
+	`defaultdict(int)`) are summed. Any other value in `source` replaces the
+	corresponding value in `target`.
+	'''
+	if _is_counter(target):
+		for k, v in source.items():
+			target[k] += v
+	elif isinstance(target, dict):
+		for k, v in source.items():
+			if k in target and _container_kind(v) and _container_kind(v) is _container_kind(target[k]):
+				merge_state(target[k], v)
+			else:
+				target[k] = v
+	elif isinstance(target, list):
+		target.extend(source)
+	elif isinstance(target, set):
+		target.update(source)
+	return target
+
+def state_conflicts(target, source, path=()):
+	'''
+	Return the keys (as tuples of the keys of the nested containers holding them) of
+	the values in the state container `target` that `merge_state(target, source)`
+	would replace with a different value.
+	'''
+	conflicts = []
+	if isinstance(target, dict) and not _is_counter(target):
+		for k, v in source.items():
+			if k not in target:
+				continue
+			if _container_kind(v) and _container_kind(v) is _container_kind(target[k]):
+				conflicts.extend(state_conflicts(target[k], v, path + (k,)))
+			elif target[k] != v:
+				conflicts.append(path + (k,))
+	return conflicts
+
+def replace_state(target, source):
+	'''Replace the contents of the state container `target` (in place) with those of `source`.'''
+	target.clear()
+	return merge_state(target, source)
+
+class PlanNode:
+	'''
+	A node of an `ExecutionPlan`: the graph node with its services bound, its name,
+	and the indexes of the nodes its results are passed to.
+
+	If a service that the node looks up by name at runtime is not available,
+	`missing_service` holds the name, and `bound()` raises a `KeyError` (as binding
+	the node's services would each time the node is called).
+	'''
+	__slots__ = ('index', 'name', 'node', 'call', 'outputs', 'missing_service')
+
+	def __init__(self, index, name, node, call, outputs, missing_service=None):
+		self.index = index
+		self.name = name
+		self.node = node
+		self.call = call
+		self.outputs = outputs
+		self.missing_service = missing_service
+
+	def bound(self):
+		if self.missing_service is not None:
+			raise KeyError(self.missing_service)
+		return self.call
+
+class ExecutionPlan:
+	'''
+	A flat, precompiled form of a bonobo graph, used by `GraphExecutor` so that the
+	work of binding services to nodes, naming nodes, and finding the outputs of each
+	node is done once per graph instead of once per record.
+	'''
+	def __init__(self, graph, services):
+		self.roots = tuple(graph.outputs_of(BEGIN))
+		self.nodes = {}
+		for i in graph.topologically_sorted_indexes:
+			self.nodes[i] = self.compile_node(graph, i, services)
+
+	def __getitem__(self, i):
+		return self.nodes[i]
+
+	def __iter__(self):
+		return iter(self.nodes.values())
+
+	def levels(self):
+		'''Return the depth at which each node is first reached from the start of the graph.'''
+		levels = {}
+		queue = deque((i, 0) for i in self.roots)
+		while queue:
+			i, level = queue.popleft()
+			if i in levels:
+				continue
+			levels[i] = level
+			queue.extend((j, level+1) for j in self.nodes[i].outputs)
+		return levels
+
+	def fuse(self, executor, barriers=()):
+		'''
+		Replace each linear run of nodes in the plan (where every node but the last has
+		a single output, and every node but the first has a single input) with a single
+		`FusedSegment` node, run using the `call_node` and `report_error` methods of
+		`executor`. Nodes in `barriers` are left as they are.
+		'''
+		inputs = Counter(self.roots)
+		for p in self.nodes.values():
+			inputs.update(p.outputs)
+
+		def fusible(p):
+			return p.index not in barriers and p.missing_service is None
+
+		def next_stage(p):
+			if len(p.outputs) != 1:
+				return None
+			q = self.nodes[p.outputs[0]]
+			if inputs[q.index] != 1 or not fusible(q):
+				return None
+			return q
+
+		levels = self.levels()
+		absorbed = set()
+		for i in list(self.nodes):
+			if i in absorbed:
+				continue
+			p = self.nodes[i]
+			if not fusible(p):
+				continue
+			stages = [p]
+			q = next_stage(p)
+			while q is not None:
+				stages.append(q)
+				q = next_stage(q)
+			if len(stages) < 2:
+				continue
+			segment = FusedSegment(i, stages, executor, levels.get(i, 0))
+			self.nodes[i] = PlanNode(i, segment.__name__, segment, segment, stages[-1].outputs)
+			for q in stages[1:]:
+				absorbed.add(q.index)
+				del self.nodes[q.index]
+		return self
+
+	@staticmethod
+	def compile_node(graph, i, services):
+		node = graph[i]
+		options = dict(getattr(node, '__options__', {}))
+		bindings = {}
+		missing_service = None
+		for k, v in options.items():
+			if isinstance(v, Service):
+				s = services.get(k)
+				if s is None:
+					# the service is named by the node's option value, not the option name
+					service_name = getattr(node, k)
+					if service_name not in services:
+						missing_service = service_name
+						continue
+					s = services[service_name]
+				bindings[k] = s
+		call = partial(node, **bindings) if bindings else node
+		return PlanNode(i, get_name(node), node, call, tuple(graph.outputs_of(i)), missing_service)
+
+class FusedSegment:
+	'''
+	A linear run of graph nodes, called as a single node of an `ExecutionPlan`.
+
+	Each value produced by a stage is passed directly to the next stage, and the
+	values produced by the last stage are yielded. Errors are reported and handled
+	for each stage as they would be if the stages were run as separate nodes, but
+	calls, counters, and timers are recorded for the segment as a whole.
+	'''
+	def __init__(self, index, stages, executor, level=0):
+		self.index = index
+		self.stages = tuple(stages)
+		self.executor = executor
+		self.level = level
+		self.__name__ = '+'.join(p.name for p in self.stages)
+
+	def __repr__(self):
+		return f'<FusedSegment {self.__name__}>'
+
+	def __call__(self, input=None):
+		return self.run_stage(0, input)
+
+	def run_stage(self, k, input):
+		e = self.executor
+		node = self.stages[k].call
+		last = k == len(self.stages) - 1
+		try:
+			result = e.call_node(self.index, self.__name__, node, input, self.level)
+			if isinstance(result, types.GeneratorType):
+				for r in result:
+					if last:
+						yield r
+					else:
+						yield from self.run_stage(k+1, r)
+			elif last:
+				yield result
+			else:
+				yield from self.run_stage(k+1, result)
+		except Exception as exc:
+			e.report_error(node, exc, self.level + k)
+
 class GraphExecutor(object):
 	'''
 	Run a bonobo graph sequentially on a single thread, allowing easier debugging
 	and profiling.
 	'''
-	def __init__(self, graph, services, verbose=False):
-		file = None
-		with suppress(FileNotFoundError):
-			file = open(os.path.join(settings.output_file_path, 'pipeline.counters'), 'wt', buffering=1)
-# 		if not file:
-# 			file = sys.stdout
-		self.file = file
+	def __init__(self, graph, services, verbose=False, fuse=False, profiler=None, memory=None, checkpoint=None, dead_letters=None):
+		self.file = self.open_counters_file()
+		self.profiler = profiler if profiler is not None else self.open_profiler()
+		self.memory = memory
 		self.counters_in = defaultdict(int)
 		self.counters_out = defaultdict(int)
 		self.timers = defaultdict(float)
+		self.inclusive_timers = defaultdict(float)
+		self.timer_stack = []
+		self.timer_start = None
+		self.latency = defaultdict(LatencyHistogram)
+		self.metrics_writer = self.open_metrics_writer()
 		self.start_time = time.time()
 		self.next_emit_time = self.start_time + 10.0
 		self.graph = graph
 		self.services = services.copy()
-		self.service_bindings = {}
-		self.runtime_bindings = {}
 		self.verbose = verbose
-		for ix in graph.topologically_sorted_indexes:
-			node = graph[ix]
-# 			name = get_name(node)
-			options = dict(getattr(node, '__options__', {}))
-			self.service_bindings[ix] = []
-			self.runtime_bindings[ix] = []
-			for k, v in options.items():
-				if isinstance(v, Service):
-					s = services.get(k)
-					if s is not None:
-						self.service_bindings[ix].append((k, s))
-					else:
-						self.runtime_bindings[ix].append(k)
-# 			print(f'[{name}] static services: {self.service_bindings[ix]}')
-# 			print(f'[{name}] runtime services: {self.runtime_bindings[ix]}')
+		self.dead_letters = dead_letters
+		self.sources = [None, None]
+		self.checkpoint = checkpoint
+		self.readers = {}
+		if checkpoint is not None:
+			self.readers = {i: graph[i] for i in graph.topologically_sorted_indexes if isinstance(graph[i], CurriedCSVReader)}
+			checkpoint.attach_readers(self.readers)
+		self.plan = ExecutionPlan(graph, self.services)
+		if fuse:
+			self.plan.fuse(self, barriers=self.fusion_barriers())
 # 		for i in self.graph.outputs_of(BEGIN):
 # 			self.print_tree(i)
 
+	def fusion_barriers(self):
+		'''Return the indexes of graph nodes that must not be fused with their neighbours.'''
+		# the progress of readers is checkpointed as their rows are processed
+		barriers = set(self.readers)
+		if self.dead_letters is not None:
+			# the records that are recorded as dead letters are those produced by the
+			# nodes at the start of the graph
+			barriers.update(i for i, level in self.plan.levels().items() if level <= 1)
+		if self.profiler is not None:
+			# nodes are selected for profiling by name, which a fused segment does not have
+			barriers.update(p.index for p in self.plan if self.profiler.wants(p.name))
+		if self.memory is not None:
+			# memory growth is attributed to each node
+			barriers.update(p.index for p in self.plan)
+		return barriers
+
+	def open_counters_file(self):
+		file = None
+		with suppress(FileNotFoundError):
+			file = open(os.path.join(settings.output_file_path, 'pipeline.counters'), 'wt', buffering=1)
+# 		if not file:
+# 			file = sys.stdout
+		return file
+
+	def open_metrics_writer(self):
+		return MetricsWriter(settings.output_file_path)
+
+	def open_profiler(self):
+		'''
+		Return a `NodeProfiler` for the nodes named in the `GETTY_PIPELINE_PROFILE_NODES`
+		setting, or `None` if no nodes are to be profiled.
+		'''
+		nodes = NodeProfiler.parse_nodes(settings.pipeline_profile_nodes)
+		if not nodes:
+			return None
+		return NodeProfiler(nodes, settings.pipeline_profile_path, settings.pipeline_profile_sample_rate)
+
+	def write_profiles(self):
+		if self.profiler is not None:
+			self.profiler.write()
+
 	def run(self):
-		g = self.graph
-		for i in g.outputs_of(BEGIN):
+		checkpoint = self.checkpoint
+		for i in self.plan.roots:
+			if checkpoint is not None and checkpoint.is_complete(i, None):
+				continue
 			self.run_node(i, None, level=0)
+			if checkpoint is not None:
+				checkpoint.complete(i, None)
+				checkpoint.save_if_due()
 		self.print_counts()
+		self.write_metrics(final=True)
+		self.write_profiles()
 		if self.verbose:
 			print('================ DONE ================', file=self.file)
 
@@ -79,74 +380,219 @@ class GraphExecutor(object):
 				elapsed = self.timers[k]
 				j, level, name = k
 				message = name
-				message += f' [in={self.counters_in[j]}, out={self.counters_out[j]}]'
+				message += f' [in={self.counters_in[j]}, out={self.counters_out[j]}, inclusive=%.2f]' % (self.inclusive_timers[j],)
 				print(f'%7.2f\t{message}' % (self.timers[k]), file=file)
+			self.write_metrics()
+
+	def metrics(self):
+		'''
+		Return a list of the metrics collected for each node of the graph that has been
+		run (or for each fused segment of nodes), with the number of calls, values in and
+		out, the time spent in the node itself (`self_time`, including the time spent
+		producing values from a generator), the time spent in the node and in the nodes
+		processing its output (`inclusive_time`), and a `LatencyHistogram` of the self
+		time spent on each input.
+		'''
+		self_time = defaultdict(float)
+		for (i, _, _), elapsed in self.timers.items():
+			self_time[i] += elapsed
+		metrics = []
+		for p in self.plan:
+			i = p.index
+			if not self.counters_in[i]:
+				continue
+			metrics.append({
+				'index': i,
+				'name': p.name,
+				'calls': self.latency[i].count,
+				'in': self.counters_in[i],
+				'out': self.counters_out[i],
+				'self_time': self_time[i],
+				'inclusive_time': self.inclusive_timers[i],
+				'latency': self.latency[i],
+			})
+		return metrics
+
+	def write_metrics(self, final=False):
+		if self.metrics_writer is not None:
+			self.metrics_writer.write(self.metrics(), time.time() - self.start_time, final=final)
 
 	def tick_in(self, i, name, level):
 		self.counters_in[i] += 1
 		self.print_counts()
+		if self.memory is not None:
+			self.memory.tick()
 
 	def tick_out(self, i, name, level):
 		self.counters_out[i] += 1
 
-	def run_node(self, i, input, level=0):
-		g = self.graph
-		node = g[i]
-		name = get_name(node)
-		self.tick_in(i, name, level)
-		indent = '  ' * level
-		services = {k: v for k, v in self.service_bindings[i] if v is not None}
-		for k in self.runtime_bindings[i]:
-			s = getattr(node, k)
-			services[k] = self.services[s]
+	def enter_timer(self, key):
+		'''
+		Start attributing elapsed time to the timer `key` (until a matching call to
+		`leave_timer`), pausing the timer that was running.
+		'''
+		now = time.time()
+		stack = self.timer_stack
+		if stack:
+			self.timers[stack[-1]] += now - self.timer_start
+		stack.append(key)
+		if self.profiler is not None:
+			self.profiler.switch(key)
+		if self.memory is not None:
+			self.memory.switch(key)
+		self.timer_start = now
 
-		if services:
-			# print(f'*** binding services: {services}')
-			node = partial(node, **services)
+	def leave_timer(self):
+		now = time.time()
+		stack = self.timer_stack
+		key = stack.pop()
+		self.timers[key] += now - self.timer_start
+		if self.profiler is not None:
+			self.profiler.switch(stack[-1] if stack else None)
+		if self.memory is not None:
+			self.memory.switch(stack[-1] if stack else None)
+		self.timer_start = now
 
-# 		if services:
-# 			print(f'{indent}{name} {services.keys()}')
-# 		else:
-# 			print(f'{indent}{name}')
+	def iterate(self, key, results):
+		'''
+		Yield the values produced by the generator `results`, attributing the time spent
+		producing each one to the timer `key` (and not to the nodes that process them).
+		'''
+		while True:
+			self.enter_timer(key)
+			try:
+				r = next(results)
+			except StopIteration:
+				return
+			finally:
+				self.leave_timer()
+			yield r
 
+	def call_node(self, i, name, node, input, level):
+		'''
+		Call the bound `node` with `input`, and return the result (either a single value
+		or a generator of values).
+		'''
+		# print(f'calling {node!r}({input})')
+		checkpoint = self.checkpoint
+		resuming = checkpoint is not None and i in self.readers
+		if resuming:
+			if checkpoint.is_complete(i, input):
+				return self.track_reading(i, input, ())
+			self.readers[i].skip_rows[input] = checkpoint.resume_offset(i, input)
+		self.enter_timer((i, level, name))
 		try:
-			# print(f'calling {node!r}({input})')
-			start = time.time()
 			if input is None:
 				result = node()
 			else:
 				result = node(input)
-			end = time.time()
-			elapsed = end - start
-			self.timers[(i, level, name)] += elapsed
+		finally:
+			self.leave_timer()
+
+		if result == NOT_MODIFIED:
+			result = input
+		if resuming:
+			result = self.track_reading(i, input, result)
+		return result
+
+	def track_reading(self, i, input, rows):
+		'''
+		Yield the `rows` read by reader node `i` from `input`, recording each row in the
+		checkpoint once it has been processed by the rest of the graph.
+		'''
+		checkpoint = self.checkpoint
+		for row in rows:
+			yield row
+			checkpoint.advance(i, input)
+		checkpoint.complete(i, input)
 
-			if result == NOT_MODIFIED:
-				result = input
+	def report_error(self, node, e, level=None):
+		'''
+		Report that `node` (at depth `level` in the graph) raised the exception `e`,
+		and record the record being processed in the dead-letter queue.
+		'''
+		print(f'**** ERROR running {node}: {e!r}')
+		traceback.print_exc()
+		with open('log.txt', 'a') as f:
+			f.write(str(e))
+			f.write(traceback.format_exc())
+			f.write('\n\n')
+		if self.dead_letters is not None:
+			self.dead_letters.record(node, e, self.failure_source(level))
+
+	def failure_source(self, level):
+		'''
+		Return the record (as a tuple of the index and name of the node that produced
+		it, and the record itself) being processed by a node at depth `level` in the
+		graph: the last value produced by the node at depth 1 (or, for a node at depth
+		1, by the root) on the path to the node.
+		'''
+		if level is None or level < 1:
+			return None
+		return self.sources[min(level, 2) - 1]
+
+	def replay(self, dead_letters):
+		'''
+		Pass each of the records in `dead_letters` (as loaded by `DeadLetterQueue.load`)
+		to the outputs of the node that produced it, instead of running the whole graph.
+		'''
+		levels = self.plan.levels()
+		for entry in dead_letters:
+			i = entry['source']
+			if i not in self.plan.nodes or self.plan[i].name != entry['source_name']:
+				warnings.warn(f'Skipping dead letter from unknown node {entry["source_name"]} ({i})')
+				continue
+			level = levels[i]
+			self.sources[level] = (i, entry['source_name'], entry['record'])
+			self.emit(i, self.plan[i].name, entry['record'], level)
+		self.print_counts()
+		self.write_metrics(final=True)
+
+	def run_node(self, i, input, level=0):
+		start = time.time()
+		p = self.plan[i]
+		name = p.name
+		key = (i, level, name)
+		self_start = self.timers[key]
+		profiling = self.profiler is not None and self.profiler.start(key)
+		self.tick_in(i, name, level)
+		indent = '  ' * level
+		node = p.bound()
+
+# 		if services:
+# 			print(f'{indent}{name} {services.keys()}')
+# 		else:
+# 			print(f'{indent}{name}')
 
+		try:
+			result = self.call_node(i, name, node, input, level)
 			if isinstance(result, types.GeneratorType):
 				#print('RESULT IS A GENERATOR')
-				for r in result:
-					self.tick_out(i, name, level)
+				for r in self.iterate(key, result):
 					#print(f'[{name}] =gen=> {r}')
-					for j in g.outputs_of(i):
-						self.run_node(j, r, level=level+1)
+					self.emit(i, name, r, level)
 			else:
-				self.tick_out(i, name, level)
 				#print(f'RESULT IS {result}')
 				#print(f'[{name}] =ret=> {result}')
-				for j in g.outputs_of(i):
-					self.run_node(j, result, level=level+1)
+				self.emit(i, name, result, level)
 		except Exception as e:
-			print(f'**** ERROR running {node}: {e!r}')
-			traceback.print_exc()
-			with open('log.txt', 'a') as f:
-				f.write(str(e))
-				f.write(traceback.format_exc())
-				f.write('\n\n')
-
+			self.report_error(node, e, level)
+		self.inclusive_timers[i] += time.time() - start
+		self.latency[i].add(self.timers[key] - self_start)
+		if profiling:
+			self.profiler.stop(key)
 
 # 			raise
 
+	def emit(self, i, name, result, level):
+		'''Pass a `result` produced by node `i` to each of the node's outputs.'''
+		self.tick_out(i, name, level)
+		if level <= 1 and self.dead_letters is not None:
+			# the record is copied before the nodes it is passed to can modify it
+			self.sources[level] = (i, name, snapshot_record(result))
+		for j in self.plan[i].outputs:
+			self.run_node(j, result, level=level+1)
+
 	def print_tree(self, i, level=0):
 		g = self.graph
 		node = g[i]
@@ -155,3 +601,562 @@ class GraphExecutor(object):
 		print(f'{indent}{name}')
 		for j in g.outputs_of(i):
 			self.print_tree(j, level=level+1)
+
+
+class _Frame:
+	'''
+	A node call on the stack of an `IterativeGraphExecutor`. `results` is the
+	iterator of values still to be pulled from the node (`None` once it is
+	exhausted), and `pending` holds the calls of the node's outputs that are waiting
+	to be made with the values already pulled. `input` is the value the node was
+	called with (and `record` a snapshot of it, taken when it was produced, if it
+	may be recorded as a dead letter), `start` is the time at which the node was
+	called, and `self_start` the value of its self-time timer at that time.
+	'''
+	__slots__ = ('i', 'name', 'node', 'level', 'input', 'record', 'results', 'pending', 'start', 'self_start')
+
+	def __init__(self, i, name, node, level, input=None, record=None, results=None, pending=(), start=None, self_start=0.0):
+		self.i = i
+		self.name = name
+		self.node = node
+		self.level = level
+		self.input = input
+		self.record = record
+		self.results = results
+		self.pending = deque(pending)
+		self.start = start
+		self.self_start = self_start
+
+	@property
+	def key(self):
+		return (self.i, self.level, self.name)
+
+class IterativeGraphExecutor(GraphExecutor):
+	'''
+	Run a bonobo graph sequentially like `GraphExecutor`, but walk the graph using an
+	explicit stack of node calls instead of recursing for every record.
+
+	Values are pulled from a generator node at most `queue_size` at a time, and each
+	batch is passed through the rest of the graph before more values are pulled. A
+	`queue_size` of 1 processes records in the same order as `GraphExecutor`; larger
+	values read ahead of downstream processing, trading peak memory and per-record
+	latency for fewer switches between nodes.
+	'''
+	def __init__(self, graph, services, queue_size=1, verbose=False, fuse=False, profiler=None, memory=None, dead_letters=None):
+		super().__init__(graph, services, verbose=verbose, fuse=fuse, profiler=profiler, memory=memory, dead_letters=dead_letters)
+		self.queue_size = max(1, queue_size)
+		self.stack = []
+		self.starting = None
+
+	def run(self):
+		root = _Frame(None, None, None, -1, pending=[(i, None, None) for i in self.plan.roots])
+		self.stack = [root]
+		self.walk()
+		self.print_counts()
+		self.write_metrics(final=True)
+		self.write_profiles()
+		if self.verbose:
+			print('================ DONE ================', file=self.file)
+
+	def walk(self):
+		stack = self.stack
+		while stack:
+			frame = stack[-1]
+			if frame.pending:
+				j, input, record = frame.pending.popleft()
+				try:
+					self.start_node(j, input, frame.level + 1, record)
+				except Exception as e:
+					# failing to bind the services of a node aborts the calling node
+					# (as it does when the node is run recursively)
+					self.report_error(frame.node, e, frame.level)
+					frame.pending.clear()
+					frame.results = None
+			elif frame.results is not None:
+				self.pull(frame)
+			else:
+				stack.pop()
+				if frame.node is not None:
+					self.finish_node(frame)
+
+	def start_node(self, i, input, level, record=None):
+		start = time.time()
+		p = self.plan[i]
+		name = p.name
+		self.tick_in(i, name, level)
+		node = p.bound()
+		frame = _Frame(i, name, node, level, input=input, record=record, start=start, self_start=self.timers[(i, level, name)])
+		if self.profiler is not None:
+			self.profiler.start(frame.key)
+		try:
+			self.starting = frame
+			result = self.call_node(i, name, node, input, level)
+		except Exception as e:
+			self.report_error(node, e, level)
+			self.finish_node(frame)
+			return
+		finally:
+			self.starting = None
+		self.stack.append(frame)
+		if isinstance(result, types.GeneratorType):
+			frame.results = result
+		else:
+			self.emit(i, name, result, level)
+
+	def finish_node(self, frame):
+		self.inclusive_timers[frame.i] += time.time() - frame.start
+		self.latency[frame.i].add(self.timers[frame.key] - frame.self_start)
+		if self.profiler is not None:
+			self.profiler.stop(frame.key)
+
+	def pull(self, frame):
+		'''Pull up to `queue_size` values from the node of the `frame` on top of the stack.'''
+		key = frame.key
+		try:
+			for _ in range(self.queue_size):
+				self.enter_timer(key)
+				try:
+					r = next(frame.results)
+				finally:
+					self.leave_timer()
+				self.emit(frame.i, frame.name, r, frame.level)
+		except StopIteration:
+			frame.results = None
+		except Exception as e:
+			self.report_error(frame.node, e, frame.level)
+			frame.results = None
+
+	def emit(self, i, name, result, level):
+		self.tick_out(i, name, level)
+		frame = self.stack[-1]
+		record = None
+		if level <= 1 and self.dead_letters is not None:
+			# the record is copied before the nodes it is passed to can modify it
+			record = snapshot_record(result)
+		frame.pending.extend((j, result, record) for j in self.plan[i].outputs)
+
+	def failure_source(self, level):
+		if level is None or level < 1:
+			return None
+		# the call at depth 1 or 2 on the current path was made with the record, which
+		# was produced by the call below it on the stack
+		depth = min(level, 2)
+		frames = self.stack
+		if self.starting is not None and self.starting.level == depth:
+			parent = frames[-1]
+			return (parent.i, parent.name, self.starting.record)
+		for k in range(len(frames) - 1, 0, -1):
+			if frames[k].level == depth:
+				parent = frames[k-1]
+				return (parent.i, parent.name, frames[k].record)
+		return None
+
+	def replay(self, dead_letters):
+		levels = self.plan.levels()
+		for entry in dead_letters:
+			i = entry['source']
+			if i not in self.plan.nodes or self.plan[i].name != entry['source_name']:
+				warnings.warn(f'Skipping dead letter from unknown node {entry["source_name"]} ({i})')
+				continue
+			# stand-in for the call of the node that produced the record
+			frame = _Frame(i, entry['source_name'], None, levels[i])
+			self.stack = [frame]
+			self.emit(i, frame.name, entry['record'], frame.level)
+			self.walk()
+		self.print_counts()
+		self.write_metrics(final=True)
+
+class _CollectingWriter:
+	'''
+	Stands in for a `MergingMemoryWriter`, `MergingFileWriter` or `SegmentWriter`
+	node in the worker process of a `ShardedGraphExecutor`, merging the objects it is
+	passed in memory so that they can be handed back to the parent process.
+	'''
+	def __init__(self, writer):
+		self.__name__ = get_name(writer)
+		self.by_filename = isinstance(writer, (MergingFileWriter, SegmentWriter))
+		self.data = {}
+		self.merger = CromObjectMerger()
+
+	def __call__(self, data: dict):
+		model_object = data.get('_LOD_OBJECT')
+		if model_object is None:
+			return None
+		if self.by_filename:
+			# keep the filename the file writer would have used for this record
+			filename, _ = filename_for(data)
+			key = filename[:-len('.json')]
+			fields = {'uuid': key}
+		else:
+			key = model_object.id
+			fields = {}
+		if key in self.data:
+			_, m = self.data[key]
+			if m != model_object:
+				self.merger.merge(m, model_object)
+		else:
+			self.data[key] = (fields, model_object)
+		return None
+
+class _ShardWorker(GraphExecutor):
+	'''
+	The executor run in each worker process of a `ShardedGraphExecutor`, which calls
+	the shard nodes with the inputs assigned to the worker (and runs the rest of the
+	graph on the records they produce).
+	'''
+	def __init__(self, graph, services, shard_nodes, fuse=False, dead_letters=None):
+		self.shard_nodes = shard_nodes
+		super().__init__(graph, services, fuse=fuse, dead_letters=dead_letters)
+
+	def fusion_barriers(self):
+		# the shard nodes are called directly
+		return super().fusion_barriers() | set(self.shard_nodes)
+
+	def open_counters_file(self):
+		return None
+
+	def open_metrics_writer(self):
+		return None
+
+	def open_profiler(self):
+		profiler = super().open_profiler()
+		if profiler is not None:
+			# each worker writes its own profiles
+			profiler.suffix = f'.{os.getpid()}'
+		return profiler
+
+	def print_counts(self):
+		pass
+
+	def run_calls(self, calls):
+		producers = {j: p for p in self.plan for j in p.outputs}
+		for i, input, level in calls:
+			if self.dead_letters is not None and 1 <= level <= 2 and i in producers:
+				# the input is recorded as produced by the node the shard node follows
+				p = producers[i]
+				self.sources[level - 1] = (p.index, p.name, snapshot_record(input))
+			self.run_node(i, input, level)
+		self.write_profiles()
+
+def _fingerprint(value):
+	'''Return a digest of the content of `value`, or `None` if it cannot be pickled.'''
+	try:
+		return hashlib.sha1(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)).digest()
+	except Exception:
+		return None
+
+class ShardedGraphExecutor(GraphExecutor):
+	'''
+	Run a bonobo graph in several worker processes, each handling a contiguous block of
+	the records read by the graph's `CurriedCSVReader` nodes (the shard nodes).
+
+	The roots of the graph that lead to shard nodes are run in this process, with the
+	calls to the shard nodes recorded instead of made. Their inputs are then divided
+	into blocks of about the same size by splitting the files into `ByteRange`s at
+	record boundaries, without parsing them (compressed files are not split). Each
+	worker (forked from this process) calls the shard nodes with the inputs of its
+	block, with the writer nodes collecting their objects in memory; once all
+	workers are done, the collected objects are passed to the real writers of this
+	process in worker order, and the containers in `shared_state` (e.g. the mutable
+	pipeline services) are merged with `merge_state`. The blocks are contiguous and
+	the workers are reduced in order, but the parts of an object collected by a
+	worker are merged with each other before they are merged with those of earlier
+	workers, so the merge order is only that of a serial run for merges that are
+	associative. Roots that do not lead to a shard node are run once, in this process
+	(before the workers if they precede the first root that does).
+
+	A limit on the rows read by a shard node is applied when the blocks are planned
+	(by counting records); if that is not possible (for compressed files, or when
+	only selected records are read), the graph is run serially.
+
+	Records are only independent between workers as far as the state of the pipeline
+	goes: the state added to a service by the records of one worker is not seen by
+	the records of the others (only merged once they are all done). The services
+	that accumulate state must be listed in `shared_state`, and sharding only gives
+	the results of a serial run if that state is insert-only or commutative
+	(counters, sets, lists that are appended to, and maps whose keys are each only
+	ever set to one value). The results of the workers are discarded, and the shard
+	nodes run serially with a warning, if a worker changes a (container) service that
+	is not listed, or if merging the state of the workers would replace a value (set
+	before the workers were forked, or by an earlier worker) with a different one,
+	as a record of a later worker may then have depended on a value it could not see
+	(e.g. a map in which the first value set for a key wins).
+
+	Failures in the workers are recorded in `dead_letters` (in worker order, once
+	all of the workers are done).
+
+	Graphs without any `CurriedCSVReader` nodes are run serially.
+	'''
+	def __init__(self, graph, services, processes=2, shared_state=None, verbose=False, fuse=False, memory=None, dead_letters=None):
+		self.fuse = fuse
+		self.processes = processes
+		self.shared_state = shared_state or {}
+		self.shard_nodes = {i for i in graph.topologically_sorted_indexes if isinstance(graph[i], CurriedCSVReader)}
+		self.writer_nodes = {i for i in graph.topologically_sorted_indexes if isinstance(graph[i], (MergingMemoryWriter, MergingFileWriter, SegmentWriter))}
+		# while the roots are run to plan the shards, the calls to the shard nodes
+		self.planned_calls = None
+		super().__init__(graph, services, verbose=verbose, fuse=fuse, memory=memory, dead_letters=dead_letters)
+
+	def fusion_barriers(self):
+		# fused the same way as the graphs of the workers, so that their counters
+		# and timers refer to the same nodes
+		return super().fusion_barriers() | set(self.shard_nodes)
+
+	def sharded_roots(self):
+		'''Return the roots of the graph from which a shard node is reached.'''
+		g = self.graph
+		roots = set()
+		for root in self.plan.roots:
+			queue = deque([root])
+			seen = set()
+			while queue:
+				i = queue.popleft()
+				if i in self.shard_nodes:
+					roots.add(root)
+					break
+				if i not in seen:
+					seen.add(i)
+					queue.extend(g.outputs_of(i))
+		return roots
+
+	def run_node(self, i, input, level=0):
+		if self.planned_calls is not None and i in self.shard_nodes:
+			# the shard nodes are called by the workers
+			self.planned_calls.append((i, input, level))
+			return
+		super().run_node(i, input, level)
+
+	def run(self):
+		if self.processes < 2 or not self.shard_nodes:
+			return super().run()
+
+		roots = self.plan.roots
+		sharded = self.sharded_roots()
+		first = min(k for k, i in enumerate(roots) if i in sharded)
+		for i in roots[:first]:
+			self.run_node(i, None, level=0)
+		self.planned_calls = []
+		for i in roots[first:]:
+			if i in sharded:
+				self.run_node(i, None, level=0)
+		calls, self.planned_calls = self.planned_calls, None
+
+		blocks = self.plan_blocks(calls)
+		if blocks is None or not self.run_shards(blocks):
+			for i, input, level in calls:
+				super().run_node(i, input, level)
+		for i in roots[first:]:
+			if i not in sharded:
+				self.run_node(i, None, level=0)
+
+		self.next_emit_time = time.time()
+		self.print_counts()
+		self.write_metrics(final=True)
+		self.write_profiles()
+		if self.verbose:
+			print('================ DONE ================', file=self.file)
+
+	def input_units(self, i, input):
+		'''
+		Return the inputs read by the call of shard node `i` with `input`, as a list of
+		`(part, size, splittable)` tuples, where `part` is a `ByteRange` if `splittable`
+		is true.
+		'''
+		p = self.plan[i]
+		fs = p.call.keywords.get('fs') if isinstance(p.call, partial) else None
+		parts = input if isinstance(input, tuple) and not isinstance(input, ByteRange) else (input,)
+		units = []
+		for part in parts:
+			if isinstance(part, ByteRange):
+				units.append((part, part.end - part.start, True))
+			elif isinstance(part, str) and fs is not None:
+				filename = find_input(fs, part)
+				if not fs.exists(filename):
+					# the reader reports the missing file
+					units.append((part, 0, False))
+				elif compression_suffix(filename):
+					units.append((part, fs.getsize(filename), False))
+				else:
+					units.append((ByteRange(part, 0, fs.getsize(filename)), fs.getsize(filename), True))
+			else:
+				units.append((part, 0, False))
+		return units
+
+	def apply_limit(self, i, units):
+		'''
+		Return the `units` of shard node `i` truncated to the rows the node may still
+		read (if it has a limit), or `None` if they cannot be.
+		'''
+		reader = self.graph[i]
+		if not reader.limit:
+			return units
+		if reader.record_ids is not None or not all(splittable for _, _, splittable in units):
+			return None
+		fs = self.plan[i].call.keywords['fs']
+		remaining = max(reader.limit - reader.count, 0)
+		limited = []
+		for part, size, splittable in units:
+			if not remaining:
+				break
+			with fs.open(part.path, 'rb') as fh:
+				end, count = skip_records(fh, part.start, part.end, remaining)
+			remaining -= count
+			limited.append((ByteRange(part.path, part.start, end), end - part.start, True))
+		return limited
+
+	def plan_blocks(self, calls):
+		'''
+		Divide the inputs of the shard node `calls` (as `(i, input, level)` tuples) into
+		`processes` contiguous blocks of about the same size, returning the calls to be
+		made by each worker, or `None` if the graph must be run serially.
+		'''
+		units = []
+		by_node = defaultdict(list)
+		for i, input, level in calls:
+			for part, size, splittable in self.input_units(i, input):
+				by_node[i].append(len(units))
+				units.append([i, level, part, size, splittable])
+		for i, indexes in by_node.items():
+			limited = self.apply_limit(i, [tuple(units[k][2:]) for k in indexes])
+			if limited is None:
+				warnings.warn(f'Running {self.plan[i].name} serially, as its limit cannot be applied to sharded inputs')
+				return None
+			for n, k in enumerate(indexes):
+				if n < len(limited):
+					units[k][2:] = limited[n]
+				else:
+					units[k] = None
+		units = [u for u in units if u is not None]
+
+		n = self.processes
+		total = sum(size for _, _, _, size, _ in units)
+		blocks = [[] for _ in range(n)]
+		pos = 0
+		for i, level, part, size, splittable in units:
+			targets = [total * k // n for k in range(1, n) if pos < total * k // n < pos + size]
+			if not splittable or not targets:
+				blocks[min(n - 1, pos * n // total) if total else 0].append((i, level, part))
+				pos += size
+				continue
+			fs = self.plan[i].call.keywords['fs']
+			with fs.open(part.path, 'rb') as fh:
+				boundaries = record_boundaries(fh, [part.start + t - pos for t in targets])
+			offsets = sorted({part.start, part.end} | {b for b in boundaries if part.start < b < part.end})
+			for start, end in zip(offsets, offsets[1:]):
+				w = min(n - 1, (pos + start - part.start) * n // total)
+				blocks[w].append((i, level, ByteRange(part.path, start, end)))
+			pos += size
+		return [[(i, part, level) for i, level, part in block] for block in blocks]
+
+	def unlisted_services(self):
+		'''Return the container services that are not part of the shared state.'''
+		shared = {id(v) for v in self.shared_state.values()}
+		return {k: v for k, v in self.services.items() if _container_kind(v) and id(v) not in shared}
+
+	def run_shards(self, blocks):
+		'''
+		Run the `blocks` of calls in worker processes and reduce their results, or
+		return `False` if a worker changed a service that is not part of the shared
+		state, or the shared state changed by the workers depends on their order
+		(discarding the results of the workers).
+		'''
+		ctx = multiprocessing.get_context('fork')
+		# the workers report only the changes they make to the shared state, relative
+		# to this copy taken before they are forked
+		self.initial_state = copy.deepcopy(self.shared_state)
+		self.service_fingerprints = {k: _fingerprint(v) for k, v in self.unlisted_services().items()}
+		workers = []
+		for w, block in enumerate(blocks):
+			fd, path = tempfile.mkstemp(prefix='pipeline-shard-', suffix='.pickle', dir=settings.pipeline_tmp_path)
+			os.close(fd)
+			p = ctx.Process(target=self._run_shard, args=(block, path))
+			p.start()
+			workers.append((p, path))
+
+		try:
+			for w, (p, _) in enumerate(workers):
+				p.join()
+				if p.exitcode != 0:
+					raise RuntimeError(f'Shard worker {w} exited with status {p.exitcode}')
+			mutated = set()
+			conflicts = []
+			# the state of the workers is merged (in order) into the copy taken before
+			# they were forked, to find the values they set differently
+			merged = self.initial_state
+			for _, path in workers:
+				with open(path, 'rb') as fh:
+					mutated.update(crom_load(fh))
+					for name, state in crom_load(fh).items():
+						conflicts.extend(f'{name}' + ''.join(f'[{k!r}]' for k in key) for key in state_conflicts(merged[name], state))
+						merge_state(merged[name], state)
+			if mutated:
+				names = ', '.join(sorted(mutated))
+				warnings.warn(f'Running the graph serially, as its workers changed services that are not shared state: {names}')
+				return False
+			if conflicts:
+				names = ', '.join(conflicts[:10])
+				warnings.warn(f'Running the graph serially, as its workers set shared state differently: {names}')
+				return False
+			for _, path in workers:
+				with open(path, 'rb') as fh:
+					crom_load(fh)
+					state = crom_load(fh)
+					payload = crom_load(fh)
+				self._reduce(state, payload)
+				if self.dead_letters is not None:
+					self.dead_letters.extend(path + '.dead-letters')
+		finally:
+			for _, path in workers:
+				for filename in (path, path + '.dead-letters'):
+					with suppress(FileNotFoundError):
+						os.remove(filename)
+		return True
+
+	def _run_shard(self, calls, path):
+		g = self.graph
+		collectors = {}
+		for i in self.writer_nodes:
+			collectors[i] = _CollectingWriter(g[i])
+			g.nodes[i] = collectors[i]
+		dead_letters = None
+		if self.dead_letters is not None:
+			dead_letters = DeadLetterQueue(path + '.dead-letters')
+			dead_letters.graph = self.dead_letters.graph
+		e = _ShardWorker(g, self.services, self.shard_nodes, fuse=self.fuse, dead_letters=dead_letters)
+		e.run_calls(calls)
+		if dead_letters is not None:
+			dead_letters.close()
+		mutated = [k for k, v in self.unlisted_services().items() if self.service_fingerprints.get(k) not in (None, _fingerprint(v))]
+		state = {k: state_delta(self.initial_state[k], v) for k, v in self.shared_state.items()}
+		payload = {
+			'writers': {i: c.data for i, c in collectors.items()},
+			'counters_in': e.counters_in,
+			'counters_out': e.counters_out,
+			'timers': e.timers,
+			'inclusive_timers': e.inclusive_timers,
+			'latency': e.latency,
+		}
+		with open(path, 'wb') as fh:
+			# the changed services and state are read first, before the (larger) payload
+			crom_dump(mutated, fh)
+			crom_dump(state, fh)
+			crom_dump(payload, fh)
+
+	def _reduce(self, state, payload):
+		g = self.graph
+		for i, data in payload['writers'].items():
+			writer = g[i]
+			for fields, model_object in data.values():
+				writer(add_crom_data(data=dict(fields), what=model_object))
+		for name, delta in state.items():
+			merge_state(self.shared_state[name], delta)
+		for k, v in payload['counters_in'].items():
+			self.counters_in[k] += v
+		for k, v in payload['counters_out'].items():
+			self.counters_out[k] += v
+		for k, v in payload['timers'].items():
+			self.timers[k] += v
+		for k, v in payload['inclusive_timers'].items():
+			self.inclusive_timers[k] += v
+		for k, v in payload['latency'].items():
+			self.latency[k].merge(v)
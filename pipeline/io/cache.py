@@ -0,0 +1,100 @@
+'''
+A cache of the rows parsed from input files, so that unchanged inputs do not need
+to be parsed again by each pipeline run.
+'''
+
+import os
+import struct
+import marshal
+import hashlib
+from contextlib import suppress
+
+from pipeline.io.compression import find_input
+
+def content_hash(fs, path, prefix=b''):
+	'''
+	Return the SHA-1 hash (as a hex string) of `prefix` followed by the content of
+	the file at `path` (or its compressed variant) in the filesystem `fs`.
+	'''
+	h = hashlib.sha1(prefix)
+	with fs.open(find_input(fs, path), 'rb') as fh:
+		for chunk in iter(lambda: fh.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+class IngestCache:
+	'''
+	Store the rows parsed from input files (as lists of strings) in the directory
+	`path`, in a file named by the SHA-1 hash of the content of the input file. The
+	file holds a sequence of `marshal`led lists of up to `batch_size` rows, each
+	preceded by its length.
+
+	A cache file is only written once all of the rows of the input file have been
+	parsed, so that a run that stops reading a file early (e.g. because of a row
+	limit) does not leave an incomplete cache behind.
+	'''
+	# changing the format of the cache files (or the parsing of the input files)
+	# must change the version, so that existing cache files are not used
+	VERSION = b'csv-2'
+	LENGTH = struct.Struct('<Q')
+
+	def __init__(self, path, batch_size=1000):
+		self.path = path
+		self.batch_size = batch_size
+
+	def key(self, fs, path):
+		'''Return the hash of the content of the file at `path` in the filesystem `fs`.'''
+		return content_hash(fs, path, self.VERSION)
+
+	def filename(self, key):
+		return os.path.join(self.path, f'{key}.rows')
+
+	def rows(self, fs, path, parse):
+		'''
+		Yield the rows of the file at `path` in the filesystem `fs` from the cache if
+		it holds them, or otherwise from `parse(path, fs)`, adding them to the cache.
+		'''
+		filename = self.filename(self.key(fs, path))
+		if os.path.exists(filename):
+			yield from self.read(filename)
+		else:
+			yield from self.write(filename, parse(path, fs))
+
+	def read(self, filename):
+		with open(filename, 'rb') as fh:
+			while True:
+				header = fh.read(self.LENGTH.size)
+				if not header:
+					break
+				# reading each batch whole is much faster than `marshal.load(fh)`,
+				# which reads the file in small pieces
+				length, = self.LENGTH.unpack(header)
+				yield from marshal.loads(fh.read(length))
+
+	def write(self, filename, rows):
+		os.makedirs(self.path, exist_ok=True)
+		tmp = f'{filename}.{os.getpid()}.tmp'
+		complete = False
+		try:
+			with open(tmp, 'wb') as fh:
+				batch = []
+				for row in rows:
+					# the rows yielded may be modified, so a copy is cached
+					batch.append(row[:])
+					if len(batch) >= self.batch_size:
+						self.write_batch(fh, batch)
+						batch = []
+					yield row
+				if batch:
+					self.write_batch(fh, batch)
+			os.replace(tmp, filename)
+			complete = True
+		finally:
+			if not complete:
+				with suppress(FileNotFoundError):
+					os.remove(tmp)
+
+	def write_batch(self, fh, batch):
+		data = marshal.dumps(batch)
+		fh.write(self.LENGTH.pack(len(data)))
+		fh.write(data)
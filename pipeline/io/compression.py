@@ -0,0 +1,59 @@
+'''
+Transparent decompression of input files compressed with gzip, bzip2 or xz (with
+a '.gz', '.bz2' or '.xz' filename suffix).
+'''
+
+import os
+import bz2
+import gzip
+import lzma
+
+from fs.errors import NoSysPath
+
+COMPRESSION_MODULES = {
+	'.gz': gzip,
+	'.bz2': bz2,
+	'.xz': lzma,
+}
+
+def compression_suffix(path):
+	'''Return the compression suffix of the filename `path`, or `None`.'''
+	_, ext = os.path.splitext(str(path))
+	return ext if ext in COMPRESSION_MODULES else None
+
+def strip_compression_suffix(path):
+	'''Return the filename `path` without its compression suffix (if any).'''
+	suffix = compression_suffix(path)
+	return path[:-len(suffix)] if suffix else path
+
+def find_input(fs, path):
+	'''
+	Return `path` if it exists in the filesystem `fs`, or otherwise the first of its
+	compressed variants (`path` with a compression suffix) that does. If none exist,
+	`path` is returned.
+	'''
+	if compression_suffix(path) or fs.exists(path):
+		return path
+	for suffix in COMPRESSION_MODULES:
+		if fs.exists(path + suffix):
+			return path + suffix
+	return path
+
+def open_input(fs, path, mode='r', **kwargs):
+	'''
+	Open the file at `path` in the filesystem `fs` for reading, as with `fs.open`,
+	decompressing its content if `path` (or, if it does not exist, the compressed
+	variant found by `find_input`) has a compression suffix.
+	'''
+	path = find_input(fs, path)
+	suffix = compression_suffix(path)
+	if suffix is None:
+		return fs.open(path, mode, **kwargs)
+	module = COMPRESSION_MODULES[suffix]
+	if 'b' not in mode:
+		mode = mode.replace('t', '') + 't'
+	try:
+		return module.open(fs.getsyspath(path), mode, **kwargs)
+	except NoSysPath:
+		# the underlying file is closed when it is garbage collected
+		return module.open(fs.openbin(path), mode, **kwargs)
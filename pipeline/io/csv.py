@@ -1,17 +1,337 @@
 import os
 import sys
 import csv
+import marshal
 import fnmatch
 import warnings
+import multiprocessing
+from queue import Empty
+from collections import deque, namedtuple
+from collections.abc import MutableMapping
 
 from bonobo.constants import NOT_MODIFIED
 from bonobo.nodes.io.file import FileReader
 from bonobo.config import Configurable, Option, Service
 
+from pipeline.io.cache import IngestCache, content_hash
+from pipeline.io.compression import compression_suffix, find_input, open_input
+
+class _Missing:
+	def __reduce__(self):
+		return '_MISSING'
+
+# the value of a field that has been deleted from a `Row`
+_MISSING = _Missing()
+
+class Row(MutableMapping):
+	'''
+	A CSV row, which behaves as a `dict` mapping field names to values.
+
+	The values of the fields are stored in a list, with a mapping from field names
+	to positions in the list that is shared by all of the rows read from a file.
+	Keys that are not field names are stored in a separate `dict`, created when
+	the first such key is set. This uses a fraction of the memory of a `dict`
+	holding the same data.
+	'''
+	__slots__ = ('_index', '_values', '_extra')
+
+	def __init__(self, index, values):
+		self._index = index
+		self._values = values
+		self._extra = None
+
+	def __getitem__(self, key):
+		i = self._index.get(key)
+		if i is not None:
+			value = self._values[i]
+			if value is not _MISSING:
+				return value
+		elif self._extra is not None:
+			return self._extra[key]
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		i = self._index.get(key)
+		if i is not None:
+			self._values[i] = value
+		else:
+			if self._extra is None:
+				self._extra = {}
+			self._extra[key] = value
+
+	def __delitem__(self, key):
+		i = self._index.get(key)
+		if i is not None:
+			if self._values[i] is _MISSING:
+				raise KeyError(key)
+			self._values[i] = _MISSING
+		elif self._extra is not None:
+			del self._extra[key]
+		else:
+			raise KeyError(key)
+
+	def __contains__(self, key):
+		i = self._index.get(key)
+		if i is not None:
+			return self._values[i] is not _MISSING
+		return self._extra is not None and key in self._extra
+
+	def get(self, key, default=None):
+		i = self._index.get(key)
+		if i is not None:
+			value = self._values[i]
+			return default if value is _MISSING else value
+		elif self._extra is not None:
+			return self._extra.get(key, default)
+		return default
+
+	def __iter__(self):
+		values = self._values
+		for key, i in self._index.items():
+			if values[i] is not _MISSING:
+				yield key
+		if self._extra is not None:
+			yield from self._extra
+
+	def __len__(self):
+		values = self._values
+		count = sum(1 for i in self._index.values() if values[i] is not _MISSING)
+		if self._extra is not None:
+			count += len(self._extra)
+		return count
+
+	def copy(self):
+		row = Row(self._index, list(self._values))
+		if self._extra is not None:
+			row._extra = dict(self._extra)
+		return row
+
+	def __repr__(self):
+		return f'{type(self).__name__}({dict(self)!r})'
+
+class CSVRowText:
+	'''
+	The text of the fields of a CSV row, as lines of the form `{name}: {value}`,
+	which is only rendered (and then cached) when it is first converted to a string.
+	Until then, it holds a reference to the (shared) list of field `names` and to
+	the `values` of the row.
+	'''
+	__slots__ = ('_names', '_values', '_text')
+
+	def __init__(self, names, values):
+		self._names = names
+		self._values = values
+		self._text = None
+
+	def __str__(self):
+		if self._text is None:
+			self._text = ''.join([f'{k}: {v}\n' for k, v in zip(self._names, self._values)])
+			self._names = self._values = None
+		return self._text
+
+	def __bool__(self):
+		if self._text is None:
+			return bool(self._names)
+		return bool(self._text)
+
+	def __eq__(self, other):
+		if isinstance(other, CSVRowText):
+			other = str(other)
+		return str(self) == other
+
+	def __hash__(self):
+		return hash(str(self))
+
+	def __repr__(self):
+		return f'{type(self).__name__}({str(self)!r})'
+
+class ByteRange(namedtuple('ByteRange', 'path start end')):
+	'''
+	The records of the CSV file at `path` that start in the byte range `[start, end)`.
+	`start` must be the start of a record (as returned by `record_boundaries`).
+	'''
+	__slots__ = ()
+
+	def __str__(self):
+		return f'{self.path}[{self.start}:{self.end}]'
+
+def record_boundaries(fh, offsets, chunk_size=1 << 20):
+	'''
+	Return, for each of the sorted byte `offsets`, the offset of the first record
+	in the binary CSV file `fh` starting after it (or the size of the file).
+
+	The file is scanned once from its start, counting quote characters: a newline
+	ends a record only if an even number of quotes precedes it, as otherwise it is
+	part of a quoted field.
+	'''
+	targets = deque(offsets)
+	boundaries = []
+	quoted = False
+	pos = 0
+	fh.seek(0)
+	while targets:
+		chunk = fh.read(chunk_size)
+		if not chunk:
+			break
+		i = 0
+		while targets:
+			t = targets[0] - pos
+			if t >= len(chunk):
+				break
+			if t > i:
+				quoted ^= bool(chunk.count(b'"', i, t) & 1)
+				i = t
+			nl = chunk.find(b'\n', i)
+			if nl == -1:
+				break
+			quoted ^= bool(chunk.count(b'"', i, nl) & 1)
+			i = nl + 1
+			if not quoted:
+				while targets and targets[0] < pos + i:
+					targets.popleft()
+					boundaries.append(pos + i)
+		quoted ^= bool(chunk.count(b'"', i) & 1)
+		pos += len(chunk)
+	boundaries.extend(pos for _ in targets)
+	return boundaries
+
+def plan_byte_ranges(fs, path, shards):
+	'''
+	Split the CSV file at `path` into at most `shards` `ByteRange`s of about the
+	same size, each starting at the start of a record. The file must not be
+	compressed.
+	'''
+	size = fs.getsize(path)
+	if shards < 2 or size == 0:
+		return [ByteRange(path, 0, size)]
+	with fs.open(path, 'rb') as fh:
+		boundaries = record_boundaries(fh, [size * k // shards for k in range(1, shards)])
+	offsets = sorted(set([0] + boundaries + [size]))
+	return [ByteRange(path, start, end) for start, end in zip(offsets, offsets[1:])]
+
+def byte_range_lines(fh, start, end, encoding):
+	'''
+	Yield the lines of the binary CSV file `fh` from the offset `start` (which must
+	be the start of a record) up to the end of the record containing the offset
+	`end - 1`.
+	'''
+	fh.seek(start)
+	pos = start
+	quoted = False
+	while pos < end or quoted:
+		line = fh.readline()
+		if not line:
+			break
+		pos += len(line)
+		quoted ^= bool(line.count(b'"') & 1)
+		yield line.decode(encoding)
+
+def skip_records(fh, start, end, count):
+	'''
+	Return the offset of the record `count` records after the one at the offset
+	`start` of the binary CSV file `fh` (or of the end of the last record starting
+	before `end`, if there are fewer), and the number of records skipped, without
+	parsing them.
+	'''
+	fh.seek(start)
+	pos = start
+	quoted = False
+	skipped = 0
+	while (pos < end or quoted) and skipped < count:
+		line = fh.readline()
+		if not line:
+			break
+		pos += len(line)
+		quoted ^= bool(line.count(b'"') & 1)
+		if not quoted:
+			skipped += 1
+	return pos, skipped
+
+def record_offsets(fh, encoding):
+	'''
+	Yield the byte offset of each record of the binary CSV file `fh` (read from its
+	start), together with the (decoded) lines of the record.
+	'''
+	fh.seek(0)
+	pos = 0
+	start = 0
+	quoted = False
+	lines = []
+	for line in fh:
+		pos += len(line)
+		quoted ^= bool(line.count(b'"') & 1)
+		lines.append(line.decode(encoding))
+		if not quoted:
+			yield start, lines
+			start = pos
+			lines = []
+	if lines:
+		yield start, lines
+
+class RecordIndex:
+	'''
+	An index of the records of CSV files by the value of one of their columns (such
+	as a record number), mapping each value to the byte offsets of the records that
+	have it, so that those records can be read without parsing the rest of the file.
+
+	The index of each file is stored in the directory `path`, in a file named by the
+	SHA-1 hash of the content of the CSV file and the column number, and is built
+	the first time it is needed.
+	'''
+	VERSION = b'index-1'
+
+	def __init__(self, path):
+		self.path = path
+
+	def filename(self, fs, path, column):
+		key = content_hash(fs, path, self.VERSION)
+		return os.path.join(self.path, f'{key}.{column}.index')
+
+	def offsets(self, fs, path, column, encoding='utf-8'):
+		'''
+		Return a `dict` mapping the values of the column numbered `column` in the CSV
+		file at `path` in the filesystem `fs` to lists of the offsets of the records
+		with that value.
+		'''
+		filename = self.filename(fs, path, column)
+		try:
+			with open(filename, 'rb') as fh:
+				return marshal.load(fh)
+		except FileNotFoundError:
+			pass
+		with fs.open(path, 'rb') as fh:
+			index = self.build(fh, column, encoding)
+		os.makedirs(self.path, exist_ok=True)
+		tmp = f'{filename}.{os.getpid()}.tmp'
+		with open(tmp, 'wb') as fh:
+			marshal.dump(index, fh)
+		os.replace(tmp, filename)
+		return index
+
+	@staticmethod
+	def build(fh, column, encoding='utf-8'):
+		index = {}
+		for offset, lines in record_offsets(fh, encoding):
+			for row in csv.reader(lines):
+				if len(row) > column:
+					index.setdefault(row[column], []).append(offset)
+		return index
+
 class CurriedCSVReader(Configurable):
 	'''
 	This reader takes CSV filenames as input, and for each parses
 	the CSV content and yields a tuple of strings for each row.
+
+	The input may also be a `ByteRange`, to read only part of a file, or a tuple of
+	filenames and `ByteRange`s (as produced by `MatchingFiles` with `batch=True`),
+	whose rows are yielded in order. If `processes` is greater than 1,
+	the files are then parsed concurrently by that many worker processes, each
+	parsing every `processes`-th file and handing its rows back in batches through
+	a queue holding at most `queue_size` batches for each file, so that parsing
+	overlaps with the processing of the rows already read.
+
+	If `record_ids` is set, only the rows with those values of the `id_field` field
+	are read (e.g. to run a pipeline for a few records of a complete export).
 	'''
 	fs = Service(
 		'fs',
@@ -36,36 +356,225 @@ class CurriedCSVReader(Configurable):
 		default=False
 	)
 	field_names = Option()
+	processes = Option(
+		int,
+		default=1,
+		__doc__='''The number of processes used to parse a tuple of files concurrently.''',
+	)
+	queue_size = Option(
+		int,
+		default=16,
+		__doc__='''The number of batches of rows each file may be parsed ahead of processing.''',
+	)
+	compact_rows = Option(
+		bool,
+		default=True,
+		__doc__='''Yield rows as `Row` objects instead of dicts.''',
+	)
+	cache_path = Option(
+		str,
+		default='',
+		__doc__='''The directory of an `IngestCache` of the rows parsed from files, if any.''',
+	)
+	record_ids = Option(
+		required=False,
+		__doc__='''Only read the rows whose `id_field` value is one of these (if set).''',
+	)
+	id_field = Option(
+		str,
+		default='',
+		__doc__='''The field holding the record identifiers selected by `record_ids`.''',
+	)
+	index_path = Option(
+		str,
+		default='',
+		__doc__='''The directory of a `RecordIndex` used to find the rows selected by `record_ids`.''',
+	)
+	batch_size = 1000
+	# how often (in seconds) the workers parsing files are checked while waiting for their rows
+	poll_interval = 1.0
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.count = 0
+		# the number of rows to skip in the next read of each path (when resuming a run)
+		self.skip_rows = {}
+
+	def rows(self, path, fs):
+		'''
+		Yield the rows of the CSV file (or `ByteRange`) at `path` (as dicts, or `Row`s
+		if `compact_rows` is set, if `field_names` is set).
+		'''
+		return self.make_rows(path, self.records(path, fs))
+
+	def records(self, path, fs):
+		'''
+		Return an iterator of the fields of each row read from the CSV file (or
+		`ByteRange`) at `path`, as lists.
+		'''
+		names = self.field_names
+		if self.record_ids is not None and names and self.id_field in names:
+			return self.selected_rows(path, fs, names.index(self.id_field))
+		elif self.cache_path and not isinstance(path, ByteRange):
+			return IngestCache(self.cache_path).rows(fs, path, self.parse)
+		else:
+			return self.parse(path, fs)
+
+	def make_rows(self, path, records, index=None):
+		'''
+		Yield the rows (as returned by `rows`) of the field lists `records` read from
+		`path`. If `compact_rows` is set, the `Row`s share the field `index` (or an
+		index made for `path`).
+		'''
+		names = self.field_names
+		if names and self.compact_rows and index is None:
+			index = {name: i for i, name in enumerate(names)}
+		error_emitted = False
+		for line, row in enumerate(records):
+			if not error_emitted:
+				if len(row) != len(names):
+					error_emitted = True
+					warnings.warn(f'Column counts for header and content do not match ({len(names)} != {len(row)}) in {path}:{line+1}')
+			if names and self.compact_rows:
+				if len(row) < len(names):
+					raise IndexError(f'Row {line+1} of {path} has {len(row)} fields, {len(names)} expected')
+				yield Row(index, row)
+			elif names:
+				d = {}
+				for i in range(len(names)):
+					d[names[i]] = row[i]
+				yield d
+			else:
+				yield row
+
+	def parse(self, path, fs):
+		'''Yield the fields of each row of the CSV file (or `ByteRange`) at `path`, as lists.'''
+		if isinstance(path, ByteRange):
+			csvfile = fs.open(path.path, 'rb')
+			lines = byte_range_lines(csvfile, path.start, path.end, self.encoding)
+		else:
+			csvfile = open_input(fs, path, newline='')
+			lines = csvfile
+		with csvfile:
+			yield from csv.reader(lines)
+
+	def selected_rows(self, path, fs, column):
+		'''
+		Yield the fields of the rows of the CSV file (or `ByteRange`) at `path` whose
+		value in the column numbered `column` is in `record_ids`. If `index_path` is
+		set, only those rows are parsed, using a `RecordIndex` of the file (unless it
+		is compressed, as it could not then be read from an offset).
+		'''
+		ids = set(self.record_ids)
+		filename = path.path if isinstance(path, ByteRange) else path
+		if not self.index_path or compression_suffix(find_input(fs, filename)):
+			for row in self.parse(path, fs):
+				if len(row) > column and row[column] in ids:
+					yield row
+			return
+		index = RecordIndex(self.index_path).offsets(fs, filename, column, self.encoding)
+		offsets = sorted(offset for i in ids for offset in index.get(i, ()))
+		if isinstance(path, ByteRange):
+			offsets = [offset for offset in offsets if path.start <= offset < path.end]
+		with fs.open(filename, 'rb') as fh:
+			for offset in offsets:
+				yield from csv.reader(byte_range_lines(fh, offset, offset + 1, self.encoding))
 
 	def read(self, path, *, fs):
 		limit = self.limit
 		count = self.count
-		names = self.field_names
-		error_emitted = False
+		skip = self.skip_rows.pop(path, 0)
 		if not(limit) or (limit and count < limit):
 			if self.verbose:
 				sys.stderr.write('============================== %s\n' % (path,))
-			with fs.open(path, newline='') as csvfile:
-				r = csv.reader(csvfile)
-				for line, row in enumerate(r):
-					if not error_emitted:
-						if len(row) != len(names):
-							error_emitted = True
-							warnings.warn(f'Column counts for header and content do not match ({len(names)} != {len(row)}) in {path}:{line+1}')
-					if limit and count >= limit:
-						break
-					count += 1
-					if names:
-						d = {}
-						for i in range(len(names)):
-							d[names[i]] = row[i]
-						yield d
-					else:
-						yield row
+			if isinstance(path, ByteRange) or not isinstance(path, tuple):
+				rows = self.rows(path, fs)
+			elif self.processes > 1 and len(path) > 1:
+				rows = self.parallel_rows(path, fs)
+			else:
+				rows = (row for p in path for row in self.rows(p, fs))
+			for line, row in enumerate(rows):
+				if limit and count >= limit:
+					break
+				count += 1
+				if line < skip:
+					continue
+				yield row
+			rows.close()
 			self.count = count
 
 	__call__ = read
+
+	def parallel_rows(self, paths, fs):
+		'''
+		Yield the rows of the CSV files at `paths` in order, parsing them in
+		`processes` worker processes.
+
+		The workers hand back the fields of each row as lists, and the rows are made
+		here, so that the field index of the `Row`s is not pickled with each of them,
+		and is shared by all of the rows.
+		'''
+		ctx = multiprocessing.get_context('fork')
+		limit = self.limit
+		# the number of rows that may still be needed from the file being yielded and
+		# those after it (or -1 if there is no limit); the workers stop parsing a file
+		# once they have parsed this many of its rows
+		budget = ctx.Value('q', limit - self.count if limit else -1, lock=False)
+		queues = [ctx.Queue(self.queue_size) for _ in paths]
+		workers = []
+		for k in range(min(self.processes, len(paths))):
+			p = ctx.Process(target=self._parse_files, args=(paths, queues, k, fs, budget), daemon=True)
+			p.start()
+			workers.append(p)
+
+		def received(j, q):
+			# the worker parsing the file (which may be killed without reporting an error)
+			p = workers[j % self.processes]
+			read = 0
+			while True:
+				try:
+					batch = q.get(timeout=self.poll_interval)
+				except Empty:
+					if not p.is_alive() and q.empty():
+						raise RuntimeError(f'The worker process parsing {paths[j]} exited with status {p.exitcode}')
+					continue
+				if batch is None:
+					break
+				if isinstance(batch, Exception):
+					raise batch
+				yield from batch
+				read += len(batch)
+			if limit:
+				budget.value = max(budget.value - read, 0)
+
+		names = self.field_names
+		index = {name: i for i, name in enumerate(names)} if names and self.compact_rows else None
+		try:
+			for j, q in enumerate(queues):
+				yield from self.make_rows(paths[j], received(j, q), index)
+		finally:
+			for p in workers:
+				p.terminate()
+				p.join()
+
+	def _parse_files(self, paths, queues, k, fs, budget):
+		for j in range(k, len(paths), self.processes):
+			q = queues[j]
+			try:
+				batch = []
+				parsed = 0
+				for row in self.records(paths[j], fs):
+					if 0 <= budget.value <= parsed:
+						break
+					batch.append(row)
+					parsed += 1
+					if len(batch) >= self.batch_size:
+						q.put(batch)
+						batch = []
+				if batch:
+					q.put(batch)
+				q.put(None)
+			except Exception as e:
+				q.put(e)
+				return
+
@@ -34,6 +34,13 @@ def filename_for(data: dict):
 	fn = f'{uu}.json'
 	return fn, partition
 
+def partition_for(ident):
+	'''
+	Return the partition that `filename_for` assigns to a crom object with the
+	identifier `ident` (passed without a UUID or URI).
+	'''
+	return str(uuid.uuid3(uuid.NAMESPACE_URL, ident))[:2]
+
 class FileWriter(Configurable):
 	directory = Option(default="output")
 
@@ -148,3 +155,7 @@ class MergingFileWriter(Configurable):
 				if getsize(fn) == 0:
 					warnings.warn(f'*** Wrote empty file: {fn}')
 			return NOT_MODIFIED
+
+	def close(self):
+		'''Each object is written to its file as it is passed to the writer, so there is nothing to close.'''
+		pass
@@ -1,42 +1,58 @@
 import os
 import os.path
+import heapq
+import pickle
+import itertools
+import tempfile
+import multiprocessing
 import hashlib
 import uuid
 import pprint
 import traceback
 import warnings
 from collections import Counter, defaultdict, namedtuple
+from contextlib import suppress
 # import multiprocessing
 # from multiprocessing.pool import ThreadPool
 
-from pipeline.util import CromObjectMerger
+from pipeline.util import CromObjectMerger, CromPickler, CromUnpickler
 
 from bonobo.constants import NOT_MODIFIED
 from bonobo.config import Configurable, Option
 from pipeline.util import ExclusiveValue
 from cromulent import model, reader
 from cromulent.model import factory
-from .file import MergingFileWriter
+from .file import MergingFileWriter, partition_for
+from .segments import SegmentWriter
 from pipeline.linkedart import add_crom_data, get_crom_object
 
-class MergingMemoryWriter(Configurable):
-	directory = Option(default="output")
-	partition_directories = Option(default=False)
-	compact = Option(default=True, required=False)
-	model = Option(default=None, required=True)
-	limit = Option(default=None, required=False)
+class MergeStore:
+	'''
+	The objects of a model collected in memory by one or more `MergingMemoryWriter`s,
+	keyed by their identifiers. Objects with the same identifier are merged as they
+	are added, so that writers of a model sharing a store (rather than each holding
+	its own objects, merged only when they are written to disk) hold, merge and write
+	each object once.
 
-	def __init__(self, *args, **kwargs):
-		'''
-		Sets the __name__ property to include the relevant options so that when the
-		bonobo graph is serialized as a GraphViz document, different objects can be
-		visually differentiated.
-		'''
-		super().__init__(self, *args, **kwargs)
+	If `limit` is set, at most that many objects are held in memory: when it is
+	exceeded, the least recently added or merged half of the objects is written to a
+	run file (sorted by identifier) in a new directory in `spill_path` (or the system
+	temporary directory). `items` merges the runs and the objects still in memory.
+	'''
+	def __init__(self, model=None, limit=None, spill_path=None):
+		self.model = model
 		self.data = {}
 		self.counter = Counter()
 		self.merger = CromObjectMerger()
-		self.__name__ = f'{type(self).__name__} ({self.model})'
+		self.limit = limit
+		self.spill_path = spill_path
+		self.spill_directory = None
+		# the filenames of the run files, in the order they were written
+		self.runs = []
+		self.spilled = 0
+
+	def __len__(self):
+		return len(self.data)
 
 	def merge(self, model_object):
 		merger = self.merger
@@ -56,6 +72,156 @@ class MergingMemoryWriter(Configurable):
 			print(factory.toString(model_object, False))
 			raise
 
+	def add(self, model_object):
+		ident = model_object.id
+		self.counter['total'] += 1
+		if ident in self.data:
+			self.counter['collision'] += 1
+			m = self.merge(model_object)
+			if self.limit:
+				# move the object to the end of the (least recently used first) order
+				del self.data[ident]
+			self.data[ident] = m
+		else:
+			self.counter['non-collision'] += 1
+			self.data[ident] = model_object
+			if self.limit and len(self.data) > self.limit:
+				self.spill()
+
+	def spill(self):
+		'''Write the least recently added or merged half of the objects to a new run file.'''
+		if self.spill_directory is None:
+			if self.spill_path:
+				os.makedirs(self.spill_path, exist_ok=True)
+			self.spill_directory = tempfile.mkdtemp(prefix=f'{self.model}-', dir=self.spill_path or None)
+		keys = sorted(itertools.islice(self.data, max(len(self.data) // 2, 1)))
+		filename = os.path.join(self.spill_directory, f'run-{len(self.runs)}.pickle')
+		self.write_run(filename, ((k, self.data.pop(k)) for k in keys))
+		self.runs.append(filename)
+		self.spilled += len(keys)
+		self.counter['spilled'] += len(keys)
+
+	@staticmethod
+	def write_run(filename, items):
+		'''Write the `(identifier, object)` pairs in `items` to the run file `filename`.'''
+		with open(filename, 'wb') as fh:
+			shared = CromPickler.shared_table()
+			for item in items:
+				# each object is pickled separately, so the pickler memo does not keep them all in memory
+				CromPickler(fh, protocol=pickle.HIGHEST_PROTOCOL, shared=shared).dump(item)
+
+	@staticmethod
+	def read_run(filename):
+		with open(filename, 'rb') as fh:
+			shared = CromUnpickler.shared_table()
+			while True:
+				try:
+					yield CromUnpickler(fh, shared=shared).load()
+				except EOFError:
+					break
+
+	def items(self):
+		'''
+		Yield the `(identifier, object)` pairs of all of the objects of the store (in
+		the run files and in memory), sorted by identifier. The parts of an object
+		that were spilled to several runs are merged in the order they were added.
+		'''
+		in_memory = ((k, self.data[k]) for k in sorted(self.data))
+		if not self.runs:
+			yield from in_memory
+			return
+		streams = [self.read_run(filename) for filename in self.runs] + [in_memory]
+		merged = heapq.merge(*(_numbered(i, stream) for i, stream in enumerate(streams)))
+		for ident, parts in itertools.groupby(merged, key=lambda part: part[0]):
+			_, _, m = next(parts)
+			for _, _, model_object in parts:
+				try:
+					if m != model_object:
+						self.merger.merge(m, model_object)
+				except Exception as e:
+					print(f'Exception caught while merging data ({e}):')
+					print(factory.toString(m, False))
+					print(factory.toString(model_object, False))
+					raise
+			yield ident, m
+
+	def finish(self):
+		'''Called before the objects of the store are written (they are already merged and sorted as needed).'''
+		pass
+
+	def count(self):
+		'''Return the number of objects in the store (counting the parts of objects in several runs).'''
+		return len(self.data) + self.spilled
+
+	def clear(self):
+		'''Remove all of the objects of the store, and its run files.'''
+		self.data = {}
+		directories = {os.path.dirname(filename) for filename in self.runs}
+		for filename in self.runs:
+			with suppress(FileNotFoundError):
+				os.remove(filename)
+		for directory in directories:
+			with suppress(OSError):
+				os.rmdir(directory)
+		self.spill_directory = None
+		self.runs = []
+		self.spilled = 0
+
+def _numbered(i, stream):
+	# the stream number orders the parts of an object with the same identifier
+	for ident, model_object in stream:
+		yield ident, i, model_object
+
+class MergingMemoryWriter(Configurable):
+	'''
+	Collect the objects passed to this node in memory (merging objects with the same
+	identifier), and write them to disk with a `MergingFileWriter` when `flush` is
+	called.
+
+	The objects are kept in `store`, which may be a `MergeStore` shared by all of the
+	writers of the model (or a `RunStore`, which keeps them on disk and merges them
+	with an external sort); otherwise the writer has its own, holding at most `limit`
+	objects in memory (if set) and spilling the others to disk. If `flush_processes`
+	is greater than 1, the objects are serialized and written by that many processes.
+
+	If `output_format` is 'segments', the objects are written to JSON lines segments
+	with a `SegmentWriter`, rather than to one file each.
+	'''
+	directory = Option(default="output")
+	partition_directories = Option(default=False)
+	compact = Option(default=True, required=False)
+	model = Option(default=None, required=True)
+	limit = Option(default=None, required=False)
+	store = Option(default=None, required=False)
+	flush_processes = Option(int, default=1)
+	output_format = Option(str, default='files')
+
+	def __init__(self, *args, **kwargs):
+		'''
+		Sets the __name__ property to include the relevant options so that when the
+		bonobo graph is serialized as a GraphViz document, different objects can be
+		visually differentiated.
+		'''
+		super().__init__(self, *args, **kwargs)
+		if self.store is None:
+			self.store = MergeStore(self.model, limit=self.limit)
+		self.__name__ = f'{type(self).__name__} ({self.model})'
+
+	@property
+	def data(self):
+		return self.store.data
+
+	@data.setter
+	def data(self, data):
+		self.store.data = data
+
+	@property
+	def counter(self):
+		return self.store.counter
+
+	def merge(self, model_object):
+		return self.store.merge(model_object)
+
 	def __call__(self, data: dict):
 		# import pdb; pdb.set_trace()
 		# check what is going on with LOD_OBJECT
@@ -64,27 +230,31 @@ class MergingMemoryWriter(Configurable):
 			# 	f.write(str(data))
 			# 	f.write('\n')
 		
-			model_object = data['_LOD_OBJECT']
-			ident = model_object.id
-			self.counter['total'] += 1
-			if ident in self.data:
-				self.counter['collision'] += 1
-				self.data[ident] = self.merge(model_object)
-			else:
-				self.counter['non-collision'] += 1
-				self.data[ident] = model_object
-
-			if self.limit is not None and len(self.data) >= self.limit:
-				self.flush(verbose=False)
+			self.store.add(data['_LOD_OBJECT'])
 
 		return None
 
 	def flush(self, verbose=True):
-		writer = MergingFileWriter(directory=self.directory, partition_directories=self.partition_directories, compact=self.compact, model=self.model)
-		count = len(self.data)
+		writer = self.file_writer()
+		# done before any worker processes are forked
+		self.store.finish()
+		count = self.store.count()
+		if self.flush_processes > 1 and count > 1:
+			self.parallel_flush(writer, count, verbose=verbose)
+		else:
+			self.write_objects(writer, (o for _, o in self.store.items()), count, verbose=verbose)
+		if verbose:
+			warnings.warn(f'MergingMemoryWriter flush for model {self.model} with {count} items')
+		self.store.clear()
+
+	def file_writer(self):
+		if self.output_format == 'segments':
+			return SegmentWriter(directory=self.directory, model=self.model)
+		return MergingFileWriter(directory=self.directory, partition_directories=self.partition_directories, compact=self.compact, model=self.model)
+
+	def write_objects(self, writer, objects, count, verbose=True):
 		skip = max(int(count / 100), 1)
-		for i, k in enumerate(sorted(self.data)):
-			o = self.data[k]
+		for i, o in enumerate(objects):
 			if (i % skip) == 0:
 				pct = 100.0 * float(i) / float(count)
 				if verbose:
@@ -95,6 +265,57 @@ class MergingMemoryWriter(Configurable):
 			except:
 				traceback.print_exc()
 				continue
+		writer.close()
+
+	def partition_buckets(self, n):
+		'''
+		Divide the objects of the store between `n` workers by the output partitions
+		(the first two characters of the output filenames) they are written to, and
+		return a function that yields the objects of the worker `w`.
+
+		If the store has no runs on disk, the identifiers of the objects in memory
+		are divided, so that each worker touches only its own objects. Otherwise the
+		runs are merged once, here, and the merged objects are written to a run file
+		for each worker.
+		'''
+		store = self.store
+		runs = store.runs
+		if not runs:
+			keys = [[] for _ in range(n)]
+			for k in store.data:
+				keys[int(partition_for(k), 16) % n].append(k)
+			return lambda w: (store.data[k] for k in keys[w])
+		directory = os.path.dirname(runs[0])
+		filenames = [os.path.join(directory, f'flush-{w}.pickle') for w in range(n)]
+		files = [open(filename, 'wb') for filename in filenames]
+		try:
+			shared = CromPickler.shared_table()
+			for k, o in store.items():
+				fh = files[int(partition_for(k), 16) % n]
+				CromPickler(fh, protocol=pickle.HIGHEST_PROTOCOL, shared=shared).dump((k, o))
+		finally:
+			for fh in files:
+				fh.close()
+		# the bucket files are removed by `clear`, with the runs
+		runs.extend(filenames)
+		return lambda w: (o for _, o in MergeStore.read_run(filenames[w]))
+
+	def parallel_flush(self, writer, count, verbose=True):
+		'''
+		Write the objects in `flush_processes` forked worker processes. Each worker
+		writes all of the objects of a disjoint set of partitions, so no two workers
+		write (or merge with) the same file.
+		'''
+		n = self.flush_processes
 		if verbose:
-			warnings.warn(f'MergingMemoryWriter flush for model {self.model} with {len(self.data)} items')
-		self.data = {}
+			print('writing %d objects for model %s in %d processes' % (count, self.model, n))
+		objects = self.partition_buckets(n)
+		ctx = multiprocessing.get_context('fork')
+		workers = [ctx.Process(target=self.write_objects, args=(writer, objects(w), count, False)) for w in range(n)]
+		for p in workers:
+			p.start()
+		for p in workers:
+			p.join()
+		for w, p in enumerate(workers):
+			if p.exitcode != 0:
+				raise RuntimeError(f'Flush worker {w} for model {self.model} exited with status {p.exitcode}')
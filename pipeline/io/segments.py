@@ -0,0 +1,231 @@
+'''
+Output of the objects of each model as large append-only segments of JSON lines,
+instead of one JSON file for each object.
+'''
+
+import os
+import os.path
+import time
+import marshal
+import warnings
+
+from bonobo.constants import NOT_MODIFIED
+from bonobo.config import Configurable, Option
+from cromulent import model, reader
+from cromulent.model import factory
+
+from pipeline.util import CromObjectMerger, ExclusiveValue
+from .file import filename_for
+
+def merge_contents(contents):
+	'''
+	Return the compact JSON serialization (as `bytes`) of the object made by merging
+	the objects serialized in `contents`, in order.
+	'''
+	merger = CromObjectMerger()
+	m = None
+	for content in contents:
+		r = reader.Reader(validate_profile=False, validate_props=False)
+		model_object = r.read(content.decode('utf-8'))
+		if m is None:
+			m = model_object
+		elif m != model_object:
+			merger.merge(m, model_object)
+	return factory.toString(m, True).encode('utf-8')
+
+class SegmentIndex:
+	'''
+	The segments written by `SegmentWriter`s to the directory `path` (the output
+	directory of a model).
+
+	Each segment `<name>.jsonl` holds the compact JSON serializations of objects,
+	one per line, and has an index `<name>.index` holding a `marshal`led `dict`
+	mapping the output filename of each object (`<uuid>.json`) to the offset and
+	length of its line. The index of a segment is written when the segment is
+	closed, so segments without an index (left by an interrupted run) are ignored.
+	Segments are named so that they sort in the order they were written. An object
+	written again is usually merged with the earlier version, but writers only see
+	the segments that were closed before they started, so all of the versions of an
+	object are merged when it is read with `items`.
+	'''
+	SEGMENT = '.jsonl'
+	INDEX = '.index'
+
+	def __init__(self, path):
+		self.path = path
+
+	def segments(self):
+		'''Return the names of the complete segments, in the order they were written.'''
+		with os.scandir(self.path) as entries:
+			names = [e.name[:-len(self.INDEX)] for e in entries if e.name.endswith(self.INDEX)]
+		return sorted(names)
+
+	def versions(self):
+		'''
+		Return a `dict` mapping the output filename of each object to the list of the
+		`(segment, offset, length)` of each of its versions, in the order they were
+		written.
+		'''
+		versions = {}
+		for name in self.segments():
+			with open(os.path.join(self.path, name + self.INDEX), 'rb') as fh:
+				for filename, (offset, length) in marshal.load(fh).items():
+					versions.setdefault(filename, []).append((name, offset, length))
+		return versions
+
+	def entries(self):
+		'''Return a `dict` mapping the output filename of each object to the `(segment, offset, length)` of its last version.'''
+		return {filename: versions[-1] for filename, versions in self.versions().items()}
+
+	def read(self, entry):
+		'''Return the JSON serialization (as `bytes`) of the object at `entry`.'''
+		name, offset, length = entry
+		with open(os.path.join(self.path, name + self.SEGMENT), 'rb') as fh:
+			fh.seek(offset)
+			return fh.read(length)
+
+	def items(self):
+		'''
+		Yield the `(filename, content)` pairs of each object, reading each segment
+		sequentially. The versions of an object written more than once are merged.
+		'''
+		by_segment = {}
+		merged = []
+		for filename, versions in self.versions().items():
+			if len(versions) > 1:
+				merged.append((filename, versions))
+				continue
+			name, offset, length = versions[0]
+			by_segment.setdefault(name, []).append((offset, length, filename))
+		for name in sorted(by_segment):
+			with open(os.path.join(self.path, name + self.SEGMENT), 'rb') as fh:
+				for offset, length, filename in sorted(by_segment[name]):
+					fh.seek(offset)
+					yield filename, fh.read(length)
+		for filename, versions in merged:
+			yield filename, merge_contents([self.read(entry) for entry in versions])
+
+	def export(self, directory, partition_directories=True):
+		'''
+		Write each object to its own file in `directory` (in a subdirectory for its
+		partition, if `partition_directories` is true), in the layout written by
+		`MergingFileWriter`. As with `MergingFileWriter`, an object whose file already
+		exists is merged with it. Returns the number of files written.
+		'''
+		count = 0
+		for filename, content in self.items():
+			dr = os.path.join(directory, filename[:2]) if partition_directories else directory
+			os.makedirs(dr, exist_ok=True)
+			fn = os.path.join(dr, filename)
+			if os.path.exists(fn) and os.path.getsize(fn):
+				with open(fn, 'rb') as fh:
+					existing = fh.read()
+				content = merge_contents([existing, content])
+			with open(fn, 'wb') as fh:
+				fh.write(content)
+			count += 1
+		return count
+
+class SegmentWriter(Configurable):
+	'''
+	Append the compact JSON serialization of each object passed to this node to a
+	segment in the directory of its model, in the format read by `SegmentIndex`.
+	Segments are closed (and their indexes written) when they reach `segment_size`
+	bytes, and when `close` (or `flush`) is called.
+
+	As with `MergingFileWriter`, an object whose filename was already written is
+	merged with the version on disk, and the merged object is appended (superseding
+	the earlier version in the index).
+	'''
+	directory = Option(default="output")
+	model = Option(default=None, required=True)
+	segment_size = Option(int, default=256 * 1024 * 1024)
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(self, *args, **kwargs)
+		self.merger = CromObjectMerger()
+		self.__name__ = f'{type(self).__name__} ({self.model})'
+
+		self.dr = os.path.join(self.directory, self.model)
+		with ExclusiveValue(self.dr):
+			if not os.path.exists(self.dr):
+				os.mkdir(self.dr)
+		self.index = SegmentIndex(self.dr)
+		# loaded when the first object is written (which may be in a forked worker process)
+		self._entries = None
+		self.fh = None
+		self.segment = None
+		self.segment_entries = {}
+
+	@property
+	def entries(self):
+		if self._entries is None:
+			self._entries = self.index.entries()
+		return self._entries
+
+	def merge(self, model_object, content):
+		r = reader.Reader(validate_profile=False, validate_props=False)
+		try:
+			m = r.read(content.decode('utf-8'))
+			if m == model_object:
+				return None
+			else:
+				self.merger.merge(m, model_object)
+				return m
+		except model.DataError as e:
+			print(f'Exception caught while merging data from segment {self.dr} ({str(e)}):')
+			print(factory.toString(model_object, False))
+			print(content)
+			raise
+
+	def __call__(self, data: dict):
+		filename, _ = filename_for(data)
+		factory = data['_CROM_FACTORY']
+		model_object = data['_LOD_OBJECT']
+
+		entry = self.entries.get(filename)
+		if entry:
+			if self.fh and entry[0] == self.segment:
+				self.fh.flush()
+			m = self.merge(model_object, self.index.read(entry))
+			if m is None:
+				return NOT_MODIFIED
+			model_object = m
+		# lines must not contain newlines, so the serialization is always compact
+		self.append(filename, factory.toString(model_object, True).encode('utf-8'))
+		return NOT_MODIFIED
+
+	def append(self, filename, content):
+		if not content:
+			warnings.warn(f'*** Writing empty content for {filename} to segment in {self.dr}')
+		if self.fh is None:
+			# the time orders the segments; the process id keeps concurrent writers apart
+			self.segment = f'{time.time_ns():020d}-{os.getpid()}'
+			self.fh = open(os.path.join(self.dr, self.segment + SegmentIndex.SEGMENT), 'wb')
+		offset = self.fh.tell()
+		self.fh.write(content)
+		self.fh.write(b'\n')
+		self.segment_entries[filename] = (offset, len(content))
+		self.entries[filename] = (self.segment, offset, len(content))
+		if self.fh.tell() >= self.segment_size:
+			self.close()
+
+	def flush(self, verbose=True):
+		'''Close the segment being written (when the pipeline flushes its writers).'''
+		self.close()
+
+	def close(self):
+		'''Close the segment being written, and write its index.'''
+		# reloaded when the next object is written, to see the segments of other writers
+		self._entries = None
+		if self.fh is None:
+			return
+		self.fh.close()
+		self.fh = None
+		filename = os.path.join(self.dr, self.segment + SegmentIndex.INDEX)
+		tmp = f'{filename}.tmp'
+		with open(tmp, 'wb') as fh:
+			marshal.dump(self.segment_entries, fh)
+		os.replace(tmp, filename)
+		self.segment = None
+		self.segment_entries = {}
@@ -0,0 +1,181 @@
+'''
+An external merge sort of the objects of a model, for runs whose output does not
+fit in memory.
+'''
+
+import io
+import os
+import heapq
+import pickle
+import struct
+import marshal
+import tempfile
+import itertools
+from operator import itemgetter
+from collections import Counter
+from contextlib import suppress
+
+from cromulent.model import factory
+from pipeline.util import CromObjectMerger, CromPickler, CromUnpickler
+
+class RunStore:
+	'''
+	A store for `MergingMemoryWriter`s (used in place of a `MergeStore`) that keeps
+	none of the objects of a model in memory. Each object added is pickled and
+	appended, tagged with its identifier, to an unsorted run file of up to
+	`run_size` objects in a new directory in `path` (or the system temporary
+	directory).
+
+	When the objects are written, each run is sorted by identifier, and the sorted
+	runs are merged, so that the parts of each object are read one after another
+	and the object is merged and written once, with sequential I/O instead of
+	reading, merging and rewriting its output file for each part.
+
+	A run file holds a sequence of `marshal`led `(identifier, pickled object)`
+	pairs, each preceded by its length.
+	'''
+	LENGTH = struct.Struct('<Q')
+	UNSORTED = '.unsorted'
+	SORTED = '.sorted'
+
+	def __init__(self, model=None, path=None, run_size=10000):
+		self.model = model
+		self.path = path
+		self.run_size = run_size
+		# nothing is held in memory, but writers and checkpoints expect a `data` dict
+		self.data = {}
+		self.counter = Counter()
+		self.merger = CromObjectMerger()
+		self.directory = None
+		self.shared = None
+		self.fh = None
+		self.run_count = 0
+		self._runs = []
+		self.spilled = 0
+
+	def __len__(self):
+		return len(self.data)
+
+	@property
+	def runs(self):
+		'''
+		The filenames of the run files. The run being written is closed (objects added
+		later go to a new run), so that the files listed (e.g. by a checkpoint) are not
+		changed afterwards.
+		'''
+		self.close_run()
+		return self._runs
+
+	@runs.setter
+	def runs(self, runs):
+		self.close_run()
+		self._runs = list(runs)
+
+	def add(self, model_object):
+		self.counter['total'] += 1
+		if self.fh is None:
+			self.open_run()
+		if self.shared is None:
+			self.shared = CromPickler.shared_table()
+		blob = io.BytesIO()
+		CromPickler(blob, protocol=pickle.HIGHEST_PROTOCOL, shared=self.shared).dump(model_object)
+		self.write_record(self.fh, (model_object.id, blob.getvalue()))
+		self.run_count += 1
+		self.spilled += 1
+		self.counter['spilled'] += 1
+		if self.run_count >= self.run_size:
+			self.close_run()
+
+	def open_run(self):
+		if self.directory is None:
+			if self.path:
+				os.makedirs(self.path, exist_ok=True)
+			self.directory = tempfile.mkdtemp(prefix=f'{self.model}-', dir=self.path or None)
+		filename = os.path.join(self.directory, f'run-{len(self._runs)}{self.UNSORTED}')
+		self.fh = open(filename, 'wb')
+		self.run_count = 0
+		self._runs.append(filename)
+
+	def close_run(self):
+		if self.fh:
+			self.fh.close()
+			self.fh = None
+
+	@classmethod
+	def write_record(cls, fh, record):
+		data = marshal.dumps(record)
+		fh.write(cls.LENGTH.pack(len(data)))
+		fh.write(data)
+
+	@classmethod
+	def read_run(cls, filename):
+		with open(filename, 'rb') as fh:
+			while True:
+				header = fh.read(cls.LENGTH.size)
+				if not header:
+					break
+				length, = cls.LENGTH.unpack(header)
+				yield marshal.loads(fh.read(length))
+
+	def sort_run(self, filename):
+		'''Replace the unsorted run file `filename` with a sorted one, returning its filename.'''
+		# the sort is stable, keeping the parts of an object in the order they were added
+		records = sorted(self.read_run(filename), key=itemgetter(0))
+		sorted_filename = filename[:-len(self.UNSORTED)] + self.SORTED
+		tmp = sorted_filename + '.tmp'
+		with open(tmp, 'wb') as fh:
+			for record in records:
+				self.write_record(fh, record)
+		os.replace(tmp, sorted_filename)
+		os.remove(filename)
+		return sorted_filename
+
+	def finish(self):
+		'''Sort the run files, before the objects of the store are written.'''
+		self.close_run()
+		self._runs = [self.sort_run(f) if f.endswith(self.UNSORTED) else f for f in self._runs]
+
+	def items(self):
+		'''
+		Yield the `(identifier, object)` pairs of all of the objects of the store,
+		sorted by identifier, merging the parts of each object in the order they were
+		added.
+		'''
+		self.finish()
+		shared = CromUnpickler.shared_table()
+		# `heapq.merge` is stable, so the parts of an object are read in the order of the runs
+		merged = heapq.merge(*(self.read_run(f) for f in self._runs), key=itemgetter(0))
+		for ident, parts in itertools.groupby(merged, key=itemgetter(0)):
+			m = None
+			for _, blob in parts:
+				model_object = CromUnpickler(io.BytesIO(blob), shared=shared).load()
+				if m is None:
+					m = model_object
+					continue
+				try:
+					if m != model_object:
+						self.merger.merge(m, model_object)
+				except Exception as e:
+					print(f'Exception caught while merging data ({e}):')
+					print(factory.toString(m, False))
+					print(factory.toString(model_object, False))
+					raise
+			yield ident, m
+
+	def count(self):
+		'''Return the number of objects added to the store (counting each part of an object).'''
+		return self.spilled
+
+	def clear(self):
+		'''Remove all of the objects of the store, and its run files.'''
+		self.close_run()
+		directories = {os.path.dirname(filename) for filename in self._runs}
+		for filename in self._runs:
+			with suppress(FileNotFoundError):
+				os.remove(filename)
+		for directory in directories:
+			with suppress(OSError):
+				os.rmdir(directory)
+		self.directory = None
+		self._runs = []
+		self.spilled = 0
@@ -1,3 +1,4 @@
+import re
 import sys
 import lxml.etree
 
@@ -5,6 +6,119 @@ from bonobo.constants import NOT_MODIFIED
 from bonobo.nodes.io.file import FileReader
 from bonobo.config import Configurable, Option, Service
 
+from pipeline.io.compression import open_input
+
+SIMPLE_PATH = re.compile(r'^(/[A-Za-z_][\w.-]*)+$')
+
+def iterparse_xpath(file, xpath, encoding=None):
+	'''
+	Yield the elements of the XML document in the binary `file` matching the
+	absolute `xpath` (which must be a simple path of element names, such as
+	'/AATA_XML/record'), as soon as each element has been parsed.
+
+	Each element is removed from the document when the next matching element is
+	found, so that the memory used does not grow with the size of the document;
+	an element is only part of the document while it is being processed.
+	'''
+	path = xpath.split('/')[1:]
+	tag = path[-1]
+	ancestors = list(reversed(path[:-1]))
+	previous = None
+	for _, e in lxml.etree.iterparse(file, events=('end',), tag=tag, encoding=encoding):
+		parent = e.getparent()
+		a = parent
+		matches = True
+		for name in ancestors:
+			if a is None or a.tag != name:
+				matches = False
+				break
+			a = a.getparent()
+		if not matches or a is not None:
+			# a descendant of a matching element, which is kept as part of it
+			continue
+		if previous is not None:
+			previous.getparent().remove(previous)
+		yield e
+		previous = e
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+def _qualified_name(name, e):
+	'''
+	Return the lxml tag or attribute `name` of the element `e` with the namespace
+	prefix used in the document (e.g. 'xml:lang'), instead of the namespace URI.
+	'''
+	if name[0] != '{':
+		return name
+	uri, local = name[1:].split('}', 1)
+	if uri == XML_NAMESPACE:
+		return f'xml:{local}'
+	for prefix, u in e.nsmap.items():
+		if u == uri and prefix:
+			return f'{prefix}:{local}'
+	return local
+
+def xml_element_value(e, inherited=None):
+	'''
+	Return the content of the lxml element `e` in the structure produced by
+	`xmltodict.parse` (with its default options) for the serialized element: a
+	`dict` with '@'-prefixed keys for the attributes (including the namespace
+	declarations, which for `e` itself are all of those in scope), a key for each
+	child element (whose value is a list if the child element is repeated), and a
+	'#text' key for any text; or, for an element with no attributes or child
+	elements, its text (or `None`).
+
+	`inherited` is the namespace map of the parent of the element being converted,
+	whose declarations are not repeated.
+	'''
+	item = None
+	nsmap = e.nsmap
+	if inherited is None:
+		inherited = {}
+	if nsmap != inherited:
+		item = {}
+		for prefix, uri in nsmap.items():
+			if inherited.get(prefix) != uri:
+				item['@xmlns:' + prefix if prefix else '@xmlns'] = uri
+	if e.attrib:
+		if item is None:
+			item = {}
+		for k, v in e.attrib.items():
+			item['@' + _qualified_name(k, e)] = v
+	data = [e.text] if e.text else []
+	for child in e:
+		if child.tail:
+			data.append(child.tail)
+		if not isinstance(child.tag, str):
+			# comments and processing instructions
+			continue
+		if item is None:
+			item = {}
+		key = _qualified_name(child.tag, child)
+		value = xml_element_value(child, nsmap)
+		if key in item:
+			existing = item[key]
+			if isinstance(existing, list):
+				existing.append(value)
+			else:
+				item[key] = [existing, value]
+		else:
+			item[key] = value
+	text = ''.join(data).strip() or None
+	if item is None:
+		return text
+	if text:
+		item['#text'] = text
+	return item
+
+def xml_element_to_dict(e):
+	'''
+	Return the lxml element `e` as a `dict`, in the same structure as
+	`json.loads(json.dumps(xmltodict.parse(lxml.etree.tostring(e))))`, but without
+	serializing and re-parsing the element.
+	'''
+	return {_qualified_name(e.tag, e): xml_element_value(e)}
+
 class XMLReader(FileReader):
 	'''
 	A FileReader that parses an XML file and yields lxml.etree Element objects matching
@@ -48,26 +162,39 @@ class CurriedXMLReader(Configurable):
 		bool,
 		default=False
 	)
+	stream = Option(
+		bool,
+		default=True,
+		__doc__='''Yield the matching elements while the file is being parsed, if the XPath expression is a simple path of element names.''',
+	)
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.count = 0
 
+	def elements(self, path, fs):
+		if self.stream and SIMPLE_PATH.match(self.xpath):
+			with open_input(fs, path, 'rb') as file:
+				yield from iterparse_xpath(file, self.xpath, encoding=self.encoding)
+		else:
+			with open_input(fs, path, self.mode, encoding=self.encoding) as file:
+				root = lxml.etree.parse(file)
+			yield from root.xpath(self.xpath)
+
 	def read(self, path, *, fs):
 		limit = self.limit
 		count = self.count
 		if not(limit) or (limit and count < limit):
 			if self.verbose:
 				sys.stderr.write('============================== %s\n' % (path,))
-			file = fs.open(path, self.mode, encoding=self.encoding)
-			root = lxml.etree.parse(file)
-			for e in root.xpath(self.xpath):
+			elements = self.elements(path, fs)
+			for e in elements:
 				if limit and count >= limit:
 					break
 				count += 1
 				yield e
 			self.count = count
-			file.close()
+			elements.close()
 
 	__call__ = read
 
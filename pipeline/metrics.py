@@ -0,0 +1,365 @@
+'''
+Per-node metrics collected by the custom graph executors in `pipeline.execution`,
+and their export as JSON lines and in the Prometheus text exposition format.
+'''
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import types
+import cProfile
+import tracemalloc
+from collections import Counter
+
+class LatencyHistogram:
+	'''
+	A histogram of call latencies (in seconds), using logarithmic buckets so that
+	percentiles can be estimated (to within about 10%) in constant memory however many
+	calls are recorded.
+	'''
+	__slots__ = ('buckets', 'count', 'total')
+	BASE = 2 ** 0.25
+	MIN_LATENCY = 1e-7
+
+	def __init__(self):
+		self.buckets = Counter()
+		self.count = 0
+		self.total = 0.0
+
+	def add(self, elapsed):
+		self.count += 1
+		self.total += elapsed
+		self.buckets[self.bucket(elapsed)] += 1
+
+	def merge(self, other):
+		self.count += other.count
+		self.total += other.total
+		self.buckets.update(other.buckets)
+		return self
+
+	@classmethod
+	def bucket(cls, elapsed):
+		if elapsed <= cls.MIN_LATENCY:
+			return 0
+		return int(math.ceil(math.log(elapsed / cls.MIN_LATENCY, cls.BASE)))
+
+	@classmethod
+	def upper_bound(cls, bucket):
+		return cls.MIN_LATENCY * cls.BASE ** bucket
+
+	def percentile(self, q):
+		'''Return the upper bound of the bucket containing the `q`-th percentile (0-100).'''
+		if not self.count:
+			return 0.0
+		rank = max(1, int(math.ceil(self.count * q / 100.0)))
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				return self.upper_bound(bucket)
+		return self.upper_bound(max(self.buckets))
+
+class MetricsWriter:
+	'''
+	Write snapshots of node metrics (as returned by `GraphExecutor.metrics()`) to
+	`pipeline.metrics.jsonl` (appending one JSON object per node and snapshot) and
+	`pipeline.metrics.prom` (replaced by the latest snapshot) in `path`.
+
+	`pipeline.metrics.jsonl` is truncated when the first writer for it is made in a
+	process (when a run starts), so that it holds the snapshots of one run; the
+	writers of the later graphs of the run append to it.
+
+	If `path` does not exist, nothing is written.
+	'''
+	PERCENTILES = (50, 95, 99)
+	# the metrics files truncated by this process
+	started = set()
+
+	def __init__(self, path):
+		self.path = path
+		self.enabled = bool(path) and os.path.isdir(path)
+		if self.enabled:
+			self.jsonl_path = os.path.join(path, 'pipeline.metrics.jsonl')
+			self.prometheus_path = os.path.join(path, 'pipeline.metrics.prom')
+			if self.jsonl_path not in self.started:
+				self.started.add(self.jsonl_path)
+				open(self.jsonl_path, 'w').close()
+
+	def write(self, metrics, elapsed, final=False):
+		if not self.enabled:
+			return
+		with open(self.jsonl_path, 'a') as fh:
+			for m in metrics:
+				print(json.dumps(self.json_record(m, elapsed, final), sort_keys=True), file=fh)
+		tmp = self.prometheus_path + '.tmp'
+		with open(tmp, 'w') as fh:
+			fh.write(self.prometheus_text(metrics, elapsed))
+		os.replace(tmp, self.prometheus_path)
+
+	def json_record(self, m, elapsed, final=False):
+		h = m['latency']
+		data = {k: v for k, v in m.items() if k != 'latency'}
+		data['elapsed'] = elapsed
+		data['final'] = final
+		for q in self.PERCENTILES:
+			data[f'p{q}'] = h.percentile(q)
+		return data
+
+	def prometheus_text(self, metrics, elapsed):
+		lines = []
+		def metric(name, kind, help, values):
+			lines.append(f'# HELP pipeline_{name} {help}')
+			lines.append(f'# TYPE pipeline_{name} {kind}')
+			for labels, value in values:
+				label = ','.join(f'{k}="{self.escape(v)}"' for k, v in labels)
+				lines.append(f'pipeline_{name}{{{label}}} {value!r}')
+
+		def labels(m, **extra):
+			return [('node', m['name']), ('index', m['index'])] + list(extra.items())
+
+		lines.append('# HELP pipeline_elapsed_seconds Time since the pipeline executor started')
+		lines.append('# TYPE pipeline_elapsed_seconds gauge')
+		lines.append(f'pipeline_elapsed_seconds {float(elapsed)!r}')
+		metric('node_calls_total', 'counter', 'Number of calls of the node', [(labels(m), m['calls']) for m in metrics])
+		metric('node_in_total', 'counter', 'Number of values passed to the node', [(labels(m), m['in']) for m in metrics])
+		metric('node_out_total', 'counter', 'Number of values produced by the node', [(labels(m), m['out']) for m in metrics])
+		metric('node_self_seconds_total', 'counter', 'Time spent in the node itself', [(labels(m), m['self_time']) for m in metrics])
+		metric('node_inclusive_seconds_total', 'counter', 'Time spent in the node and in the nodes processing its output', [(labels(m), m['inclusive_time']) for m in metrics])
+		latency = []
+		for m in metrics:
+			h = m['latency']
+			for q in self.PERCENTILES:
+				latency.append((labels(m, quantile=str(q / 100.0)), h.percentile(q)))
+		metric('node_latency_seconds', 'summary', 'Latency of calls of the node', latency)
+		for m in metrics:
+			h = m['latency']
+			label = ','.join(f'{k}="{self.escape(v)}"' for k, v in labels(m))
+			lines.append(f'pipeline_node_latency_seconds_sum{{{label}}} {h.total!r}')
+			lines.append(f'pipeline_node_latency_seconds_count{{{label}}} {h.count!r}')
+		return '\n'.join(lines) + '\n'
+
+	@staticmethod
+	def escape(value):
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class NodeProfiler:
+	'''
+	Profile a sample of the calls of selected graph nodes with `cProfile`, keeping a
+	separate profile for each node, so that the time spent inside a node can be
+	inspected without profiling (and slowing down) the whole pipeline.
+
+	`nodes` is a collection of node names (as reported in `pipeline.counters`), or
+	contains `'*'` to profile every node. A fraction `sample_rate` of the calls of each
+	node are profiled, spread evenly over the run. Profiles are written as
+	`{index}-{name}{suffix}.prof` files in `path` by `write()`.
+	'''
+	def __init__(self, nodes, path, sample_rate=0.01, suffix=''):
+		self.nodes = set(nodes)
+		self.path = path
+		self.sample_rate = sample_rate
+		self.suffix = suffix
+		self.calls = Counter()
+		self.profiles = {}
+		self.names = {}
+		self.active = {}
+		self.current = None
+
+	@classmethod
+	def parse_nodes(cls, value):
+		return [n.strip() for n in value.split(',') if n.strip()]
+
+	def wants(self, name):
+		return '*' in self.nodes or name in self.nodes
+
+	def start(self, key):
+		'''
+		Record a call of the node identified by the timer `key` (a tuple of the node
+		index, level, and name), and return `True` if the call should be profiled.
+		'''
+		i, _, name = key
+		if not self.wants(name):
+			return False
+		n = self.calls[i]
+		self.calls[i] += 1
+		if int((n + 1) * self.sample_rate) == int(n * self.sample_rate):
+			return False
+		if i not in self.profiles:
+			self.profiles[i] = cProfile.Profile()
+			self.names[i] = name
+		self.active[key] = self.profiles[i]
+		return True
+
+	def stop(self, key):
+		profile = self.active.pop(key, None)
+		if profile is not None and profile is self.current:
+			profile.disable()
+			self.current = None
+
+	def switch(self, key):
+		'''Profile only while the node identified by `key` (if it is being sampled) is running.'''
+		profile = self.active.get(key)
+		if profile is self.current:
+			return
+		if self.current is not None:
+			self.current.disable()
+		if profile is not None:
+			profile.enable()
+		self.current = profile
+
+	def filename(self, i):
+		name = re.sub(r'[^\w.-]+', '_', self.names[i]).strip('_')
+		return os.path.join(self.path, f'{i}-{name}{self.suffix}.prof')
+
+	def write(self):
+		if not self.profiles:
+			return []
+		os.makedirs(self.path, exist_ok=True)
+		files = []
+		for i, profile in sorted(self.profiles.items()):
+			filename = self.filename(i)
+			profile.dump_stats(filename)
+			files.append(filename)
+		return files
+
+def approximate_size(obj, seen):
+	'''
+	Return the approximate number of bytes used by `obj` and the objects it refers
+	to (through attributes and containers), skipping objects whose `id` is in `seen`
+	(which is updated with the objects visited).
+	'''
+	size = 0
+	stack = [obj]
+	while stack:
+		o = stack.pop()
+		if id(o) in seen or isinstance(o, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+			continue
+		seen.add(id(o))
+		size += sys.getsizeof(o)
+		if isinstance(o, dict):
+			stack.extend(o.keys())
+			stack.extend(o.values())
+		elif isinstance(o, (list, tuple, set, frozenset)):
+			stack.extend(o)
+		elif hasattr(o, '__dict__'):
+			stack.append(o.__dict__)
+	return size
+
+class MemoryTracker:
+	'''
+	Track memory use of a pipeline run with `tracemalloc`.
+
+	While an executor runs a node, the growth in traced memory is attributed to the
+	node (by name, so that the growth of a node is accumulated over all the graphs
+	of a pipeline). `report()` writes (as `memory.{n}.json` in `path`) the growth per
+	node, the allocation sites that have grown the most since the previous report,
+	and the number and approximate size of the objects held by each writer. While
+	a graph runs, a report (without writers) is also written every `interval`
+	seconds (unless `interval` is 0).
+	'''
+	SAMPLE_SIZE = 100
+
+	def __init__(self, path, interval=60.0, top=25, frames=1):
+		self.path = path
+		self.interval = interval
+		self.top = top
+		if not tracemalloc.is_tracing():
+			tracemalloc.start(frames)
+		self.start_time = time.time()
+		self.next_snapshot_time = self.start_time + interval
+		self.growth = Counter()
+		self.current = None
+		self.last_size = tracemalloc.get_traced_memory()[0]
+		self.reported_snapshot = None
+		self.reports = 0
+
+	def switch(self, key):
+		'''Attribute memory growth to the node identified by the timer `key` (or to no node if `None`).'''
+		self.account()
+		self.current = key[2] if key is not None else None
+
+	def account(self):
+		size = tracemalloc.get_traced_memory()[0]
+		if self.current is not None:
+			self.growth[self.current] += size - self.last_size
+		self.last_size = size
+
+	def tick(self):
+		if not self.interval:
+			return
+		now = time.time()
+		if now >= self.next_snapshot_time:
+			self.next_snapshot_time = now + self.interval
+			self.report(label='interval')
+
+	def take_snapshot(self):
+		return tracemalloc.take_snapshot().filter_traces((
+			tracemalloc.Filter(False, tracemalloc.__file__),
+		))
+
+	def writer_sizes(self, writers):
+		'''
+		Return the number of objects held by each in-memory writer, and their
+		approximate total size, estimated from a sample of up to `SAMPLE_SIZE` objects.
+		'''
+		from pipeline.util import _shared_crom_objects
+		shared = {id(o) for o in _shared_crom_objects().values()}
+		sizes = []
+		seen = set()
+		for w in writers:
+			data = getattr(w, 'data', None)
+			if data is None or id(data) in seen:
+				# writers may share the objects they hold (in a `MergeStore`)
+				continue
+			seen.add(id(data))
+			values = list(data.values())
+			count = len(values)
+			step = max(1, count // self.SAMPLE_SIZE)
+			sample = values[::step][:self.SAMPLE_SIZE]
+			sample_size = sum(approximate_size(o, set(shared)) for o in sample)
+			approx = int(sample_size * count / len(sample)) if sample else 0
+			sizes.append({
+				'writer': getattr(w, '__name__', type(w).__name__),
+				'model': getattr(w, 'model', None),
+				'objects': count,
+				'approximate_bytes': approx,
+			})
+		return sorted(sizes, key=lambda s: s['approximate_bytes'], reverse=True)
+
+	def report(self, label=None, writers=()):
+		'''Write a memory report (labeled with `label`), and return its filename.'''
+		self.account()
+		snapshot = self.take_snapshot()
+		if self.reported_snapshot is not None:
+			stats = snapshot.compare_to(self.reported_snapshot, 'lineno')
+		else:
+			stats = snapshot.statistics('lineno')
+		self.reported_snapshot = snapshot
+		current, peak = tracemalloc.get_traced_memory()
+		self.reports += 1
+		data = {
+			'label': label,
+			'elapsed': time.time() - self.start_time,
+			'traced_bytes': current,
+			'peak_traced_bytes': peak,
+			'node_growth_bytes': dict(self.growth.most_common()),
+			'top_allocations': [{
+				'location': str(s.traceback),
+				'bytes': s.size,
+				'bytes_growth': getattr(s, 'size_diff', s.size),
+				'blocks': s.count,
+				'blocks_growth': getattr(s, 'count_diff', s.count),
+			} for s in stats[:self.top]],
+			'writers': self.writer_sizes(writers),
+		}
+		os.makedirs(self.path, exist_ok=True)
+		filename = os.path.join(self.path, f'memory.{self.reports}.json')
+		with open(filename, 'w') as fh:
+			json.dump(data, fh, indent=1)
+		return filename
+
+	def stop(self):
+		if tracemalloc.is_tracing():
+			tracemalloc.stop()
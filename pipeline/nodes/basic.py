@@ -11,6 +11,7 @@ import itertools
 import warnings
 from contextlib import suppress
 from pipeline.util.cleaners import date_cleaner
+from pipeline.io.csv import CSVRowText
 from cromulent import model
 from pipeline.linkedart import get_crom_object
 
@@ -65,105 +66,174 @@ class CleanDateToSpan(Configurable):
 		return NOT_MODIFIED
 
 class PreserveCSVFields(Configurable):
+	'''
+	Store the text of the fields of a CSV row in `data[key]`, as a `CSVRowText`
+	holding the values of the fields (in the `order` of the CSV header, or sorted by
+	name), which is rendered as a string only when it is used (by calling `str`).
+	'''
 	key = Option(str, default='csv_line')
 	order = Option(list, default=None)
 	
 	def __call__(self, data:dict):
-		s = ''
 		keyorder = self.order
 		if not keyorder:
 			keyorder = sorted(data.keys())
-		for k in keyorder:
-			v = data.get(k, '')
-			s += f'{k}: {v}\n'
-		data[self.key] = s
+		data[self.key] = CSVRowText(keyorder, tuple(map(data.get, keyorder, itertools.repeat(''))))
 		yield data
 
 class KeyManagement(Configurable):
+	'''
+	Restructure the keys of a `dict` by applying a list of `operations`, each a
+	`dict` of operations to apply in order:
+
+	* `remove`: a set of keys to remove
+	* `rename`: a mapping from keys to new keys
+	* `group`: a mapping from new keys to a `properties` list of keys whose values
+	  are moved to a `dict` under the new key
+	* `group_repeating`: a mapping from new keys to a `prefixes` list; the values of
+	  the keys `{prefix}_1`, `{prefix}_2`, ... are moved to a list of `dict`s (one
+	  for each number) under the new key
+
+	The operations are compiled into a plan naming the keys each step uses, so
+	that the numbered keys of `group_repeating` are not searched for in each row.
+	If `field_names` is set (to the field names of the CSV rows being processed),
+	a single plan is compiled for them; otherwise a plan is compiled (and cached)
+	for each distinct list of keys of the rows.
+	'''
 	operations = Option(list)
 	drop_empty = Option(bool, default=True)
+	field_names = Option(required=False)
 
-	def __call__(self, data:dict):
-		pass
-# 		print('KeyManagement')
-		for step, op_record in enumerate(self.operations):
-			pass
-# 			print(f'- step {step}')
+	# the number of plans cached for distinct lists of keys (if `field_names` is not set)
+	max_plans = 256
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.plan = None
+		self.plans = {}
+
+	def compile(self, keys):
+		'''
+		Return the plan of the operations for a `dict` with the given keys, as a list
+		of `(op, arguments)` tuples, where `op` is one of the `_apply_*` methods.
+		'''
+		keys = set(keys)
+		plan = []
+		for op_record in self.operations:
 			for op, op_data in op_record.items():
-				pass
-# 				print(f'  - {op}')
 				if op == 'remove':
-					for key in op_data:
-						with suppress(KeyError):
-							del data[key]
+					keys.difference_update(op_data)
+					plan.append((self._apply_remove, (tuple(op_data),)))
 				elif op == 'rename':
 					for k, v in op_data.items():
-						with suppress(KeyError):
-							value = data[k]
-							data[v] = value
-							del data[k]
+						if k in keys:
+							keys.discard(k)
+							keys.add(v)
+					plan.append((self._apply_rename, (tuple(op_data.items()),)))
 				elif op == 'group':
+					groups = []
 					to_delete = set()
 					for key, mapping in op_data.items():
-						subd = {}
 						properties = mapping['properties']
-						postprocess = mapping.get('postprocess')
 						rename = mapping.get('rename_keys', {})
-						for k in properties:
-							v = data.get(k)
-							if k != key:
-								to_delete.add(k)
-							if self.drop_empty and not v:
-								continue
-							sub_key = rename.get(k, k)
-							subd[sub_key] = v
-						if postprocess:
-							if callable(postprocess):
-								postprocess = [postprocess]
-							for p in postprocess:
-								subd = p(subd, data)
-						data[key] = subd
-					for k in to_delete:
-						with suppress(KeyError):
-							del data[k]
+						fields = tuple((k, rename.get(k, k)) for k in properties)
+						to_delete.update(k for k in properties if k != key)
+						groups.append((key, fields, self._postprocessors(mapping)))
+					keys.difference_update(to_delete)
+					keys.update(key for key, _, _ in groups)
+					plan.append((self._apply_group, (tuple(groups), tuple(to_delete))))
 				elif op == 'group_repeating':
 					for key, mapping in op_data.items():
 						property_prefixes = mapping['prefixes']
-						postprocess = mapping.get('postprocess')
 						rename = mapping.get('rename_keys', {})
-						data[key] = []
-						to_delete = set()
-						exit = False
+						keys.add(key)
+						entries = []
+						to_delete = []
 						for i in itertools.count(1):
-							if exit:
-								break
-							ks = ((prefix, f'{prefix}_{i}') for prefix in property_prefixes)
-							subd = {}
-							for p, k in ks:
-								try:
-									sub_key = rename.get(p, p)
-									subd[sub_key] = data[k]
+							fields = []
+							for p in property_prefixes:
+								k = f'{p}_{i}'
+								if k in keys:
+									fields.append((k, rename.get(p, p)))
 									if k != key:
-										to_delete.add(k)
-								except KeyError:
-									exit = True
-							if self.drop_empty:
-								values_unset = list(map(lambda v: not bool(v), subd.values()))
-								if all(values_unset):
-									continue
-							if postprocess and subd:
-								if callable(postprocess):
-									postprocess = [postprocess]
-								for p in postprocess:
-									subd = p(subd, data)
-									if not subd:
-										break
-							if subd:
-								data[key].append(subd)
-						for k in to_delete:
-							del data[k]
+										to_delete.append(k)
+							if fields:
+								entries.append(tuple(fields))
+							if len(fields) < len(property_prefixes):
+								break
+						keys.difference_update(to_delete)
+						plan.append((self._apply_group_repeating, (key, tuple(entries), tuple(to_delete), self._postprocessors(mapping))))
 				else:
 					warnings.warn(f'Unrecognized operator {op!r} in KeyManagement')
+		return plan
+
+	@staticmethod
+	def _postprocessors(mapping):
+		postprocess = mapping.get('postprocess')
+		if not postprocess:
+			return ()
+		if callable(postprocess):
+			return (postprocess,)
+		return tuple(postprocess)
+
+	def _apply_remove(self, data, keys):
+		for key in keys:
+			if key in data:
+				del data[key]
+
+	def _apply_rename(self, data, pairs):
+		for k, v in pairs:
+			if k in data:
+				value = data[k]
+				data[v] = value
+				del data[k]
+
+	def _apply_group(self, data, groups, to_delete):
+		drop_empty = self.drop_empty
+		for key, fields, postprocess in groups:
+			subd = {}
+			for k, sub_key in fields:
+				v = data.get(k)
+				if drop_empty and not v:
+					continue
+				subd[sub_key] = v
+			for p in postprocess:
+				subd = p(subd, data)
+			data[key] = subd
+		for k in to_delete:
+			if k in data:
+				del data[k]
+
+	def _apply_group_repeating(self, data, key, entries, to_delete, postprocess):
+		drop_empty = self.drop_empty
+		values = data[key] = []
+		for fields in entries:
+			subd = {sub_key: data[k] for k, sub_key in fields}
+			if drop_empty and not any(subd.values()):
+				continue
+			for p in postprocess:
+				subd = p(subd, data)
+				if not subd:
+					break
+			if subd:
+				values.append(subd)
+		for k in to_delete:
+			del data[k]
+
+	def __call__(self, data:dict):
+		plan = self.plan
+		if plan is None:
+			if self.field_names:
+				plan = self.plan = self.compile(self.field_names)
+			else:
+				keys = tuple(data)
+				plan = self.plans.get(keys)
+				if plan is None:
+					plan = self.compile(keys)
+					if len(self.plans) < self.max_plans:
+						self.plans[keys] = plan
+		for op, args in plan:
+			op(data, *args)
 		return data
 
 class RemoveKeys(Configurable):
@@ -1,4 +1,5 @@
 import re
+import os
 import sys
 import pathlib
 import pprint
@@ -16,6 +17,13 @@ import bonobo
 import settings
 
 import pipeline.execution
+from pipeline.metrics import MemoryTracker
+from pipeline.checkpoint import RunCheckpoint
+from pipeline.deadletters import DeadLetterQueue
+from pipeline.io.file import MergingFileWriter
+from pipeline.io.memory import MergeStore
+from pipeline.io.segments import SegmentWriter
+from pipeline.io.sort import RunStore
 from cromulent import model, vocab
 
 from pipeline.util import \
@@ -555,9 +563,41 @@ class StaticInstanceHolder:
 		return used
 
 class PipelineBase:
+	# Names of the services that nodes add data to while a graph is run. When a graph
+	# is run with a `ShardedGraphExecutor`, the data accumulated in these services by
+	# each worker process is merged back into the main process.
+	stateful_services = ('counts',)
+
 	def __init__(self, project_name, *, helper, parallel=False, verbose=False, **kwargs):
 		self.project_name = project_name
 		self.parallel = parallel
+		self.processes = kwargs.get('processes', settings.pipeline_processes)
+		self.queue_size = kwargs.get('queue_size', settings.pipeline_queue_size)
+		self.csv_processes = kwargs.get('csv_processes', settings.pipeline_csv_processes)
+		self.csv_shards = kwargs.get('csv_shards', settings.pipeline_csv_shards)
+		self.flush_processes = kwargs.get('flush_processes', settings.pipeline_flush_processes)
+		self.merge_store_limit = kwargs.get('merge_store_limit', settings.pipeline_merge_store_limit)
+		# 'memory' (the default) or 'sort', to merge the output of the writers with an external sort
+		self.writer_backend = kwargs.get('writer_backend', settings.pipeline_writer_backend)
+		# 'files' (the default) or 'segments', to write the output of the writers to JSON lines segments
+		self.output_format = kwargs.get('output_format', settings.pipeline_output_format)
+		self.ingest_cache_path = settings.pipeline_ingest_cache_path if kwargs.get('ingest_cache', settings.pipeline_ingest_cache) else ''
+		# if set, only the records with these identifiers are read from the main input files
+		self.record_ids = kwargs.get('record_ids', settings.pipeline_record_ids)
+		self.record_index_path = kwargs.get('record_index_path', settings.pipeline_record_index_path)
+		# the `MergeStore` shared by the in-memory writers of each model
+		self.merge_stores = {}
+		# off by default, so that counters, metrics and profiles refer to individual nodes
+		self.fuse_chains = kwargs.get('fuse_chains', settings.pipeline_fuse_chains)
+		self.checkpoint_interval = kwargs.get('checkpoint_interval', settings.pipeline_checkpoint_interval)
+		self.resume = kwargs.get('resume', settings.pipeline_resume)
+		self.run_checkpoint = None
+		self.dead_letters = DeadLetterQueue(kwargs.get('dead_letter_path', settings.pipeline_dead_letter_path))
+		self.replay_entries = None
+		self.memory_tracker = None
+		memory_profile_interval = kwargs.get('memory_profile_interval', settings.pipeline_memory_profile_interval)
+		if memory_profile_interval:
+			self.memory_tracker = MemoryTracker(settings.pipeline_memory_profile_path, interval=memory_profile_interval)
 		self.helper = helper
 		self.verbose = verbose
 		self.services = self.setup_services()
@@ -842,15 +882,135 @@ class PipelineBase:
 			self.add_serialization_chain(graph, groups.output, model=self.models['Group'])
 		return people
 
+	def file_writer(self, **kwargs):
+		'''
+		Return a node writing each object passed to it to the output directory as it is
+		passed: a `MergingFileWriter` (with the options `kwargs`), or a `SegmentWriter`
+		if the output format is 'segments' (as the in-memory writers then write to
+		segments, and the objects of a model must all be written in the same format).
+		'''
+		if self.output_format == 'segments':
+			return SegmentWriter(directory=kwargs['directory'], model=kwargs['model'])
+		return MergingFileWriter(**kwargs)
+
+	def merge_store(self, model):
+		'''
+		Return the `MergeStore` shared by the `MergingMemoryWriter`s of `model`, which
+		holds at most `GETTY_PIPELINE_MERGE_STORE_LIMIT` objects in memory (if set).
+		If the writer backend is 'sort', it is a `RunStore` instead.
+		'''
+		store = self.merge_stores.get(model)
+		if store is None:
+			if self.writer_backend == 'sort':
+				store = RunStore(model, path=settings.pipeline_merge_spill_path, run_size=settings.pipeline_sort_run_size)
+			else:
+				store = MergeStore(model, limit=self.merge_store_limit or None, spill_path=settings.pipeline_merge_spill_path)
+			self.merge_stores[model] = store
+		return store
+
+	def shared_state(self, services):
+		'''
+		Return a `dict` of the mutable containers that are populated while a graph is
+		run, and which must be merged back from worker processes when running with a
+		`ShardedGraphExecutor`.
+		'''
+		state = {name: services[name] for name in self.stateful_services if name in services}
+		state['static_instances'] = self.static_instances.used
+		return state
+
+	def checkpoint(self):
+		'''
+		Called between the graphs of a pipeline run. If memory profiling is enabled
+		(with `GETTY_PIPELINE_MEMORY_PROFILE`), writes a report of the memory in use.
+		'''
+		if self.memory_tracker is not None:
+			filename = self.memory_tracker.report(label=self.project_name, writers=getattr(self, 'writers', []))
+			if self.verbose:
+				print(f'Memory report written to {filename}', file=sys.stderr)
+
+	def checkpoint_for_run(self, services):
+		'''
+		Return the `RunCheckpoint` used to save (every `GETTY_PIPELINE_CHECKPOINT_INTERVAL`
+		seconds) and resume (if `GETTY_PIPELINE_RESUME` is set) the progress of this
+		pipeline's run, or `None` if checkpointing is disabled. It is created for the
+		services of the first graph run.
+		'''
+		if not self.checkpoint_interval:
+			return None
+		if self.run_checkpoint is None:
+			filename = os.path.join(settings.pipeline_tmp_path, f'{self.project_name}.checkpoint')
+			writers = getattr(self, 'writers', [])
+			self.run_checkpoint = RunCheckpoint(filename, self.checkpoint_interval, self.shared_state(services), writers=writers, resume=self.resume)
+		return self.run_checkpoint
+
+	def complete_run(self):
+		'''
+		Called once a run of the pipeline is complete (after its writers are flushed),
+		removing the run's checkpoint, so that a later run with `GETTY_PIPELINE_RESUME`
+		set starts from the beginning instead of skipping every graph.
+		'''
+		if self.run_checkpoint is not None:
+			self.run_checkpoint.clear()
+			self.run_checkpoint = None
+
+	def replay(self, filename=None, **options):
+		'''
+		Run the pipeline, passing only the records recorded in the dead-letter file
+		`filename` (by default, the file written by the last run) through each graph,
+		instead of reading all of the input data. The dead-letter file is renamed with
+		a `.replayed` suffix, and the records that fail again are recorded in a new one.
+		'''
+		if filename is None:
+			filename = self.dead_letters.filename
+		self.replay_entries = DeadLetterQueue.load(filename)
+		os.replace(filename, filename + '.replayed')
+		if self.verbose:
+			count = sum(len(entries) for entries in self.replay_entries.values())
+			print(f'Replaying {count} records from {filename}', file=sys.stderr)
+		try:
+			self.run(**options)
+		finally:
+			self.replay_entries = None
+			self.dead_letters.close()
+
 	def run_graph(self, graph, *, services):
-		if self.parallel:
+		self.dead_letters.start_graph()
+		if self.replay_entries is not None:
+			entries = self.replay_entries.get(self.dead_letters.graph, [])
+			if self.verbose:
+				print(f'Replaying {len(entries)} records with SERIAL custom executor')
+			e = pipeline.execution.GraphExecutor(graph, services, fuse=self.fuse_chains, memory=self.memory_tracker, dead_letters=self.dead_letters)
+			e.replay(entries)
+			return
+		checkpoint = self.checkpoint_for_run(services)
+		if checkpoint is not None:
+			if not checkpoint.start_graph():
+				if self.verbose:
+					print('Skipping graph completed before the last checkpoint')
+				return
+			if self.verbose:
+				print('Running with SERIAL custom executor (checkpointing)')
+			e = pipeline.execution.GraphExecutor(graph, services, fuse=self.fuse_chains, memory=self.memory_tracker, checkpoint=checkpoint, dead_letters=self.dead_letters)
+			e.run()
+			checkpoint.finish_graph()
+		elif self.parallel:
 			if self.verbose:
 				print('Running with PARALLEL bonobo executor')
 			bonobo.run(graph, services=services)
+		elif self.processes > 1:
+			if self.verbose:
+				print(f'Running with SHARDED custom executor ({self.processes} processes)')
+			e = pipeline.execution.ShardedGraphExecutor(graph, services, processes=self.processes, shared_state=self.shared_state(services), fuse=self.fuse_chains, memory=self.memory_tracker, dead_letters=self.dead_letters)
+			e.run()
+		elif self.queue_size:
+			if self.verbose:
+				print(f'Running with ITERATIVE custom executor (queue size {self.queue_size})')
+			e = pipeline.execution.IterativeGraphExecutor(graph, services, queue_size=self.queue_size, fuse=self.fuse_chains, memory=self.memory_tracker, dead_letters=self.dead_letters)
+			e.run()
 		else:
 			if self.verbose:
 				print('Running with SERIAL custom executor')
-			e = pipeline.execution.GraphExecutor(graph, services)
+			e = pipeline.execution.GraphExecutor(graph, services, fuse=self.fuse_chains, memory=self.memory_tracker, dead_letters=self.dead_letters)
 			e.run()
 
 class UtilityHelper:
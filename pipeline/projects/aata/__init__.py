@@ -17,7 +17,6 @@ from datetime import datetime
 import lxml.etree
 from sqlalchemy import create_engine
 from langdetect import detect
-import xmltodict
 import iso639
 
 import bonobo
@@ -43,7 +42,7 @@ from pipeline.linkedart import \
 			MakeLinkedArtPerson, \
 			get_crom_object, \
 			add_crom_data
-from pipeline.io.xml import CurriedXMLReader
+from pipeline.io.xml import CurriedXMLReader, xml_element_to_dict
 from pipeline.nodes.basic import \
 			RecordCounter, \
 			AddArchesModel, \
@@ -204,11 +203,7 @@ class AATAUtilityHelper(UtilityHelper):
 		return self.make_proj_uri('Journal', j_id, 'Issue', i_id)
 
 def _xml_element_to_dict(e):
-	chunk = lxml.etree.tostring(e).decode('utf-8')
-	data = xmltodict.parse(chunk)
-	s = json.dumps(data)
-	data = json.loads(s)
-	return data
+	return xml_element_to_dict(e)
 
 # def _gaia_authority_type(code):
 # 	if code in ('CB', 'Corp'):
@@ -456,6 +451,8 @@ def filter_abstract_authors(data: dict):
 
 class AATAPipeline(PipelineBase):
 	'''Bonobo-based pipeline for transforming AATA data from XML into JSON-LD.'''
+	stateful_services = ('places_with_named_uris', 'counts')
+
 	def __init__(self, input_path, **kwargs):
 		project_name = 'aata'
 		self.input_path = input_path
@@ -754,6 +751,7 @@ class AATAPipeline(PipelineBase):
 			source = g.add_chain(GraphListSource(values))
 			self.add_serialization_chain(g, source.output, model=self.models[model_name])
 			self.run_graph(g, services={})
+		self.complete_run()
 
 class AATAFilePipeline(AATAPipeline):
 	'''
@@ -14,8 +14,9 @@ from cromulent.extract import extract_monetary_amount
 
 import settings
 from pipeline.io.csv import CurriedCSVReader
-from pipeline.io.file import MergingFileWriter
+from pipeline.io.compression import open_input
 from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
 from pipeline.linkedart import (
     MakeLinkedArtHumanMadeObject,
     MakeLinkedArtLinguisticObject,
@@ -863,7 +864,7 @@ class AddRows(Configurable, GoupilProvenance):
             label = f"Goupil Stock Book {book_id}, Page {page}, Row {row}"
 
             ## Transcription #####
-            transctiption = vocab.Transcription(ident='', content=data['star_csv_data'])
+            transctiption = vocab.Transcription(ident='', content=str(data['star_csv_data']))
             transctiption.part_of = self.helper.static_instances.get_instance('LinguisticObject', 'db-goupil')
             trans_creation = vocab.TranscriptionProcess(ident='')
             trans_creation.carried_out_by = self.helper.static_instances.get_instance('Group', 'gpi')
@@ -1797,7 +1798,7 @@ class GoupilPipeline(PipelineBase):
         self.debug = kwargs.get("debug", False)
 
         fs = bonobo.open_fs(input_path)
-        with fs.open(self.header_file, newline="") as csvfile:
+        with open_input(fs, self.header_file, newline="") as csvfile:
             r = csv.reader(csvfile)
             self.headers = [v.lower() for v in next(r)]
 
@@ -1868,6 +1869,7 @@ class GoupilPipeline(PipelineBase):
         sales_records = graph.add_chain(
             PreserveCSVFields(key='star_csv_data', order=self.headers),
             KeyManagement(
+                field_names=self.headers,
                 drop_empty=True,
                 operations=[
                     {
@@ -2269,8 +2271,8 @@ class GoupilPipeline(PipelineBase):
         g = bonobo.Graph()
 
         contents_records = g.add_chain(
-            MatchingFiles(path="/", pattern=self.files_pattern, fs="fs.data.goupil"),
-            CurriedCSVReader(fs="fs.data.goupil", limit=self.limit, field_names=self.headers),
+            MatchingFiles(path="/", pattern=self.files_pattern, fs="fs.data.goupil", batch=self.csv_processes > 1, shards=self.csv_shards),
+            CurriedCSVReader(fs="fs.data.goupil", limit=self.limit, field_names=self.headers, processes=self.csv_processes, cache_path=self.ingest_cache_path, record_ids=self.record_ids, id_field="pi_record_no", index_path=self.record_index_path),
         )
 
         sales = self.add_sales_chain(g, contents_records, services, serialize=True)
@@ -2334,9 +2336,12 @@ class GoupilFilePipeline(GoupilPipeline):
                     partition_directories=True,
                     compact=False,
                     model=model,
+                    store=self.merge_store(model),
+                    flush_processes=self.flush_processes,
+                    output_format=self.output_format,
                 )
             else:
-                w = MergingFileWriter(
+                w = self.file_writer(
                     directory=self.output_path,
                     partition_directories=True,
                     compact=False,
@@ -2350,9 +2355,12 @@ class GoupilFilePipeline(GoupilPipeline):
                     partition_directories=True,
                     compact=True,
                     model=model,
+                    store=self.merge_store(model),
+                    flush_processes=self.flush_processes,
+                    output_format=self.output_format,
                 )
             else:
-                w = MergingFileWriter(
+                w = self.file_writer(
                     directory=self.output_path,
                     partition_directories=True,
                     compact=True,
@@ -2372,8 +2380,9 @@ class GoupilFilePipeline(GoupilPipeline):
         count = len(self.writers)
         for seq_no, w in enumerate(self.writers):
             print("[%d/%d] writers being flushed" % (seq_no + 1, count))
-            if isinstance(w, MergingMemoryWriter):
+            if isinstance(w, (MergingMemoryWriter, SegmentWriter)):
                 w.flush()
+        self.complete_run()
 
         print("====================================================")
         print("Total runtime: ", timeit.default_timer() - start)
@@ -50,8 +50,8 @@ from pipeline.util import \
 from pipeline.util.cleaners import \
 			parse_location_name, \
 			date_cleaner
-from pipeline.io.file import MergingFileWriter
 from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
 # from pipeline.io.arches import ArchesWriter
 import pipeline.linkedart
 from pipeline.linkedart import \
@@ -66,6 +66,7 @@ from pipeline.linkedart import \
 			make_la_place, \
 			make_tgn_place
 from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.compression import open_input
 from pipeline.nodes.basic import \
 			RecordCounter, \
 			KeyManagement, \
@@ -483,7 +484,7 @@ class AddRow(Configurable, KnoedlerProvenance):
 		book = data['book_record']
 		book_id, page_id, row_id = record_id(book)
 		rec_num = data["star_record_no"]
-		content = data['star_csv_data']
+		content = str(data['star_csv_data'])
 		
 		row = vocab.Transcription(ident='', content=content)
 		row.part_of = self.helper.static_instances.get_instance('LinguisticObject', 'db-knoedler')
@@ -1066,7 +1067,7 @@ class TransactionHandler(ProvenanceBase):
 				
 				# else:
 				# star csv data is a string containing all csv data, so split it in lines on '\n' to get each value
-				lines = data['star_csv_data'].split('\n')
+				lines = str(data['star_csv_data']).split('\n')
 				# find price amount value
 				prcamnt = next((line for line in lines if 'price_amount' in line), None)
 				# take the actual value of price amount (only the number)
@@ -1883,7 +1884,7 @@ class KnoedlerPipeline(PipelineBase):
 		self.debug = kwargs.get('debug', False)
 
 		fs = bonobo.open_fs(input_path)
-		with fs.open(self.header_file, newline='') as csvfile:
+		with open_input(fs, self.header_file, newline='') as csvfile:
 			r = csv.reader(csvfile)
 			self.headers = [v.lower() for v in next(r)]
 
@@ -2009,6 +2010,7 @@ class KnoedlerPipeline(PipelineBase):
 # 			"pi_record_no",
 			PreserveCSVFields(key='star_csv_data', order=self.headers),
 			KeyManagement(
+				field_names=self.headers,
 				drop_empty=True,
 				operations=[
 					{
@@ -2435,8 +2437,8 @@ class KnoedlerPipeline(PipelineBase):
 		g = bonobo.Graph()
 
 		contents_records = g.add_chain(
-			MatchingFiles(path='/', pattern=self.files_pattern, fs='fs.data.knoedler'),
-			CurriedCSVReader(fs='fs.data.knoedler', limit=self.limit, field_names=self.headers),
+			MatchingFiles(path='/', pattern=self.files_pattern, fs='fs.data.knoedler', batch=self.csv_processes > 1, shards=self.csv_shards),
+			CurriedCSVReader(fs='fs.data.knoedler', limit=self.limit, field_names=self.headers, processes=self.csv_processes, cache_path=self.ingest_cache_path, record_ids=self.record_ids, id_field='pi_record_no', index_path=self.record_index_path),
 		)
 		sales = self.add_sales_chain(g, contents_records, services, serialize=True)
 		self.add_transaction_chains(g, sales, services, serialize=True)
@@ -2463,6 +2465,8 @@ class KnoedlerPipeline(PipelineBase):
 		graph = self.get_graph(services=services, **options)
 		self.run_graph(graph, services=services)
 
+		self.checkpoint()
+
 		if self.verbose:
 			print('Serializing static instances...', file=sys.stderr)
 		
@@ -2491,15 +2495,15 @@ class KnoedlerFilePipeline(KnoedlerPipeline):
 		nodes = []
 		if self.debug:
 			if use_memory_writer:
-				w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, compact=False, model=model)
+				w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, compact=False, model=model, store=self.merge_store(model), flush_processes=self.flush_processes, output_format=self.output_format)
 			else:
-				w = MergingFileWriter(directory=self.output_path, partition_directories=True, compact=False, model=model)
+				w = self.file_writer(directory=self.output_path, partition_directories=True, compact=False, model=model)
 			nodes.append(w)
 		else:
 			if use_memory_writer:
-				w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, compact=True, model=model)
+				w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, compact=True, model=model, store=self.merge_store(model), flush_processes=self.flush_processes, output_format=self.output_format)
 			else:
-				w = MergingFileWriter(directory=self.output_path, partition_directories=True, compact=True, model=model)
+				w = self.file_writer(directory=self.output_path, partition_directories=True, compact=True, model=model)
 			nodes.append(w)
 		self.writers += nodes
 		return nodes
@@ -2514,8 +2518,9 @@ class KnoedlerFilePipeline(KnoedlerPipeline):
 		count = len(self.writers)
 		for seq_no, w in enumerate(self.writers):
 			print('[%d/%d] writers being flushed' % (seq_no+1, count))
-			if isinstance(w, MergingMemoryWriter):
+			if isinstance(w, (MergingMemoryWriter, SegmentWriter)):
 				w.flush()
+		self.complete_run()
 
 		print('====================================================')
 		print('Total runtime: ', timeit.default_timer() - start)
@@ -50,11 +50,12 @@ from pipeline.util import \
 			timespan_from_outer_bounds, \
 			traverse_static_place_instances_people
 from pipeline.util.cleaners import date_parse, date_cleaner, parse_location_name
-from pipeline.io.file import MergingFileWriter
 from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
 import pipeline.linkedart
 from pipeline.linkedart import add_crom_data, get_crom_object, make_tgn_place, make_la_place
 from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.compression import open_input
 from pipeline.nodes.basic import \
 			RemoveKeys, \
 			KeyManagement, \
@@ -115,7 +116,7 @@ class AddPersonEntry(Configurable):
 		recno = data['star_record_no']
 		auth_name = data.get('auth_name')
 		record_uri = self.helper.make_proj_uri('ENTRY', 'PEOPLE', recno)
-		content = data['star_csv_data']
+		content = str(data['star_csv_data'])
 		record = vocab.EntryTextForm(ident=record_uri, label=f'Entry recorded in PSCP PEOPLE dataset for {auth_name}', content=content)
 		creation = model.Creation(ident='')
 		creation.carried_out_by = self.helper.static_instances.get_instance('Group', 'gpi')
@@ -512,6 +513,8 @@ class AddPerson(Configurable):
 
 class PeoplePipeline(PipelineBase):
 	'''Bonobo-based pipeline for transforming People data from CSV into JSON-LD.'''
+	stateful_services = ('people_groups', 'counts')
+
 	def __init__(self, input_path, contents, **kwargs):
 		project_name = 'people'
 		self.input_path = input_path
@@ -545,7 +548,7 @@ class PeoplePipeline(PipelineBase):
 		self.debug = kwargs.get('debug', False)
 
 		fs = bonobo.open_fs(input_path)
-		with fs.open(self.contents_header_file, newline='') as csvfile:
+		with open_input(fs, self.contents_header_file, newline='') as csvfile:
 			r = csv.reader(csvfile)
 			self.contents_headers = [v.lower() for v in next(r)]
 
@@ -602,10 +605,11 @@ class PeoplePipeline(PipelineBase):
 		g = bonobo.Graph()
 
 		contents_records = g.add_chain(
-			MatchingFiles(path='/', pattern=self.contents_files_pattern, fs='fs.data.people'),
-			CurriedCSVReader(fs='fs.data.people', limit=self.limit, field_names=self.contents_headers),
+			MatchingFiles(path='/', pattern=self.contents_files_pattern, fs='fs.data.people', batch=self.csv_processes > 1, shards=self.csv_shards),
+			CurriedCSVReader(fs='fs.data.people', limit=self.limit, field_names=self.contents_headers, processes=self.csv_processes, cache_path=self.ingest_cache_path, record_ids=self.record_ids, id_field='star_record_no', index_path=self.record_index_path),
 			PreserveCSVFields(key='star_csv_data', order=self.contents_headers),
 			KeyManagement(
+				field_names=self.contents_headers,
 				operations=[
 					{
 						'group_repeating': {
@@ -740,9 +744,9 @@ class PeopleFilePipeline(PeoplePipeline):
 		nodes = []
 		kwargs['compact'] = not self.debug
 		if use_memory_writer:
-			w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, model=model, **kwargs)
+			w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, model=model, store=self.merge_store(model), flush_processes=self.flush_processes, output_format=self.output_format, **kwargs)
 		else:
-			w = MergingFileWriter(directory=self.output_path, partition_directories=True, model=model, **kwargs)
+			w = self.file_writer(directory=self.output_path, partition_directories=True, model=model, **kwargs)
 		nodes.append(w)
 		self.writers += nodes
 		return nodes
@@ -757,8 +761,9 @@ class PeopleFilePipeline(PeoplePipeline):
 		count = len(self.writers)
 		for seq_no, w in enumerate(self.writers):
 			print('[%d/%d] writers being flushed' % (seq_no+1, count))
-			if isinstance(w, MergingMemoryWriter):
+			if isinstance(w, (MergingMemoryWriter, SegmentWriter)):
 				w.flush()
+		self.complete_run()
 
 		print('====================================================')
 		print('Total runtime: ', timeit.default_timer() - start)
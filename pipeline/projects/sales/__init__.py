@@ -56,12 +56,13 @@ from pipeline.util import \
 			identity, \
 			replace_key_pattern, \
 			strip_key_prefix
-from pipeline.io.file import MergingFileWriter
 from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentWriter
 # from pipeline.io.arches import ArchesWriter
 import pipeline.linkedart
 from pipeline.linkedart import add_crom_data, get_crom_object, make_tgn_place
 from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.compression import open_input
 from pipeline.nodes.basic import \
 			RecordCounter, \
 			KeyManagement, \
@@ -508,6 +509,8 @@ def add_crom_price(data, parent, services, add_citations=False):
 
 class SalesPipeline(PipelineBase):
 	'''Bonobo-based pipeline for transforming Sales data from CSV into JSON-LD.'''
+	stateful_services = ('unique_catalogs', 'post_sale_map', 'event_properties', 'non_auctions', 'counts')
+
 	def __init__(self, input_path, catalogs, auction_events, contents, **kwargs):
 		project_name = 'sales'
 		self.input_path = input_path
@@ -560,13 +563,13 @@ class SalesPipeline(PipelineBase):
 		self.debug = kwargs.get('debug', False)
 
 		fs = bonobo.open_fs(input_path)
-		with fs.open(self.catalogs_header_file, newline='') as csvfile:
+		with open_input(fs, self.catalogs_header_file, newline='') as csvfile:
 			r = csv.reader(csvfile)
 			self.catalogs_headers = [v.lower() for v in next(r)]
-		with fs.open(self.auction_events_header_file, newline='') as csvfile:
+		with open_input(fs, self.auction_events_header_file, newline='') as csvfile:
 			r = csv.reader(csvfile)
 			self.auction_events_headers = [v.lower() for v in next(r)]
-		with fs.open(self.contents_header_file, newline='') as csvfile:
+		with open_input(fs, self.contents_header_file, newline='') as csvfile:
 			r = csv.reader(csvfile)
 			self.contents_headers = [v.lower() for v in next(r)]
 
@@ -698,6 +701,7 @@ class SalesPipeline(PipelineBase):
 		auction_events = graph.add_chain(
 			PreserveCSVFields(key='star_csv_data', order=self.auction_events_headers),
 			KeyManagement(
+				field_names=self.auction_events_headers,
 				drop_empty=True,
 				operations=[
 					{
@@ -848,6 +852,7 @@ class SalesPipeline(PipelineBase):
 		sales = graph.add_chain(
 			PreserveCSVFields(key='star_csv_data', order=self.contents_headers),
 			KeyManagement(
+				field_names=self.contents_headers,
 				drop_empty=True,
 				operations=[
 					{
@@ -1328,8 +1333,8 @@ class SalesPipeline(PipelineBase):
 		component3 = [graph0] if single_graph else [graph3]
 		for g in component1:
 			auction_events_records = g.add_chain(
-				MatchingFiles(path='/', pattern=self.auction_events_files_pattern, fs='fs.data.sales'),
-				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.auction_events_headers),
+				MatchingFiles(path='/', pattern=self.auction_events_files_pattern, fs='fs.data.sales', batch=self.csv_processes > 1, shards=self.csv_shards),
+				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.auction_events_headers, processes=self.csv_processes, cache_path=self.ingest_cache_path),
 # 				AddFieldNames(field_names=self.auction_events_headers)
 			)
 
@@ -1345,8 +1350,8 @@ class SalesPipeline(PipelineBase):
 
 		for g in component2:
 			physical_catalog_records = g.add_chain(
-				MatchingFiles(path='/', pattern=self.catalogs_files_pattern, fs='fs.data.sales'),
-				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.catalogs_headers),
+				MatchingFiles(path='/', pattern=self.catalogs_files_pattern, fs='fs.data.sales', batch=self.csv_processes > 1, shards=self.csv_shards),
+				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.catalogs_headers, processes=self.csv_processes, cache_path=self.ingest_cache_path),
 # 				AddFieldNames(field_names=self.catalogs_headers),
 			)
 
@@ -1361,8 +1366,8 @@ class SalesPipeline(PipelineBase):
 
 		for g in component3:
 			contents_records = g.add_chain(
-				MatchingFiles(path='/', pattern=self.contents_files_pattern, fs='fs.data.sales'),
-				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.contents_headers),
+				MatchingFiles(path='/', pattern=self.contents_files_pattern, fs='fs.data.sales', batch=self.csv_processes > 1, shards=self.csv_shards),
+				CurriedCSVReader(fs='fs.data.sales', limit=self.limit, field_names=self.contents_headers, processes=self.csv_processes, cache_path=self.ingest_cache_path, record_ids=self.record_ids, id_field='pi_record_no', index_path=self.record_index_path),
 # 				AddFieldNames(field_names=self.contents_headers),
 			)
 			# import pdb; pdb.set_trace()
@@ -1409,9 +1414,6 @@ class SalesPipeline(PipelineBase):
 			self._construct_graph(**kwargs)
 		return self.graph_3
 
-	def checkpoint(self):
-		pass
-
 	def run(self, services=None, **options):
 		'''Run the Sales bonobo pipeline.'''
 		if self.verbose:
@@ -1506,9 +1508,9 @@ class SalesFilePipeline(SalesPipeline):
 		nodes = []
 		kwargs['compact'] = not self.debug
 		if use_memory_writer:
-			w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, model=model, **kwargs)
+			w = MergingMemoryWriter(directory=self.output_path, partition_directories=True, model=model, store=self.merge_store(model), flush_processes=self.flush_processes, output_format=self.output_format, **kwargs)
 		else:
-			w = MergingFileWriter(directory=self.output_path, partition_directories=True, model=model, **kwargs)
+			w = self.file_writer(directory=self.output_path, partition_directories=True, model=model, **kwargs)
 		nodes.append(w)
 		self.writers += nodes
 		return nodes
@@ -1548,8 +1550,9 @@ class SalesFilePipeline(SalesPipeline):
 			print(f'Saved post-sales rewrite map to {rewrite_map_filename}')
 
 	def checkpoint(self):
-		self.flush_writers(verbose=False)
+		# report on memory use before the writers are flushed
 		super().checkpoint()
+		self.flush_writers(verbose=False)
 
 	def flush_writers(self, **kwargs):
 		verbose = kwargs.get('verbose', True)
@@ -1557,7 +1560,7 @@ class SalesFilePipeline(SalesPipeline):
 		for seq_no, w in enumerate(self.writers):
 			if verbose:
 				print('[%d/%d] writers being flushed' % (seq_no+1, count))
-			if isinstance(w, MergingMemoryWriter):
+			if isinstance(w, (MergingMemoryWriter, SegmentWriter)):
 				w.flush(**kwargs)
 
 	def run(self, **options):
@@ -1584,6 +1587,7 @@ class SalesFilePipeline(SalesPipeline):
 		for k, v in services['counts'].items():
 			print(f'{v:<10} {k}')
 		print('\n\n')
+		self.complete_run()
 		print('Total runtime: ', timeit.default_timer() - start)
 
 # 		for type in ('AttributeAssignment', 'Person', 'Production', 'Painting'):
@@ -29,7 +29,7 @@ class AddAuctionCatalog(Configurable):
 		sale_type = sale_type or 'Auction'
 		catalog = self.helper.catalog_text(cno, sale_type)
 
-		content = data['star_csv_data']
+		content = str(data['star_csv_data'])
 		row = vocab.Transcription(ident='', content=content)
 		row.part_of = self.helper.static_instances.get_instance('LinguisticObject', 'db-sales_events')
 		creation = vocab.TranscriptionProcess(ident='')
@@ -216,7 +216,7 @@ class AddPhysicalCatalogEntry(Configurable):
 		sale_type = non_auctions.get(cno, data.get('non_auction_flag', 'Auction'))
 		keys = [v for v in [cno, owner, copy] if v]
 		record_uri = self.helper.make_proj_uri('ENTRY', 'PHYS-CAT', *keys)
-		content = data['star_csv_data']
+		content = str(data['star_csv_data'])
 		
 		catalog_label = self.helper.physical_catalog_label(cno, sale_type, owner, copy)
 		row_name = f'STAR Entry for Physical {catalog_label}'
@@ -142,7 +142,7 @@ class PopulateSalesObject(Configurable, pipeline.linkedart.PopulateObject):
 		puid = parent.get('persistent_puid')
 		puid_id = self.helper.gpi_number_id(puid)
 
-		content = data['star_csv_data']
+		content = str(data['star_csv_data'])
 		row = vocab.Transcription(ident='', content=content)
 		row.part_of = self.helper.static_instances.get_instance('LinguisticObject', 'db-sales_contents')
 		creation = vocab.TranscriptionProcess(ident='')
@@ -3,6 +3,7 @@ import os
 import sys
 import fnmatch
 import pprint
+import pickle
 import calendar
 import datetime
 from threading import Lock
@@ -16,6 +17,8 @@ from bonobo.config import Configurable, Option, Service
 
 import settings
 import pipeline.io.arches
+from pipeline.io.csv import plan_byte_ranges
+from pipeline.io.compression import compression_suffix, strip_compression_suffix
 from cromulent import model, vocab
 from cromulent.model import factory, BaseResource
 from pipeline.linkedart import add_crom_data
@@ -430,6 +433,65 @@ class CromObjectMerger:
 					setattr(obj, p, None)
 					setattr(obj, p, value)
 
+def _shared_crom_objects():
+	'''
+	Return a `dict` mapping keys to the crom objects that are shared by all the
+	modeled data (the `vocab.instances` and the classifications of the vocab classes).
+	'''
+	shared = {('factory',): factory}
+	for name, t in vocab.instances.items():
+		shared[('instance', name)] = t
+	for name, t in vocab.instance_types.items():
+		shared[('instance_type', name)] = t
+	return shared
+
+class CromPickler(pickle.Pickler):
+	'''
+	Pickler for data containing crom objects.
+
+	Every crom object holds a reference to the shared `cromulent.model.factory`, and
+	pickling it with each object makes the output many times larger than the data it
+	describes. The factory (and the shared vocabulary instances, whose identity
+	affects how crom serializes repeated references) are instead stored by key,
+	and resolved to the same objects by `CromUnpickler`.
+
+	Building the table of shared objects is relatively expensive; code pickling many
+	objects separately can build it once with `shared_table` and pass it as `shared`.
+	'''
+	def __init__(self, *args, shared=None, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.shared = shared if shared is not None else self.shared_table()
+
+	@staticmethod
+	def shared_table():
+		return {id(v): k for k, v in _shared_crom_objects().items()}
+
+	def persistent_id(self, obj):
+		return self.shared.get(id(obj))
+
+class CromUnpickler(pickle.Unpickler):
+	def __init__(self, *args, shared=None, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.shared = shared if shared is not None else self.shared_table()
+
+	@staticmethod
+	def shared_table():
+		return _shared_crom_objects()
+
+	def persistent_load(self, pid):
+		try:
+			return self.shared[pid]
+		except KeyError:
+			raise pickle.UnpicklingError(f'Unsupported persistent object: {pid!r}')
+
+def crom_dump(data, fh):
+	'''Pickle `data` (which may contain crom objects) to the binary file handle `fh`.'''
+	CromPickler(fh, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+
+def crom_load(fh):
+	'''Load data pickled with `crom_dump` from the binary file handle `fh`.'''
+	return CromUnpickler(fh).load()
+
 class ExtractKeyedValues(Configurable):
 	'''
 	Given a `dict` representing an some object, extract an array of `dict` values from
@@ -503,9 +565,18 @@ class RecursiveExtractKeyedValue(ExtractKeyedValue):
 class MatchingFiles(Configurable):
 	'''
 	Given a path and a pattern, yield the names of all files in the path that match the pattern.
+	A compressed file (e.g. 'data.csv.gz') matches if its name without the compression
+	suffix does, unless the uncompressed file is also present.
+
+	If `batch` is set, the names are yielded together as a single tuple (which
+	`CurriedCSVReader` can parse concurrently). If `shards` is greater than 1, each
+	uncompressed CSV file is split into that many `ByteRange`s of about the same size,
+	which are yielded instead of its name.
 	'''
 	path = Option(str)
 	pattern = Option(default='*')
+	batch = Option(bool, default=False)
+	shards = Option(int, default=1)
 	fs = Service(
 		'fs',
 		__doc__='''The filesystem instance to use.''',
@@ -520,6 +591,15 @@ class MatchingFiles(Configurable):
 		super().__init__(self, *args, **kwargs)
 		self.__name__ = f'{type(self).__name__} ({self.pattern})'
 
+	@staticmethod
+	def matches(f, pattern, present):
+		if fnmatch.fnmatch(f, pattern):
+			return True
+		uncompressed = strip_compression_suffix(f)
+		if uncompressed == f or uncompressed in present:
+			return False
+		return fnmatch.fnmatch(uncompressed, pattern)
+
 	def __call__(self, *, fs, **kwargs):
 		count = 0
 		if not self.pattern:
@@ -527,10 +607,23 @@ class MatchingFiles(Configurable):
 # 		print(repr(self.pattern))
 		subpath, pattern = os.path.split(self.pattern)
 		fullpath = os.path.join(self.path, subpath)
-		for f in sorted(fs.listdir(fullpath)):
-			if fnmatch.fnmatch(f, pattern):
-				yield os.path.join(subpath, f)
+		files = []
+		listing = sorted(fs.listdir(fullpath))
+		present = set(listing)
+		for f in listing:
+			if self.matches(f, pattern, present):
+				name = os.path.join(subpath, f)
+				if self.shards > 1 and not compression_suffix(name):
+					parts = plan_byte_ranges(fs, name, self.shards)
+				else:
+					parts = [name]
+				if self.batch:
+					files.extend(parts)
+				else:
+					yield from parts
 				count += 1
+		if files:
+			yield tuple(files)
 		if not count:
 			sys.stderr.write(f'*** No files matching {pattern} found in {fullpath}\n')
 
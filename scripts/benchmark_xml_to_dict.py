@@ -0,0 +1,48 @@
+#!/usr/bin/env python3 -B
+
+'''
+Compare the time taken to convert the records of AATA XML files to dicts with
+`pipeline.io.xml.xml_element_to_dict`, and by serializing each record and parsing
+it with `xmltodict` (followed by a JSON round trip), as the AATA pipeline used to.
+
+Usage: benchmark_xml_to_dict.py [FILE.xml ...]
+
+Defaults to the AATA test fixtures.
+'''
+
+import sys
+import json
+import timeit
+from pathlib import Path
+
+import lxml.etree
+import xmltodict
+
+from pipeline.io.xml import xml_element_to_dict
+
+def xmltodict_element_to_dict(e):
+	chunk = lxml.etree.tostring(e).decode('utf-8')
+	return json.loads(json.dumps(xmltodict.parse(chunk)))
+
+if __name__ == '__main__':
+	files = sys.argv[1:]
+	if not files:
+		path = Path(__file__).resolve().parent.parent / 'tests' / 'data' / 'aata'
+		files = sorted(str(p) for p in path.glob('*/*.xml'))
+
+	records = []
+	for filename in files:
+		root = lxml.etree.parse(filename).getroot()
+		records.extend(root.xpath('/*/record'))
+	print(f'{len(records)} records from {len(files)} files')
+
+	for e in records:
+		if xml_element_to_dict(e) != xmltodict_element_to_dict(e):
+			print(f'Conversion mismatch for record at line {e.sourceline}')
+			sys.exit(1)
+
+	times = {}
+	for name, convert in (('xmltodict', xmltodict_element_to_dict), ('native', xml_element_to_dict)):
+		times[name] = min(timeit.repeat(lambda: [convert(e) for e in records], number=5, repeat=3)) / 5
+		print(f'{name:<10} {times[name]:8.4f}s  ({1000000 * times[name] / max(len(records), 1):.1f}µs per record)')
+	print(f'speedup    {times["xmltodict"] / times["native"]:.1f}x')
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3 -B
+
+'''
+Materialize the JSON lines segments written to an output directory (by a pipeline
+run with GETTY_PIPELINE_OUTPUT_FORMAT=segments) as one JSON file per object, in
+the `<model>/<partition>/<uuid>.json` layout expected by the post-processing
+scripts and by Arches.
+
+Usage: export_segments.py [OUTPUT_PATH [DESTINATION_PATH]]
+
+The destination defaults to the output path itself.
+'''
+
+import os
+import sys
+
+from settings import output_file_path
+from pipeline.io.segments import SegmentIndex
+
+if __name__ == '__main__':
+	path = sys.argv[1] if len(sys.argv) > 1 else output_file_path
+	destination = sys.argv[2] if len(sys.argv) > 2 else path
+	for model in sorted(os.listdir(path)):
+		index = SegmentIndex(os.path.join(path, model))
+		if not os.path.isdir(index.path) or not index.segments():
+			continue
+		count = index.export(os.path.join(destination, model))
+		print(f'Exported {count} objects for model {model}')
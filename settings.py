@@ -33,6 +33,29 @@ pipeline_service_files_base_path = os.environ.get('GETTY_PIPELINE_SERVICE_FILES_
 output_file_path = os.environ.get('GETTY_PIPELINE_OUTPUT', '/data2/output')
 DEBUG = os.environ.get('GETTY_PIPELINE_DEBUG', True)
 SPAM = os.environ.get('GETTY_PIPELINE_VERBOSE', False)
+pipeline_processes = int(os.environ.get('GETTY_PIPELINE_PROCESSES', 1))
+pipeline_queue_size = int(os.environ.get('GETTY_PIPELINE_QUEUE_SIZE', 0))
+pipeline_csv_processes = int(os.environ.get('GETTY_PIPELINE_CSV_PROCESSES', 1))
+pipeline_csv_shards = int(os.environ.get('GETTY_PIPELINE_CSV_SHARDS', 1))
+pipeline_flush_processes = int(os.environ.get('GETTY_PIPELINE_FLUSH_PROCESSES', 1))
+pipeline_merge_store_limit = int(os.environ.get('GETTY_PIPELINE_MERGE_STORE_LIMIT', 0))
+pipeline_merge_spill_path = os.environ.get('GETTY_PIPELINE_MERGE_SPILL_PATH', os.path.join(pipeline_tmp_path, 'merge-spill'))
+pipeline_writer_backend = os.environ.get('GETTY_PIPELINE_WRITER_BACKEND', 'memory')
+pipeline_sort_run_size = int(os.environ.get('GETTY_PIPELINE_SORT_RUN_SIZE', 10000))
+pipeline_output_format = os.environ.get('GETTY_PIPELINE_OUTPUT_FORMAT', 'files')
+pipeline_ingest_cache = os.environ.get('GETTY_PIPELINE_INGEST_CACHE', '') not in ('', '0', 'false', 'False')
+pipeline_ingest_cache_path = os.environ.get('GETTY_PIPELINE_INGEST_CACHE_PATH', os.path.join(pipeline_tmp_path, 'ingest-cache'))
+pipeline_record_ids = [i.strip() for i in os.environ['GETTY_PIPELINE_RECORD_IDS'].split(',') if i.strip()] if 'GETTY_PIPELINE_RECORD_IDS' in os.environ else None
+pipeline_record_index_path = os.environ.get('GETTY_PIPELINE_RECORD_INDEX_PATH', os.path.join(pipeline_tmp_path, 'record-index'))
+pipeline_fuse_chains = os.environ.get('GETTY_PIPELINE_FUSE_CHAINS', '') not in ('', '0', 'false', 'False')
+pipeline_profile_nodes = os.environ.get('GETTY_PIPELINE_PROFILE_NODES', '')
+pipeline_profile_sample_rate = float(os.environ.get('GETTY_PIPELINE_PROFILE_SAMPLE_RATE', 0.01))
+pipeline_profile_path = os.environ.get('GETTY_PIPELINE_PROFILE_PATH', os.path.join(output_file_path, 'profiles'))
+pipeline_memory_profile_interval = float(os.environ.get('GETTY_PIPELINE_MEMORY_PROFILE', 0))
+pipeline_memory_profile_path = os.environ.get('GETTY_PIPELINE_MEMORY_PROFILE_PATH', os.path.join(output_file_path, 'memory'))
+pipeline_checkpoint_interval = float(os.environ.get('GETTY_PIPELINE_CHECKPOINT_INTERVAL', 0))
+pipeline_resume = os.environ.get('GETTY_PIPELINE_RESUME', '') not in ('', '0', 'false', 'False')
+pipeline_dead_letter_path = os.environ.get('GETTY_PIPELINE_DEAD_LETTERS', os.path.join(output_file_path, 'dead-letters.jsonl'))
 
 gpi_engine = 'sqlite:///%s/gpi.sqlite' % (data_path,)
 raw_engine = 'sqlite:///%s/raw_gpi.sqlite' % (data_path,)
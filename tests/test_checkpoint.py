@@ -0,0 +1,173 @@
+import os
+import csv
+import unittest
+import tempfile
+from collections import defaultdict
+
+from bonobo.config import Configurable, Service
+
+import bonobo
+import settings
+from cromulent import vocab
+from cromulent.model import factory
+
+from pipeline.checkpoint import RunCheckpoint
+from pipeline.execution import GraphExecutor
+from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.sort import RunStore
+from pipeline.linkedart import add_crom_data
+from pipeline.projects import PipelineBase, UtilityHelper
+from pipeline.util import MatchingFiles
+
+class Crash(BaseException):
+	pass
+
+class CountRows(Configurable):
+	counts = Service('counts')
+
+	def __call__(self, data, counts):
+		counts['rows'] += 1
+		counts[data['group']] += 1
+		return data
+
+def make_group(data):
+	g = vocab.Group(ident=f'urn:group:{data["group"]}', label=data['group'])
+	g.identified_by = vocab.PrimaryName(ident='', content=data['name'])
+	return add_crom_data(data={'uri': g.id}, what=g)
+
+class CheckpointedPipeline(PipelineBase):
+	def __init__(self, input_path, **kwargs):
+		self.input_path = input_path
+		super().__init__('checkpoint-test', helper=UtilityHelper('checkpoint-test'), checkpoint_interval=3600, **kwargs)
+
+	def run(self, graphs):
+		for graph in graphs:
+			self.run_graph(graph, services=self.services)
+		self.complete_run()
+
+class RunCheckpointTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(self.input_path)
+		for n in range(2):
+			with open(os.path.join(self.input_path, f'rows_{n}.csv'), 'w', newline='') as fh:
+				w = csv.writer(fh)
+				for i in range(10):
+					w.writerow([str(i), f'Name {n}-{i}', f'g{i % 3}'])
+		self.filename = os.path.join(self.tmp.name, 'test.checkpoint')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def run_graph(self, crash_at=None, resume=False, limit=0):
+		seen = []
+		def crash(data):
+			seen.append(data['name'])
+			if len(seen) == crash_at:
+				raise Crash()
+			return data
+
+		writer = MergingMemoryWriter(directory=self.tmp.name, model='group')
+		g = bonobo.Graph()
+		g.add_chain(
+			MatchingFiles(path='/', pattern='rows_*.csv', fs='fs.data.test'),
+			CurriedCSVReader(fs='fs.data.test', limit=limit, field_names=['id', 'name', 'group']),
+			crash,
+			CountRows(),
+			make_group,
+			writer,
+		)
+		counts = defaultdict(int)
+		services = {
+			'fs.data.test': bonobo.open_fs(self.input_path),
+			'counts': counts,
+		}
+		checkpoint = RunCheckpoint(self.filename, 0, {'counts': counts}, writers=[writer], resume=resume)
+		self.assertTrue(checkpoint.start_graph())
+		e = GraphExecutor(g, services, checkpoint=checkpoint)
+		try:
+			e.run()
+		except Crash:
+			pass
+		else:
+			checkpoint.finish_graph()
+		data = {k: factory.toString(v, False) for k, v in writer.data.items()}
+		return data, dict(counts), seen
+
+	def test_resume(self):
+		expected_data, expected_counts, _ = self.run_graph()
+		self.assertEqual(expected_counts['rows'], 20)
+		os.remove(self.filename)
+
+		self.run_graph(crash_at=14)
+		data, counts, seen = self.run_graph(resume=True)
+		# the first file and the rows of the second file processed before the crash are skipped
+		self.assertEqual(seen[0], 'Name 1-3')
+		self.assertEqual(len(seen), 7)
+		self.assertEqual(counts, expected_counts)
+		self.assertEqual(data, expected_data)
+
+	def test_resume_with_limit(self):
+		self.run_graph(crash_at=4, limit=6)
+		_, counts, seen = self.run_graph(resume=True, limit=6)
+		self.assertEqual(seen, ['Name 0-3', 'Name 0-4', 'Name 0-5'])
+		self.assertEqual(counts['rows'], 6)
+
+	def test_completed_graphs_are_skipped(self):
+		self.run_graph()
+		checkpoint = RunCheckpoint(self.filename, 0, {'counts': defaultdict(int)}, resume=True)
+		self.assertFalse(checkpoint.start_graph())
+		self.assertTrue(checkpoint.start_graph())
+		self.assertEqual(checkpoint.saved, None)
+
+	def test_resume_after_completed_run(self):
+		seen = []
+		def source():
+			yield from range(3)
+
+		def graphs():
+			g = bonobo.Graph()
+			g.add_chain(source, seen.append)
+			return [g, g]
+
+		filename = os.path.join(settings.pipeline_tmp_path, 'checkpoint-test.checkpoint')
+		pipeline = CheckpointedPipeline(self.input_path)
+		pipeline.run(graphs())
+		self.assertEqual(len(seen), 6)
+		self.assertFalse(os.path.exists(filename))
+		# a later run that resumes does not skip the graphs of the completed run
+		pipeline = CheckpointedPipeline(self.input_path, resume=True)
+		pipeline.run(graphs())
+		self.assertEqual(len(seen), 12)
+
+	def test_resume_run_store(self):
+		def write(writer, ids):
+			for i in ids:
+				g = vocab.Group(ident=f'urn:group:{i}', label=f'Group {i}')
+				writer(add_crom_data(data={}, what=g))
+
+		spill_path = os.path.join(self.tmp.name, 'spill')
+		store = RunStore('group', path=spill_path)
+		writer = MergingMemoryWriter(directory=self.tmp.name, model='group', store=store)
+		checkpoint = RunCheckpoint(self.filename, 0, {}, writers=[writer])
+		checkpoint.start_graph()
+		write(writer, range(5))
+		checkpoint.save()
+		# added after the checkpoint, and lost when the run stops
+		write(writer, range(5, 8))
+
+		store = RunStore('group', path=spill_path)
+		writer = MergingMemoryWriter(directory=self.tmp.name, model='group', store=store)
+		checkpoint = RunCheckpoint(self.filename, 0, {}, writers=[writer], resume=True)
+		self.assertTrue(checkpoint.start_graph())
+		write(writer, range(5, 8))
+		self.assertEqual(store.count(), 8)
+		records = [ident.rsplit('/', 1)[-1] for run in store.runs for ident, _ in RunStore.read_run(run)]
+		self.assertEqual(sorted(records), sorted(f'urn:group:{i}' for i in range(8)))
+		self.assertEqual(len(list(store.items())), 8)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,70 @@
+import os
+import bz2
+import csv
+import gzip
+import lzma
+import unittest
+import tempfile
+
+import bonobo
+
+from pipeline.io.compression import open_input
+from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.xml import CurriedXMLReader
+from pipeline.util import MatchingFiles
+
+class CompressedInputTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.rows = [[str(i), f'Name\n{i}', 'é'] for i in range(5)]
+		with open(os.path.join(self.tmp.name, 'plain.csv'), 'w', newline='', encoding='utf-8') as fh:
+			csv.writer(fh).writerows(self.rows)
+		with open(os.path.join(self.tmp.name, 'plain.csv'), 'rb') as fh:
+			data = fh.read()
+		for name, module in (('rows_0.csv.gz', gzip), ('rows_1.csv.bz2', bz2), ('rows_2.csv.xz', lzma), ('plain.csv.gz', gzip)):
+			with module.open(os.path.join(self.tmp.name, name), 'wb') as fh:
+				fh.write(data)
+		self.xml = b'<?xml version="1.0" encoding="utf-8"?>\n<root><record><id>1</id></record><record><id>2</id></record></root>'
+		with gzip.open(os.path.join(self.tmp.name, 'records.xml.gz'), 'wb') as fh:
+			fh.write(self.xml)
+		self.fs = bonobo.open_fs(self.tmp.name)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_matching_files(self):
+		files = MatchingFiles(path='/', pattern='*.csv', fs='fs.data.test')
+		# compressed files match the pattern, unless the uncompressed file is also present
+		self.assertEqual(list(files(fs=self.fs)), ['plain.csv', 'rows_0.csv.gz', 'rows_1.csv.bz2', 'rows_2.csv.xz'])
+		files = MatchingFiles(path='/', pattern='rows_*.csv', fs='fs.data.test', batch=True, shards=2)
+		self.assertEqual(list(files(fs=self.fs)), [('rows_0.csv.gz', 'rows_1.csv.bz2', 'rows_2.csv.xz')])
+
+	def test_csv(self):
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name', 'x'])
+		for path in ('rows_0.csv.gz', 'rows_1.csv.bz2', 'rows_2.csv.xz'):
+			with self.subTest(path=path):
+				rows = [[d['id'], d['name'], d['x']] for d in reader(path, fs=self.fs)]
+				self.assertEqual(rows, self.rows)
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name', 'x'], processes=2)
+		rows = list(reader(('rows_0.csv.gz', 'rows_2.csv.xz'), fs=self.fs))
+		self.assertEqual(len(rows), 10)
+
+	def test_xml(self):
+		for stream in (True, False):
+			with self.subTest(stream=stream):
+				reader = CurriedXMLReader(xpath='/root/record', fs='fs.data.test', limit=0, stream=stream)
+				ids = [e.findtext('id') for e in reader('records.xml.gz', fs=self.fs)]
+				self.assertEqual(ids, ['1', '2'])
+
+	def test_header_file(self):
+		with open_input(self.fs, 'rows_1.csv', newline='') as fh:
+			self.assertEqual(next(csv.reader(fh)), self.rows[0])
+		# the uncompressed file is used if it is present
+		with open(os.path.join(self.tmp.name, 'rows_1.csv'), 'w') as fh:
+			fh.write('a,b\n')
+		with open_input(self.fs, 'rows_1.csv', newline='') as fh:
+			self.assertEqual(next(csv.reader(fh)), ['a', 'b'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,387 @@
+import io
+import os
+import sys
+import csv
+import copy
+import gzip
+import pickle
+import signal
+import unittest
+import tempfile
+import tracemalloc
+
+import bonobo
+
+from pipeline.io.cache import IngestCache
+from pipeline.io.csv import ByteRange, CSVRowText, CurriedCSVReader, RecordIndex, Row, plan_byte_ranges, record_boundaries
+from pipeline.deadletters import encode_record
+from pipeline.nodes.basic import KeyManagement, PreserveCSVFields
+from pipeline.util import MatchingFiles
+
+class KilledWorkerReader(CurriedCSVReader):
+	def _parse_files(self, paths, queues, k, fs, budget):
+		if k == 1:
+			# e.g. by the OOM killer
+			os.kill(os.getpid(), signal.SIGKILL)
+		super()._parse_files(paths, queues, k, fs, budget)
+
+class ParallelCSVReaderTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.sizes = (7, 0, 23, 1, 12)
+		for n, size in enumerate(self.sizes):
+			with open(os.path.join(self.tmp.name, f'rows_{n}.csv'), 'w', newline='') as fh:
+				w = csv.writer(fh)
+				for i in range(size):
+					w.writerow([f'{n}-{i}', f'Name, "{i}"'])
+		self.fs = bonobo.open_fs(self.tmp.name)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def paths(self, batch):
+		files = MatchingFiles(path='/', pattern='rows_*.csv', fs='fs.data.test', batch=batch)
+		return list(files(fs=self.fs))
+
+	def read(self, limit=0, processes=1, batch=True):
+		reader = CurriedCSVReader(fs='fs.data.test', limit=limit, field_names=['id', 'name'], processes=processes, queue_size=2)
+		reader.batch_size = 3
+		rows = []
+		for path in self.paths(batch):
+			rows.extend(reader(path, fs=self.fs))
+		return rows, reader
+
+	def test_batch(self):
+		paths = self.paths(batch=True)
+		self.assertEqual(paths, [tuple(f'rows_{n}.csv' for n in range(len(self.sizes)))])
+
+	def test_parallel_matches_serial(self):
+		expected, _ = self.read(batch=False)
+		self.assertEqual(len(expected), sum(self.sizes))
+		self.assertEqual(expected[7], {'id': '2-0', 'name': 'Name, "0"'})
+		for processes in (1, 2, 3, 8):
+			with self.subTest(processes=processes):
+				rows, reader = self.read(processes=processes)
+				self.assertEqual(rows, expected)
+				self.assertEqual(reader.count, len(expected))
+
+	def test_parallel_shared_index(self):
+		rows, _ = self.read(processes=3)
+		# the rows are made in this process, around a single field index
+		self.assertTrue(all(isinstance(row, Row) for row in rows))
+		self.assertEqual(len({id(row._index) for row in rows}), 1)
+
+	def test_limit(self):
+		expected, _ = self.read(batch=False)
+		for limit in (1, 5, 7, 8, 30, 100):
+			with self.subTest(limit=limit):
+				rows, reader = self.read(limit=limit, processes=3)
+				self.assertEqual(rows, expected[:limit])
+				self.assertEqual(reader.count, min(limit, len(expected)))
+
+	def test_killed_worker(self):
+		reader = KilledWorkerReader(fs='fs.data.test', limit=0, field_names=['id', 'name'], processes=2)
+		reader.poll_interval = 0.05
+		with self.assertRaisesRegex(RuntimeError, 'rows_1.csv exited with status -9'):
+			list(reader(self.paths(batch=True)[0], fs=self.fs))
+
+	def test_skip_rows(self):
+		expected, _ = self.read(batch=False)
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name'], processes=2)
+		path, = self.paths(batch=True)
+		reader.skip_rows[path] = 10
+		self.assertEqual(list(reader(path, fs=self.fs)), expected[10:])
+
+class ByteRangeTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.rows = []
+		for i in range(200):
+			name = f'Name {i}'
+			if i % 7 == 0:
+				name = f'Name\n"{i}",\nsplit'
+			self.rows.append([str(i), name, 'x' * (i % 13)])
+		with open(os.path.join(self.tmp.name, 'big.csv'), 'w', newline='') as fh:
+			csv.writer(fh).writerows(self.rows)
+		self.fs = bonobo.open_fs(self.tmp.name)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def read(self, path):
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name', 'x'])
+		return [[d['id'], d['name'], d['x']] for d in reader(path, fs=self.fs)]
+
+	def test_record_boundaries(self):
+		data = b'a,"b\nc"\nd,e\n"f""\n",g\n'
+		offsets = list(range(len(data)))
+		for chunk_size in (1, 3, 1024):
+			with self.subTest(chunk_size=chunk_size):
+				boundaries = record_boundaries(io.BytesIO(data), offsets, chunk_size=chunk_size)
+				self.assertEqual(sorted(set(boundaries)), [8, 12, 21])
+				self.assertEqual(boundaries[0], 8)
+				self.assertEqual(boundaries[7], 8)
+				self.assertEqual(boundaries[8], 12)
+				# the newline in the quoted field is not a boundary
+				self.assertEqual(boundaries[12], 21)
+
+	def test_shards(self):
+		size = os.path.getsize(os.path.join(self.tmp.name, 'big.csv'))
+		for shards in (1, 2, 3, 8, 50):
+			with self.subTest(shards=shards):
+				ranges = plan_byte_ranges(self.fs, 'big.csv', shards)
+				self.assertLessEqual(len(ranges), shards)
+				self.assertEqual(ranges[0].start, 0)
+				self.assertEqual(ranges[-1].end, size)
+				for a, b in zip(ranges, ranges[1:]):
+					self.assertEqual(a.end, b.start)
+				if shards > 1:
+					self.assertLess(max(r.end - r.start for r in ranges), 2 * size / shards)
+				rows = []
+				for r in ranges:
+					rows.extend(self.read(r))
+				self.assertEqual(rows, self.rows)
+
+	def test_unaligned_end(self):
+		# a range ends at the end of the record containing its last byte
+		rows = self.read(ByteRange('big.csv', 0, 1))
+		self.assertEqual(rows, self.rows[:1])
+
+	def test_matching_files(self):
+		files = MatchingFiles(path='/', pattern='*.csv', fs='fs.data.test', batch=True, shards=4)
+		paths, = list(files(fs=self.fs))
+		self.assertEqual(len(paths), 4)
+		self.assertTrue(all(isinstance(p, ByteRange) for p in paths))
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name', 'x'], processes=3)
+		rows = [[d['id'], d['name'], d['x']] for d in reader(paths, fs=self.fs)]
+		self.assertEqual(rows, self.rows)
+
+class RowTests(unittest.TestCase):
+	def setUp(self):
+		self.names = ['id', 'name', 'price_1', 'currency_1', 'price_2', 'currency_2', 'note']
+		self.index = {name: i for i, name in enumerate(self.names)}
+		self.values = ['1', 'Name', '10', 'fl', '', '', 'x']
+
+	def row(self):
+		return Row(self.index, list(self.values))
+
+	def test_mapping(self):
+		row = self.row()
+		d = dict(zip(self.names, self.values))
+		self.assertEqual(row, d)
+		self.assertEqual(list(row.items()), list(d.items()))
+		self.assertEqual(len(row), 7)
+		self.assertEqual(row['name'], 'Name')
+		self.assertEqual(row.get('missing', 0), 0)
+		row['extra'] = [1]
+		del row['note']
+		del row['id']
+		self.assertNotIn('note', row)
+		self.assertIn('extra', row)
+		with self.assertRaises(KeyError):
+			row['note']
+		with self.assertRaises(KeyError):
+			del row['note']
+		self.assertIsNone(row.get('note'))
+		self.assertEqual(len(row), 6)
+		self.assertEqual(list(row)[-1], 'extra')
+		row['note'] = 'y'
+		self.assertEqual(row.pop('note'), 'y')
+		self.assertEqual(row.setdefault('id', '2'), '2')
+		self.assertEqual(row, {**row})
+		for other in (row.copy(), copy.deepcopy(row), pickle.loads(pickle.dumps(row))):
+			self.assertEqual(other, row)
+		copied = row.copy()
+		copied['name'] = 'Other'
+		copied['extra'] = None
+		self.assertEqual(row['name'], 'Name')
+		self.assertEqual(row['extra'], [1])
+
+	def test_key_management(self):
+		key_management = KeyManagement(operations=[
+			{
+				'group_repeating': {
+					'prices': {'prefixes': ['price', 'currency']},
+				},
+				'rename': {'name': 'label'},
+				'remove': {'note'},
+			},
+			{
+				'group': {
+					'record': {'properties': ['id', 'label']},
+				},
+			},
+		])
+		preserve = PreserveCSVFields(key='csv', order=self.names)
+		expected = key_management(next(preserve(dict(zip(self.names, self.values)))))
+		self.assertEqual(key_management(next(preserve(self.row()))), expected)
+		self.assertEqual(expected['prices'], [{'price': '10', 'currency': 'fl'}])
+		self.assertEqual(expected['record'], {'id': '1', 'label': 'Name'})
+		self.assertNotIn('price_1', expected)
+
+	def test_memory(self):
+		names = [f'field_{i}' for i in range(200)]
+		index = {name: i for i, name in enumerate(names)}
+		rows = [[str(j) for j in range(200)] for _ in range(100)]
+
+		def allocated(make):
+			tracemalloc.start()
+			before = tracemalloc.get_traced_memory()[0]
+			made = [make(row) for row in rows]
+			size = tracemalloc.get_traced_memory()[0] - before
+			tracemalloc.stop()
+			return size
+
+		dict_size = allocated(lambda row: dict(zip(names, row)))
+		row_size = allocated(lambda row: Row(index, row))
+		self.assertLess(row_size * 10, dict_size)
+
+class CSVRowTextTests(unittest.TestCase):
+	def setUp(self):
+		self.names = [f'field_{i}' for i in range(200)]
+		self.index = {name: i for i, name in enumerate(self.names)}
+
+	def test_preserve(self):
+		data = {'b': '2', 'a': '1'}
+		preserved = next(PreserveCSVFields(key='csv', order=['a', 'b'])(data))['csv']
+		self.assertIsInstance(preserved, CSVRowText)
+		# the text holds the values at the time the fields were preserved
+		data['a'] = 'changed'
+		del data['b']
+		self.assertEqual(str(preserved), 'a: 1\nb: 2\n')
+		self.assertEqual(preserved, 'a: 1\nb: 2\n')
+		self.assertTrue(preserved)
+		self.assertFalse(CSVRowText([], ()))
+
+		row = Row(self.index, [str(i) for i in range(200)])
+		preserved = next(PreserveCSVFields(key='csv', order=self.names + ['missing'])(row))['csv']
+		self.assertTrue(str(preserved).startswith('field_0: 0\nfield_1: 1\n'))
+		self.assertTrue(str(preserved).endswith('field_199: 199\nmissing: \n'))
+
+		encoded = encode_record({'csv': preserved})
+		self.assertEqual(encoded, {'type': 'json', 'value': {'csv': str(preserved)}})
+		self.assertEqual(pickle.loads(pickle.dumps(preserved)), preserved)
+
+	def test_memory(self):
+		row = Row(self.index, [f'value {j}' for j in range(200)])
+		preserved = next(PreserveCSVFields(key='csv', order=self.names)(row))['csv']
+		# the unrendered text only holds references to the values of the row
+		lazy_size = sys.getsizeof(preserved) + sys.getsizeof(preserved._values)
+		self.assertLess(lazy_size * 2, sys.getsizeof(str(preserved)))
+
+class RecordIndexTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.index_path = os.path.join(self.tmp.name, 'index')
+		self.input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(self.input_path)
+		self.rows = []
+		for i in range(100):
+			self.rows.append([f'R{i % 40}', f'Name\n"{i}",\nsplit' if i % 3 == 0 else f'Name {i}'])
+		with open(os.path.join(self.input_path, 'rows.csv'), 'w', newline='') as fh:
+			csv.writer(fh).writerows(self.rows)
+		with gzip.open(os.path.join(self.input_path, 'other.csv.gz'), 'wt', newline='') as fh:
+			csv.writer(fh).writerows(self.rows)
+		self.fs = bonobo.open_fs(self.input_path)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def read(self, path, ids, index_path=None):
+		if index_path is None:
+			index_path = self.index_path
+		reader = CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name'], record_ids=ids, id_field='id', index_path=index_path)
+		return [[d['id'], d['name']] for d in reader(path, fs=self.fs)]
+
+	def test_index(self):
+		index = RecordIndex(self.index_path).offsets(self.fs, 'rows.csv', 0)
+		self.assertEqual(len(index), 40)
+		self.assertEqual(len(index['R3']), 3)
+		self.assertEqual(index['R0'][0], 0)
+		self.assertEqual(len(os.listdir(self.index_path)), 1)
+		with open(os.path.join(self.input_path, 'rows.csv'), 'rb') as fh:
+			data = fh.read()
+		for offset in index['R7']:
+			self.assertTrue(data[offset:].startswith(b'R7,'))
+			self.assertEqual(data[offset - 1:offset], b'\n')
+
+	def test_selected_rows(self):
+		ids = {'R0', 'R7', 'R39', 'missing'}
+		expected = [row for row in self.rows if row[0] in ids]
+		self.assertEqual(len(expected), 8)
+		for path in ('rows.csv', 'other.csv'):
+			for index_path in (self.index_path, ''):
+				with self.subTest(path=path, index_path=index_path):
+					self.assertEqual(self.read(path, ids, index_path), expected)
+		# the compressed file is not indexed
+		self.assertEqual(len(os.listdir(self.index_path)), 1)
+		self.assertEqual(self.read('rows.csv', []), [])
+
+		rows = []
+		for r in plan_byte_ranges(self.fs, 'rows.csv', 3):
+			rows.extend(self.read(r, ids))
+		self.assertEqual(rows, expected)
+
+class IngestCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.cache_path = os.path.join(self.tmp.name, 'cache')
+		self.input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(self.input_path)
+		self.write_rows(25)
+		self.fs = bonobo.open_fs(self.input_path)
+		self.parsed = 0
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def write_rows(self, count):
+		with open(os.path.join(self.input_path, 'rows.csv'), 'w', newline='') as fh:
+			csv.writer(fh).writerows([[str(i), f'Name\n{i}'] for i in range(count)])
+
+	def read(self, limit=0):
+		reader = CurriedCSVReader(fs='fs.data.test', limit=limit, field_names=['id', 'name'], cache_path=self.cache_path)
+		parse = reader.parse
+		def counting_parse(path, fs):
+			self.parsed += 1
+			return parse(path, fs)
+		reader.parse = counting_parse
+		rows = []
+		for row in reader('rows.csv', fs=self.fs):
+			rows.append(dict(row))
+			# modifying the rows does not modify the cache
+			row['id'] = None
+			del row['name']
+		return rows
+
+	def test_cache(self):
+		# a partial read is not cached
+		self.assertEqual(len(self.read(limit=5)), 5)
+		self.assertFalse(os.listdir(self.cache_path))
+
+		expected = self.read()
+		self.assertEqual(len(expected), 25)
+		self.assertEqual(expected[3], {'id': '3', 'name': 'Name\n3'})
+		self.assertEqual(self.parsed, 2)
+		self.assertEqual(len(os.listdir(self.cache_path)), 1)
+
+		self.assertEqual(self.read(), expected)
+		self.assertEqual(self.read(limit=5), expected[:5])
+		self.assertEqual(self.parsed, 2)
+
+		# a changed file is parsed again
+		self.write_rows(30)
+		self.assertEqual(len(self.read()), 30)
+		self.assertEqual(self.parsed, 3)
+		self.assertEqual(len(os.listdir(self.cache_path)), 2)
+
+	def test_batches(self):
+		cache = IngestCache(self.cache_path, batch_size=4)
+		rows = [[str(i)] for i in range(10)]
+		filename = cache.filename('test')
+		self.assertEqual(list(cache.write(filename, iter(rows))), rows)
+		self.assertEqual(list(cache.read(filename)), rows)
+
+
+if __name__ == '__main__':
+	unittest.main()
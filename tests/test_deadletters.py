@@ -0,0 +1,181 @@
+import os
+import json
+import unittest
+import tempfile
+from contextlib import suppress
+
+import bonobo
+
+from pipeline.deadletters import DeadLetterQueue, decode_record, encode_record
+from pipeline.execution import GraphExecutor, IterativeGraphExecutor
+from pipeline.io.csv import ByteRange, CurriedCSVReader
+from pipeline.nodes.basic import KeyManagement, PreserveCSVFields
+
+class DeadLetterTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.tmp.name, 'dead-letters.jsonl')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def build_graph(self, bad, seen):
+		def files():
+			yield 'a.csv'
+			yield 'b.csv'
+
+		def rows(filename):
+			for i in range(3):
+				yield {'file': filename, 'id': i}
+
+		def split(data):
+			yield data['id']
+			yield -data['id']
+
+		def check(value):
+			if value in bad:
+				raise ValueError(f'bad value {value}')
+			seen.append(value)
+
+		g = bonobo.Graph()
+		g.add_chain(files, rows, split, check)
+		return g
+
+	def run_executor(self, cls, bad, entries=None):
+		seen = []
+		queue = DeadLetterQueue(self.filename)
+		queue.start_graph()
+		e = cls(self.build_graph(bad, seen), {}, dead_letters=queue)
+		if entries is None:
+			e.run()
+		else:
+			e.replay(entries)
+		queue.close()
+		return seen, queue
+
+	def test_record(self):
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				_, queue = self.run_executor(cls, bad={1})
+				self.assertEqual(queue.count, 2)
+				with open(self.filename) as fh:
+					records = [json.loads(l) for l in fh]
+				self.assertEqual([r['node'] for r in records], ['check', 'check'])
+				self.assertEqual({r['source_name'] for r in records}, {'rows'})
+				self.assertEqual([r['record']['value'] for r in records], [
+					{'file': 'a.csv', 'id': 1},
+					{'file': 'b.csv', 'id': 1},
+				])
+				self.assertIn('bad value 1', records[0]['error'])
+				self.assertEqual(records[0]['graph'], 1)
+
+	def test_replay(self):
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				self.run_executor(cls, bad={2, -2})
+				entries = DeadLetterQueue.load(self.filename)
+				# each row failed twice, but is only replayed once
+				self.assertEqual(len(entries[1]), 2)
+				seen, queue = self.run_executor(cls, bad={-2}, entries=entries[1])
+				self.assertEqual(seen, [2, 2])
+				self.assertEqual(queue.count, 2)
+				seen, queue = self.run_executor(cls, bad=set(), entries=DeadLetterQueue.load(self.filename)[1])
+				self.assertEqual(seen, [2, -2, 2, -2])
+				self.assertEqual(queue.count, 0)
+
+	def test_encode_batch(self):
+		batch = ('a.csv', ByteRange('b.csv', 10, 20))
+		encoded = json.loads(json.dumps(encode_record(batch)))
+		decoded = decode_record(encoded)
+		self.assertEqual(decoded, batch)
+		self.assertIsInstance(decoded, tuple)
+		self.assertIsInstance(decoded[1], ByteRange)
+
+	def test_replay_batch(self):
+		input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(input_path)
+		with open(os.path.join(input_path, 'a.csv'), 'w') as fh:
+			fh.write('1\n2\n')
+		b = os.path.join(input_path, 'b.csv')
+
+		def batches():
+			yield ('a.csv', ByteRange('b.csv', 0, 4))
+
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				with suppress(FileNotFoundError):
+					os.remove(b)
+				seen = []
+				services = {'fs.data.test': bonobo.open_fs(input_path)}
+				g = bonobo.Graph()
+				g.add_chain(batches, CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id']), lambda data: seen.append(data['id']))
+				queue = DeadLetterQueue(self.filename)
+				queue.start_graph()
+				cls(g, services, dead_letters=queue).run()
+				queue.close()
+				# the second file of the batch is missing
+				self.assertEqual(queue.count, 1)
+				self.assertEqual(seen, ['1', '2'])
+
+				with open(b, 'w') as fh:
+					fh.write('3\n4\n')
+				entries = DeadLetterQueue.load(self.filename)[1]
+				self.assertEqual(entries[0]['record'], ('a.csv', ByteRange('b.csv', 0, 4)))
+				seen.clear()
+				queue = DeadLetterQueue(self.filename)
+				queue.start_graph()
+				cls(g, services, dead_letters=queue).replay(entries)
+				queue.close()
+				self.assertEqual(queue.count, 0)
+				self.assertEqual(seen, ['1', '2', '3', '4'])
+
+	def test_replay_modified_record(self):
+		input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(input_path)
+		with open(os.path.join(input_path, 'a.csv'), 'w') as fh:
+			fh.write('1,A\n2,B\n')
+
+		def files():
+			yield 'a.csv'
+
+		def build_graph(bad, seen):
+			def check(data):
+				if data['_rec']['id'] in bad:
+					raise ValueError(f'bad record {data["_rec"]["id"]}')
+				seen.append((str(data['star']), data['_rec']))
+
+			g = bonobo.Graph()
+			g.add_chain(
+				files,
+				CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name']),
+				# both nodes restructure the row in place
+				PreserveCSVFields(key='star', order=['id', 'name']),
+				KeyManagement(operations=[{'group': {'_rec': {'properties': ['id', 'name']}}}]),
+				check,
+			)
+			return g
+
+		services = {'fs.data.test': bonobo.open_fs(input_path)}
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				seen = []
+				queue = DeadLetterQueue(self.filename)
+				queue.start_graph()
+				cls(build_graph({'1'}, seen), services, dead_letters=queue).run()
+				queue.close()
+				self.assertEqual(seen, [('id: 2\nname: B\n', {'id': '2', 'name': 'B'})])
+
+				entries = DeadLetterQueue.load(self.filename)[1]
+				# the row is recorded as the reader produced it
+				self.assertEqual(entries[0]['record'], {'id': '1', 'name': 'A'})
+				seen.clear()
+				queue = DeadLetterQueue(self.filename)
+				queue.start_graph()
+				cls(build_graph(set(), seen), services, dead_letters=queue).replay(entries)
+				queue.close()
+				self.assertEqual(queue.count, 0)
+				self.assertEqual(seen, [('id: 1\nname: A\n', {'id': '1', 'name': 'A'})])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+from collections import defaultdict
+from functools import partial
+
+import bonobo
+from bonobo.config import Configurable, Option, Service
+from bonobo.constants import NOT_MODIFIED
+
+from pipeline.execution import ExecutionPlan, FusedSegment, GraphExecutor, IterativeGraphExecutor
+
+class Counted(Configurable):
+	counts = Service('counts')
+
+	def __call__(self, data, counts):
+		counts['seen'] += 1
+		return data
+
+class Named(Configurable):
+	store = Service('store')
+	prefix = Option(str, default='')
+
+	def __call__(self, data, store):
+		store.append(self.prefix + data)
+		return data
+
+class ExecutionPlanTests(unittest.TestCase):
+	def build_graph(self, *nodes):
+		def source():
+			yield 'a'
+			yield 'b'
+		g = bonobo.Graph()
+		g.add_chain(source, *nodes)
+		return g
+
+	def test_prebound_services(self):
+		counts = defaultdict(int)
+		store = []
+		g = self.build_graph(Counted(), Named(store='store.runtime', prefix='x-'))
+		plan = ExecutionPlan(g, {'counts': counts, 'store.runtime': store})
+		names = [p.name for p in plan]
+		self.assertEqual(names, ['source', 'Counted', 'Named'])
+		for p in list(plan)[1:]:
+			self.assertIsInstance(p.bound(), partial)
+		self.assertIs(plan[1].bound().keywords['counts'], counts)
+		self.assertIs(plan[2].bound().keywords['store'], store)
+		self.assertEqual(plan.roots, (0,))
+		self.assertEqual(plan[0].outputs, (1,))
+		self.assertEqual(plan[2].outputs, ())
+
+		e = GraphExecutor(g, {'counts': counts, 'store.runtime': store})
+		e.run()
+		self.assertEqual(counts['seen'], 2)
+		self.assertEqual(store, ['x-a', 'x-b'])
+
+	def test_missing_service(self):
+		g = self.build_graph(Named(store='store.missing'))
+		plan = ExecutionPlan(g, {})
+		self.assertEqual(plan[1].missing_service, 'store.missing')
+		with self.assertRaises(KeyError):
+			plan[1].bound()
+		e = GraphExecutor(g, {})
+		e.run()
+		# the error is reported against the source, which stops at the first record
+		self.assertEqual(e.counters_in[1], 1)
+		self.assertEqual(e.counters_out[1], 0)
+
+class FusionTests(unittest.TestCase):
+	def build_graph(self, log):
+		def source():
+			for i in range(4):
+				log.append(('source', i))
+				yield i
+
+		def expand(i):
+			for j in range(2):
+				if (i, j) == (2, 1):
+					raise ValueError('bad expansion')
+				log.append(('expand', i, j))
+				yield (i, j)
+
+		def check(value):
+			log.append(('check', value))
+			if value == (1, 1):
+				raise ValueError('bad value')
+			return NOT_MODIFIED
+
+		def left(value):
+			log.append(('left', value))
+
+		def right(value):
+			log.append(('right', value))
+			return value
+
+		def sink(value):
+			log.append(('sink', value))
+
+		g = bonobo.Graph()
+		values = g.add_chain(source, expand, check)
+		g.add_chain(left, _input=values.output)
+		g.add_chain(right, sink, _input=values.output)
+		return g
+
+	def run_executor(self, cls, **kwargs):
+		log = []
+		e = cls(self.build_graph(log), {}, **kwargs)
+		e.run()
+		return log, e
+
+	def test_segments(self):
+		_, e = self.run_executor(GraphExecutor, fuse=True)
+		names = {p.name for p in e.plan}
+		self.assertEqual(names, {'source+expand+check', 'left', 'right+sink'})
+		head = e.plan[0]
+		self.assertIsInstance(head.call, FusedSegment)
+		self.assertEqual(len(head.outputs), 2)
+		self.assertEqual(e.counters_in[0], 1)
+		self.assertEqual(e.counters_out[0], 6)
+
+	def test_fused_matches_unfused(self):
+		expected, _ = self.run_executor(GraphExecutor)
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				log, _ = self.run_executor(cls, fuse=True)
+				self.assertEqual(log, expected)
+		self.assertIn(('sink', (1, 0)), expected)
+		self.assertNotIn(('sink', (1, 1)), expected)
+		self.assertNotIn(('expand', 2, 1), expected)
+
+
+if __name__ == '__main__':
+	unittest.main()
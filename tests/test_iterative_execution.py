@@ -0,0 +1,59 @@
+import unittest
+
+import bonobo
+
+from pipeline.execution import GraphExecutor, IterativeGraphExecutor
+
+class IterativeGraphExecutorTests(unittest.TestCase):
+	def build_graph(self, log):
+		def source():
+			for i in range(5):
+				log.append(('source', i))
+				yield i
+
+		def expand(i):
+			for j in range(2):
+				log.append(('expand', i, j))
+				yield (i, j)
+
+		def check(value):
+			log.append(('check', value))
+			if value == (3, 1):
+				raise ValueError('bad value')
+			return value
+
+		def sink(value):
+			log.append(('sink', value))
+
+		g = bonobo.Graph()
+		values = g.add_chain(source, expand)
+		g.add_chain(check, sink, _input=values.output)
+		return g
+
+	def run_executor(self, cls, **kwargs):
+		log = []
+		e = cls(self.build_graph(log), {}, **kwargs)
+		e.run()
+		return log, e
+
+	def test_same_order_as_recursive_executor(self):
+		expected, recursive = self.run_executor(GraphExecutor)
+		log, iterative = self.run_executor(IterativeGraphExecutor, queue_size=1)
+		self.assertEqual(log, expected)
+		self.assertEqual(dict(iterative.counters_in), dict(recursive.counters_in))
+		self.assertEqual(dict(iterative.counters_out), dict(recursive.counters_out))
+		self.assertEqual(set(iterative.timers), set(recursive.timers))
+
+	def test_bounded_queue(self):
+		expected, _ = self.run_executor(GraphExecutor)
+		log, e = self.run_executor(IterativeGraphExecutor, queue_size=3)
+		self.assertEqual(sorted(log), sorted(expected))
+		# three values are pulled from the source before any of them is expanded
+		self.assertEqual(log[:4], [('source', 0), ('source', 1), ('source', 2), ('expand', 0, 0)])
+		sinks = [entry[1] for entry in log if entry[0] == 'sink']
+		self.assertEqual(len(sinks), 9)
+		self.assertNotIn((3, 1), sinks)
+
+
+if __name__ == '__main__':
+	unittest.main()
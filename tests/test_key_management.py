@@ -0,0 +1,82 @@
+import unittest
+
+from pipeline.io.csv import Row
+from pipeline.nodes.basic import KeyManagement
+
+class KeyManagementTests(unittest.TestCase):
+	def setUp(self):
+		self.names = ['id', 'name', 'note', 'price_1', 'currency_1', 'price_2', 'currency_2', 'price_3', 'seller_1', 'seller_3', 'x']
+		self.operations = [
+			{
+				'remove': {'x', 'missing'},
+				'rename': {'name': 'label', 'missing': 'other'},
+			},
+			{
+				'group_repeating': {
+					'prices': {
+						'prefixes': ['price', 'currency'],
+						'rename_keys': {'currency': 'cur'},
+						'postprocess': lambda d, p: {**d, 'id': p['id']},
+					},
+					# seller_2 is not a field, so seller_3 is not grouped
+					'sellers': {'prefixes': ['seller']},
+				},
+				'group': {
+					'record': {'properties': ['id', 'label', 'missing'], 'rename_keys': {'label': 'name'}},
+				},
+			},
+		]
+
+	def rows(self):
+		values = [
+			['1', 'A', 'n', '10', 'fl', '', '', '30', 'S1', 'S3', 'x'],
+			['2', '', '', '', '', '20', 'gns', '', '', '', ''],
+		]
+		return [dict(zip(self.names, v)) for v in values]
+
+	def test_operations(self):
+		expected = [
+			{
+				'note': 'n',
+				'seller_3': 'S3',
+				# price_3 is grouped, although currency_3 is not a field
+				'prices': [{'price': '10', 'cur': 'fl', 'id': '1'}, {'price': '30', 'id': '1'}],
+				'sellers': [{'seller': 'S1'}],
+				'record': {'id': '1', 'name': 'A'},
+			},
+			{
+				'note': '',
+				'seller_3': '',
+				'prices': [{'price': '20', 'cur': 'gns', 'id': '2'}],
+				'sellers': [],
+				'record': {'id': '2'},
+			},
+		]
+		for field_names in (None, self.names):
+			with self.subTest(field_names=field_names):
+				km = KeyManagement(operations=self.operations, field_names=field_names)
+				self.assertEqual([km(row) for row in self.rows()], expected)
+
+	def test_plans(self):
+		km = KeyManagement(operations=self.operations)
+		for row in self.rows():
+			km(row)
+		self.assertEqual(len(km.plans), 1)
+		km({'id': '3', 'name': 'C', 'price_1': '5', 'currency_1': 'fl'})
+		self.assertEqual(len(km.plans), 2)
+
+		km = KeyManagement(operations=self.operations, field_names=self.names)
+		index = {name: i for i, name in enumerate(self.names)}
+		for row in self.rows():
+			self.assertEqual(km(Row(index, list(row.values()))), KeyManagement(operations=self.operations)(row))
+		self.assertFalse(km.plans)
+		self.assertIsNotNone(km.plan)
+
+	def test_unrecognized_operator(self):
+		km = KeyManagement(operations=[{'unknown': {}}])
+		with self.assertWarns(UserWarning):
+			self.assertEqual(km({'a': 1}), {'a': 1})
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,187 @@
+import os
+import json
+import unittest
+import tempfile
+from unittest import mock
+
+from cromulent import model, vocab
+
+from pipeline.io.file import MergingFileWriter, filename_for, partition_for
+from pipeline.io.memory import MergeStore, MergingMemoryWriter
+from pipeline.io.sort import RunStore
+from pipeline.linkedart import add_crom_data
+
+class MergeStoreTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.store = MergeStore('person')
+		self.writers = [MergingMemoryWriter(directory=self.tmp.name, model='person', store=self.store) for _ in range(3)]
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def write(self, writer, ident, **properties):
+		p = vocab.Person(ident=f'urn:{ident}', label=properties.get('label'))
+		if properties.get('born'):
+			p.born = model.Birth()
+		writer(add_crom_data(data={}, what=p))
+
+	def files(self):
+		files = []
+		for path, _, filenames in os.walk(os.path.join(self.tmp.name, 'person')):
+			files.extend(os.path.join(path, f) for f in filenames)
+		return files
+
+	def test_shared(self):
+		a, b, c = self.writers
+		self.write(a, 'p1', label='Greg')
+		self.write(b, 'p1', born=True)
+		self.write(c, 'p2', label='Other')
+		self.assertIs(a.data, b.data)
+		self.assertEqual(len(self.store), 2)
+		self.assertEqual(a.counter['collision'], 1)
+		self.assertEqual(c.counter['total'], 3)
+
+		with mock.patch.object(MergingFileWriter, 'merge', autospec=True, side_effect=MergingFileWriter.merge) as merge:
+			for w in self.writers:
+				w.flush(verbose=False)
+			# each object is written once, without being merged with a file on disk
+			merge.assert_not_called()
+		objects = {}
+		for filename in self.files():
+			with open(filename) as fh:
+				j = json.load(fh)
+			objects[j['id'].rsplit('/', 1)[-1]] = j
+		self.assertEqual(len(self.files()), 2)
+		self.assertEqual(objects['urn:p1'].get('_label'), 'Greg')
+		self.assertIsInstance(objects['urn:p1'].get('born'), dict)
+		self.assertEqual(len(self.store), 0)
+
+	def test_parallel_flush(self):
+		outputs = []
+		for processes in (1, 4):
+			directory = os.path.join(self.tmp.name, str(processes))
+			os.mkdir(directory)
+			writer = MergingMemoryWriter(directory=directory, model='person', partition_directories=True, flush_processes=processes)
+			for i in range(60):
+				self.write(writer, f'p{i}', label=f'Person {i}')
+				self.write(writer, f'p{i % 7}', born=True)
+			writer.flush(verbose=False)
+			self.assertEqual(len(writer.data), 0)
+			output = {}
+			for path, _, filenames in os.walk(os.path.join(directory, 'person')):
+				for filename in filenames:
+					with open(os.path.join(path, filename)) as fh:
+						j = json.load(fh)
+					# the identifiers of the birth events are random
+					j.get('born', {}).pop('id', None)
+					output[os.path.join(os.path.basename(path), filename)] = j
+			outputs.append(output)
+		serial, parallel = outputs
+		self.assertEqual(len(serial), 60)
+		self.assertEqual(parallel, serial)
+
+	def test_partition_for(self):
+		for i in range(20):
+			p = vocab.Person(ident=f'urn:p{i}')
+			_, partition = filename_for(add_crom_data(data={}, what=p))
+			self.assertEqual(partition_for(p.id), partition)
+
+	def test_own_store(self):
+		a = MergingMemoryWriter(directory=self.tmp.name, model='person')
+		b = MergingMemoryWriter(directory=self.tmp.name, model='person')
+		self.write(a, 'p1')
+		self.assertEqual(len(a.data), 1)
+		self.assertEqual(len(b.data), 0)
+		a.data = {}
+		self.assertEqual(len(a.store), 0)
+
+class SpillTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def fill(self, store):
+		for i in range(40):
+			for j in range(3):
+				# parts of the same object, added far apart
+				k = (i * 7 + j * 13) % 40
+				p = vocab.Person(ident=f'urn:p{k}', label=f'Person {k}')
+				p.identified_by = vocab.PrimaryName(content=f'Name {k}-{j}')
+				store.add(p)
+		return store
+
+	def summary(self, items):
+		return [(k, o._label, sorted(n.content for n in o.identified_by)) for k, o in items]
+
+	def test_items(self):
+		expected = self.summary(self.fill(MergeStore('person')).items())
+		self.assertEqual(len(expected), 40)
+		self.assertEqual(expected[0][2], ['Name 0-0', 'Name 0-1', 'Name 0-2'])
+
+		spill_path = os.path.join(self.tmp.name, 'spill')
+		store = self.fill(MergeStore('person', limit=5, spill_path=spill_path))
+		self.assertLessEqual(len(store.data), 5)
+		self.assertGreater(len(store.runs), 3)
+		self.assertEqual(store.count(), store.counter['spilled'] + len(store.data))
+		self.assertEqual(self.summary(store.items()), expected)
+
+		store.clear()
+		self.assertEqual(os.listdir(spill_path), [])
+		self.assertEqual(list(store.items()), [])
+
+	def test_flush(self):
+		writer = MergingMemoryWriter(directory=self.tmp.name, model='person', limit=4, flush_processes=2)
+		for i in range(20):
+			p = vocab.Person(ident=f'urn:p{i % 10}')
+			p.identified_by = vocab.PrimaryName(content=f'Name {i}')
+			writer(add_crom_data(data={}, what=p))
+		self.assertTrue(writer.store.runs)
+		writer.flush(verbose=False)
+		names = {}
+		for filename in os.listdir(os.path.join(self.tmp.name, 'person')):
+			with open(os.path.join(self.tmp.name, 'person', filename)) as fh:
+				j = json.load(fh)
+			names[j['id'].rsplit('/', 1)[-1]] = sorted(n['content'] for n in j['identified_by'])
+		self.assertEqual(len(names), 10)
+		self.assertEqual(names['urn:p3'], ['Name 13', 'Name 3'])
+		self.assertFalse(writer.store.runs)
+
+class RunStoreTests(SpillTests):
+	def test_items(self):
+		expected = self.summary(self.fill(MergeStore('person')).items())
+
+		spill_path = os.path.join(self.tmp.name, 'spill')
+		store = self.fill(RunStore('person', path=spill_path, run_size=7))
+		self.assertEqual(len(store.data), 0)
+		self.assertEqual(len(store.runs), 18)
+		self.assertEqual(store.count(), 120)
+		self.assertEqual(self.summary(store.items()), expected)
+
+		store.clear()
+		self.assertEqual(os.listdir(spill_path), [])
+		self.assertEqual(list(store.items()), [])
+
+	def test_flush(self):
+		store = RunStore('person', path=os.path.join(self.tmp.name, 'spill'), run_size=4)
+		writers = [MergingMemoryWriter(directory=self.tmp.name, model='person', store=store, flush_processes=2) for _ in range(2)]
+		for i in range(20):
+			p = vocab.Person(ident=f'urn:p{i % 10}')
+			p.identified_by = vocab.PrimaryName(content=f'Name {i}')
+			writers[i % 2](add_crom_data(data={}, what=p))
+		for w in writers:
+			w.flush(verbose=False)
+		names = {}
+		for filename in os.listdir(os.path.join(self.tmp.name, 'person')):
+			with open(os.path.join(self.tmp.name, 'person', filename)) as fh:
+				j = json.load(fh)
+			names[j['id'].rsplit('/', 1)[-1]] = sorted(n['content'] for n in j['identified_by'])
+		self.assertEqual(len(names), 10)
+		self.assertEqual(names['urn:p3'], ['Name 13', 'Name 3'])
+		self.assertFalse(store.runs)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import pstats
+import unittest
+import tempfile
+
+import bonobo
+from cromulent import vocab
+
+from pipeline.execution import GraphExecutor, IterativeGraphExecutor
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.linkedart import add_crom_data
+from pipeline.metrics import LatencyHistogram, MemoryTracker, MetricsWriter, NodeProfiler
+
+class LatencyHistogramTests(unittest.TestCase):
+	def test_percentiles(self):
+		h = LatencyHistogram()
+		for i in range(1, 101):
+			h.add(i / 1000.0)
+		self.assertEqual(h.count, 100)
+		self.assertAlmostEqual(h.total, 5.05)
+		for q, expected in ((50, 0.050), (95, 0.095), (99, 0.099)):
+			value = h.percentile(q)
+			self.assertGreaterEqual(value, expected)
+			self.assertLess(value, expected * LatencyHistogram.BASE)
+
+	def test_merge(self):
+		a = LatencyHistogram()
+		b = LatencyHistogram()
+		a.add(0.001)
+		b.add(1.0)
+		b.add(1.0)
+		a.merge(b)
+		self.assertEqual(a.count, 3)
+		self.assertGreaterEqual(a.percentile(50), 1.0)
+		self.assertLess(a.percentile(10), 0.01)
+
+class ExecutorMetricsTests(unittest.TestCase):
+	def build_graph(self):
+		def source():
+			for i in range(4):
+				yield i
+
+		def double(i):
+			yield i
+			yield i
+
+		def sink(value):
+			pass
+
+		g = bonobo.Graph()
+		g.add_chain(source, double, sink)
+		return g
+
+	def test_node_metrics(self):
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				e = cls(self.build_graph(), {})
+				e.run()
+				metrics = {m['name']: m for m in e.metrics()}
+				self.assertEqual(set(metrics), {'source', 'double', 'sink'})
+				self.assertEqual(metrics['double']['calls'], 4)
+				self.assertEqual(metrics['double']['in'], 4)
+				self.assertEqual(metrics['double']['out'], 8)
+				self.assertEqual(metrics['sink']['in'], 8)
+				self.assertEqual(metrics['sink']['latency'].count, 8)
+				self.assertGreaterEqual(metrics['source']['inclusive_time'], metrics['double']['inclusive_time'])
+
+	def test_generator_self_time(self):
+		def source():
+			for i in range(3):
+				time.sleep(0.02)
+				yield i
+
+		def slow(i):
+			time.sleep(0.01)
+			return i
+
+		def sink(value):
+			pass
+
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__):
+				g = bonobo.Graph()
+				g.add_chain(source, slow, sink)
+				e = cls(g, {})
+				e.run()
+				metrics = {m['name']: m for m in e.metrics()}
+				# the time spent producing values is attributed to the generator node,
+				# not to the nodes processing them
+				self.assertGreaterEqual(metrics['source']['self_time'], 0.06)
+				self.assertLess(metrics['source']['self_time'], 0.085)
+				self.assertGreaterEqual(metrics['slow']['self_time'], 0.03)
+				self.assertLess(metrics['slow']['self_time'], 0.055)
+				self.assertLess(metrics['sink']['self_time'], 0.01)
+				self.assertGreaterEqual(metrics['source']['inclusive_time'], 0.09)
+				self.assertGreaterEqual(metrics['slow']['inclusive_time'], metrics['slow']['self_time'])
+				self.assertEqual(metrics['slow']['latency'].count, 3)
+				self.assertGreaterEqual(metrics['slow']['latency'].percentile(50), 0.01)
+
+	def test_export(self):
+		e = GraphExecutor(self.build_graph(), {})
+		e.run()
+		with tempfile.TemporaryDirectory() as path:
+			w = MetricsWriter(path)
+			w.write(e.metrics(), 1.5)
+			w.write(e.metrics(), 2.0, final=True)
+			with open(os.path.join(path, 'pipeline.metrics.jsonl')) as fh:
+				records = [json.loads(l) for l in fh]
+			with open(os.path.join(path, 'pipeline.metrics.prom')) as fh:
+				prometheus = fh.read()
+		self.assertEqual(len(records), 6)
+		final = {r['name']: r for r in records if r['final']}
+		self.assertEqual(final['sink']['in'], 8)
+		self.assertEqual(final['sink']['elapsed'], 2.0)
+		self.assertIn('p95', final['sink'])
+		self.assertIn('pipeline_node_out_total{node="double",index="1"} 8', prometheus)
+		self.assertIn('# TYPE pipeline_node_latency_seconds summary', prometheus)
+		self.assertIn('pipeline_node_latency_seconds_count{node="sink",index="2"} 8', prometheus)
+		self.assertIn('quantile="0.99"', prometheus)
+
+	def test_truncate_once(self):
+		e = GraphExecutor(self.build_graph(), {})
+		e.run()
+		with tempfile.TemporaryDirectory() as path:
+			filename = os.path.join(path, 'pipeline.metrics.jsonl')
+			with open(filename, 'w') as fh:
+				print('{"name": "stale"}', file=fh)
+			# a run starts
+			MetricsWriter(path).write(e.metrics(), 1.0)
+			# the next graph of the run
+			MetricsWriter(path).write(e.metrics(), 2.0, final=True)
+			with open(filename) as fh:
+				records = [json.loads(l) for l in fh]
+		self.assertEqual(len(records), 6)
+		self.assertNotIn('stale', {r['name'] for r in records})
+
+	def test_missing_directory(self):
+		w = MetricsWriter('/nonexistent/metrics/path')
+		self.assertFalse(w.enabled)
+		w.write([], 0.0)
+
+def produce_value(i):
+	return i
+
+def check_value(i):
+	return i
+
+class NodeProfilerTests(unittest.TestCase):
+	def build_graph(self):
+		def source():
+			for i in range(10):
+				yield produce_value(i)
+
+		def check(i):
+			return check_value(i)
+
+		g = bonobo.Graph()
+		g.add_chain(source, check)
+		return g
+
+	def profiled_calls(self, filename):
+		stats = pstats.Stats(filename).stats
+		return {func[2]: data[1] for func, data in stats.items()}
+
+	def test_profile_nodes(self):
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__), tempfile.TemporaryDirectory() as path:
+				profiler = NodeProfiler(['check'], path, sample_rate=0.5)
+				e = cls(self.build_graph(), {}, profiler=profiler)
+				e.run()
+				self.assertEqual(os.listdir(path), ['1-check.prof'])
+				calls = self.profiled_calls(os.path.join(path, '1-check.prof'))
+				self.assertEqual(calls['check_value'], 5)
+				self.assertNotIn('produce_value', calls)
+
+	def test_profile_fused_nodes(self):
+		def source():
+			yield from range(10)
+
+		def double(i):
+			return 2 * i
+
+		g = bonobo.Graph()
+		g.add_chain(source, produce_value, double, check_value, double)
+		for cls in (GraphExecutor, IterativeGraphExecutor):
+			with self.subTest(cls=cls.__name__), tempfile.TemporaryDirectory() as path:
+				profiler = NodeProfiler(['check_value'], path, sample_rate=1)
+				e = cls(g, {}, fuse=True, profiler=profiler)
+				e.run()
+				# the profiled node is not fused with its neighbours
+				self.assertEqual(os.listdir(path), ['3-check_value.prof'])
+				self.assertIn('check_value', {p.name for p in e.plan})
+
+	def test_profile_generator(self):
+		with tempfile.TemporaryDirectory() as path:
+			profiler = NodeProfiler(['*'], path, sample_rate=1)
+			e = GraphExecutor(self.build_graph(), {}, profiler=profiler)
+			e.run()
+			self.assertEqual(sorted(os.listdir(path)), ['0-source.prof', '1-check.prof'])
+			source_calls = self.profiled_calls(os.path.join(path, '0-source.prof'))
+			self.assertEqual(source_calls['produce_value'], 10)
+			self.assertNotIn('check_value', source_calls)
+			self.assertEqual(self.profiled_calls(os.path.join(path, '1-check.prof'))['check_value'], 10)
+
+class MemoryTrackerTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.tracker = MemoryTracker(self.tmp.name, interval=0)
+
+	def tearDown(self):
+		self.tracker.stop()
+		self.tmp.cleanup()
+
+	def test_report(self):
+		held = []
+		writer = MergingMemoryWriter(directory=self.tmp.name, model='person')
+
+		def source():
+			for i in range(20):
+				yield i
+
+		def hoard(i):
+			held.append(bytearray(100000))
+			return i
+
+		def make_person(i):
+			p = vocab.Person(ident=f'urn:person:{i}', label=f'Person {i}')
+			p.identified_by = vocab.PrimaryName(ident='', content=f'Name {i}')
+			return add_crom_data(data={}, what=p)
+
+		g = bonobo.Graph()
+		g.add_chain(source, hoard, make_person, writer)
+		e = GraphExecutor(g, {}, memory=self.tracker)
+		e.run()
+		filename = self.tracker.report(label='test', writers=[writer])
+		with open(filename) as fh:
+			report = json.load(fh)
+		self.assertEqual(os.path.basename(filename), 'memory.1.json')
+		self.assertEqual(report['label'], 'test')
+		growth = report['node_growth_bytes']
+		self.assertGreaterEqual(growth['hoard'], 2000000)
+		self.assertLess(growth['source'], 100000)
+		self.assertTrue(report['top_allocations'])
+		writers = report['writers']
+		self.assertEqual(len(writers), 1)
+		self.assertEqual(writers[0]['model'], 'person')
+		self.assertEqual(writers[0]['objects'], 20)
+		self.assertGreater(writers[0]['approximate_bytes'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+	def test_nodes_are_not_fused(self):
+		g = bonobo.Graph()
+		g.add_chain(produce_value, check_value, produce_value)
+		e = GraphExecutor(g, {}, fuse=True, memory=self.tracker)
+		self.assertEqual([p.name for p in e.plan], ['produce_value', 'check_value', 'produce_value'])
+
+	def test_interval_reports(self):
+		self.tracker.interval = 0.01
+		self.tracker.next_snapshot_time = time.time() + self.tracker.interval
+		held = []
+		self.tracker.switch((None, None, 'hoard'))
+		held.append(bytearray(1000000))
+		time.sleep(0.02)
+		self.tracker.tick()
+		self.tracker.tick()
+		self.assertEqual(self.tracker.reports, 1)
+		with open(os.path.join(self.tmp.name, 'memory.1.json')) as fh:
+			report = json.load(fh)
+		self.assertEqual(report['label'], 'interval')
+		self.assertGreaterEqual(report['node_growth_bytes']['hoard'], 1000000)
+		self.assertEqual(report['writers'], [])
+
+		held.append(bytearray(2000000))
+		time.sleep(0.02)
+		self.tracker.tick()
+		self.assertEqual(self.tracker.reports, 2)
+		with open(os.path.join(self.tmp.name, 'memory.2.json')) as fh:
+			report = json.load(fh)
+		# allocations are compared with the previous interval's snapshot
+		growth = max(a['bytes_growth'] for a in report['top_allocations'])
+		self.assertGreaterEqual(growth, 2000000)
+		self.assertLess(growth, 3000000)
@@ -0,0 +1,128 @@
+import os
+import json
+import unittest
+import tempfile
+
+from cromulent import vocab
+
+from pipeline.io.file import MergingFileWriter
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.io.segments import SegmentIndex, SegmentWriter
+from pipeline.linkedart import add_crom_data
+
+class SegmentTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def person(self, i, **properties):
+		p = vocab.Person(ident=f'urn:p{i}', label=properties.get('label'))
+		if properties.get('name'):
+			p.identified_by = vocab.PrimaryName(content=properties['name'])
+		return add_crom_data(data={}, what=p)
+
+	def objects(self, index):
+		objects = {}
+		for _, content in index.items():
+			j = json.loads(content)
+			objects[j['_label']] = j
+		return objects
+
+	def read_files(self, directory):
+		files = {}
+		for path, _, filenames in os.walk(directory):
+			for filename in filenames:
+				if not filename.endswith('.json'):
+					# e.g. segments exported to the same directory
+					continue
+				with open(os.path.join(path, filename)) as fh:
+					j = json.load(fh)
+				# the identifiers of the names are random
+				for name in j.get('identified_by', []):
+					name.pop('id', None)
+				files[os.path.join(os.path.basename(path), filename)] = j
+		return files
+
+	def test_merge(self):
+		writer = SegmentWriter(directory=self.tmp.name, model='person', segment_size=200)
+		for i in range(10):
+			writer(self.person(i, label=f'Person {i}'))
+		writer(self.person(3, name='Name 3'))
+		# unchanged objects are not written again
+		writer(self.person(4, label='Person 4'))
+		writer.close()
+
+		index = SegmentIndex(os.path.join(self.tmp.name, 'person'))
+		self.assertGreater(len(index.segments()), 1)
+		entries = index.entries()
+		self.assertEqual(len(entries), 10)
+		objects = self.objects(index)
+		self.assertEqual(objects['Person 3']['identified_by'][0]['content'], 'Name 3')
+		lines = 0
+		for name in index.segments():
+			with open(os.path.join(index.path, name + SegmentIndex.SEGMENT), 'rb') as fh:
+				lines += sum(1 for _ in fh)
+		self.assertEqual(lines, 11)
+
+		# a new writer merges with the segments already written
+		writer = SegmentWriter(directory=self.tmp.name, model='person')
+		writer(self.person(5, name='Name 5'))
+		writer.close()
+		self.assertEqual(index.entries().keys(), entries.keys())
+		objects = self.objects(index)
+		self.assertEqual(objects['Person 5']['identified_by'][0]['content'], 'Name 5')
+		self.assertEqual(objects['Person 3']['identified_by'][0]['content'], 'Name 3')
+
+	def test_export(self):
+		files = os.path.join(self.tmp.name, 'files')
+		segments = os.path.join(self.tmp.name, 'segments')
+		for directory, output_format in ((files, 'files'), (segments, 'segments')):
+			os.mkdir(directory)
+			writer = MergingMemoryWriter(directory=directory, model='person', partition_directories=True, output_format=output_format, flush_processes=2)
+			for i in range(30):
+				writer(self.person(i, label=f'Person {i}'))
+				writer(self.person(i % 4, name=f'Name {i}'))
+			writer.flush(verbose=False)
+
+		exported = os.path.join(self.tmp.name, 'exported')
+		count = SegmentIndex(os.path.join(segments, 'person')).export(os.path.join(exported, 'person'))
+		self.assertEqual(count, 30)
+		expected = self.read_files(os.path.join(files, 'person'))
+		self.assertEqual(len(expected), 30)
+		self.assertEqual(self.read_files(os.path.join(exported, 'person')), expected)
+
+	def test_merge_unseen_versions(self):
+		first = SegmentWriter(directory=self.tmp.name, model='person')
+		second = SegmentWriter(directory=self.tmp.name, model='person')
+		first(self.person(1, label='Person 1'))
+		# neither writer sees the segment of the other until it is closed
+		second(self.person(1, name='Name 1'))
+		first.close()
+		second.close()
+		index = SegmentIndex(os.path.join(self.tmp.name, 'person'))
+		self.assertEqual([len(versions) for versions in index.versions().values()], [2])
+		person = self.objects(index)['Person 1']
+		self.assertEqual(person['identified_by'][0]['content'], 'Name 1')
+
+	def test_export_merges_files(self):
+		directory = os.path.join(self.tmp.name, 'output')
+		os.mkdir(directory)
+		writer = MergingFileWriter(directory=directory, model='person', partition_directories=True)
+		writer(self.person(1, name='Name 1'))
+		writer = MergingMemoryWriter(directory=directory, model='person', partition_directories=True, output_format='segments')
+		writer(self.person(1, label='Person 1'))
+		writer.flush(verbose=False)
+
+		path = os.path.join(directory, 'person')
+		self.assertEqual(SegmentIndex(path).export(path), 1)
+		files = self.read_files(path)
+		self.assertEqual(len(files), 1)
+		person = next(iter(files.values()))
+		self.assertEqual(person['_label'], 'Person 1')
+		self.assertEqual(person['identified_by'][0]['content'], 'Name 1')
+
+
+if __name__ == '__main__':
+	unittest.main()
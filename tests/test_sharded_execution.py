@@ -0,0 +1,230 @@
+import os
+import csv
+import unittest
+import tempfile
+from collections import defaultdict
+
+from bonobo.config import Configurable, Service
+
+import bonobo
+from cromulent import model, vocab
+from cromulent.model import factory
+
+from pipeline.deadletters import DeadLetterQueue
+from pipeline.execution import GraphExecutor, ShardedGraphExecutor, merge_state, state_conflicts, state_delta
+from pipeline.io.csv import CurriedCSVReader
+from pipeline.io.file import MergingFileWriter
+from pipeline.io.memory import MergingMemoryWriter
+from pipeline.linkedart import add_crom_data
+from pipeline.util import MatchingFiles
+
+class CountRows(Configurable):
+	counts = Service('counts')
+
+	def __call__(self, data, counts):
+		counts['rows'] += 1
+		return data
+
+class CountExtra(Configurable):
+	counts = Service('counts')
+
+	def __call__(self, data, counts):
+		counts['extra'] += 1
+		return data
+
+class RecordIds(Configurable):
+	seen = Service('seen')
+
+	def __call__(self, data, seen):
+		seen.add(data['id'])
+		return data
+
+class FirstKind(Configurable):
+	'''The kind of the first row of each group wins (as with the `non_auctions` map of the sales pipeline).'''
+	kinds = Service('kinds')
+	results = Service('results')
+
+	def __call__(self, data, kinds, results):
+		if data['group'] not in kinds:
+			kinds[data['group']] = data['kind']
+		results.append((data['id'], kinds[data['group']]))
+		return data
+
+def fail_on_bad_rows(data):
+	if data['id'] in ('3', '20'):
+		raise ValueError(f'bad row {data["id"]}')
+	return data
+
+def extra_rows():
+	for i in range(5):
+		yield {'id': f'x{i}'}
+
+def make_person(data):
+	p = vocab.Person(ident=f'urn:person:{data["group"]}', label=data['group'])
+	p.identified_by = vocab.PrimaryName(ident='', content=data['name'])
+	p.referred_to_by = vocab.Note(ident='', content=f'row {data["id"]}')
+	return add_crom_data(data={'uri': p.id}, what=p)
+
+class ShardedGraphExecutorTests(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.input_path = os.path.join(self.tmp.name, 'input')
+		os.mkdir(self.input_path)
+		with open(os.path.join(self.input_path, 'rows_1.csv'), 'w', newline='') as fh:
+			w = csv.writer(fh)
+			for i in range(25):
+				w.writerow([str(i), f'Name {i}', f'g{i % 7}'])
+
+		self.shared_state = None
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def run_graph(self, name, processes, fuse=False, limit=0):
+		output_path = os.path.join(self.tmp.name, name)
+		os.mkdir(output_path)
+		memory_writer = MergingMemoryWriter(directory=output_path, model='memory', compact=False)
+		file_writer = MergingFileWriter(directory=output_path, model='file', compact=False)
+		g = bonobo.Graph()
+		people = g.add_chain(
+			MatchingFiles(path='/', pattern='rows_*.csv', fs='fs.data.test'),
+			CurriedCSVReader(fs='fs.data.test', limit=limit, field_names=['id', 'name', 'group']),
+			CountRows(),
+			RecordIds(),
+			make_person,
+		)
+		g.add_chain(memory_writer, _input=people.output)
+		g.add_chain(file_writer, _input=people.output)
+		# a root that does not lead to a reader
+		g.add_chain(extra_rows, CountExtra())
+		services = {
+			'fs.data.test': bonobo.open_fs(self.input_path),
+			'counts': defaultdict(int),
+			'seen': set(),
+		}
+		self.services = services
+		if processes > 1:
+			e = ShardedGraphExecutor(g, services, processes=processes, shared_state=self.shared_state or {'counts': services['counts'], 'seen': services['seen']})
+		else:
+			e = GraphExecutor(g, services)
+		e.run()
+		self.metrics = {m['name']: (m['calls'], m['in'], m['out']) for m in e.metrics()}
+
+		memory = {k: factory.toString(v, False) for k, v in memory_writer.data.items()}
+		files = {}
+		file_path = os.path.join(output_path, 'file')
+		for f in sorted(os.listdir(file_path)):
+			with open(os.path.join(file_path, f)) as fh:
+				files[f] = fh.read()
+		return memory, files, services['counts']
+
+	def test_sharded_output_matches_serial(self):
+		serial_memory, serial_files, serial_counts = self.run_graph('serial', 1)
+		serial_metrics = self.metrics
+		sharded_memory, sharded_files, sharded_counts = self.run_graph('sharded', 3)
+		# the input file is found once, and each worker reads its own part of it
+		self.assertEqual(self.metrics.pop('CurriedCSVReader')[1], 3)
+		serial_metrics.pop('CurriedCSVReader')
+		self.assertEqual(self.metrics, serial_metrics)
+		self.assertEqual(len(serial_memory), 7)
+		self.assertEqual(sharded_memory, serial_memory)
+		self.assertEqual(sharded_files, serial_files)
+		self.assertEqual(serial_counts['rows'], 25)
+		self.assertEqual(sharded_counts['rows'], 25)
+		# the root that does not lead to a reader is run once
+		self.assertEqual(sharded_counts['extra'], 5)
+		self.assertEqual(len(self.services['seen']), 25)
+
+	def test_sharded_limit(self):
+		serial_memory, serial_files, serial_counts = self.run_graph('serial', 1, limit=11)
+		sharded_memory, sharded_files, sharded_counts = self.run_graph('sharded', 3, limit=11)
+		self.assertEqual(serial_counts['rows'], 11)
+		self.assertEqual(sharded_counts['rows'], 11)
+		self.assertEqual(sharded_memory, serial_memory)
+		self.assertEqual(sharded_files, serial_files)
+
+	def test_unshared_service_runs_serially(self):
+		serial_memory, serial_files, _ = self.run_graph('serial', 1)
+		# the `seen` service is changed by the workers, but not merged
+		self.shared_state = {'counts': defaultdict(int)}
+		with self.assertWarns(UserWarning):
+			sharded_memory, sharded_files, _ = self.run_graph('sharded', 3)
+		self.assertEqual(len(self.services['seen']), 25)
+		self.assertEqual(sharded_memory, serial_memory)
+		self.assertEqual(sharded_files, serial_files)
+
+	def test_sharded_fused_output_matches_serial(self):
+		serial_memory, serial_files, _ = self.run_graph('serial', 1)
+		sharded_memory, sharded_files, sharded_counts = self.run_graph('sharded', 3, fuse=True)
+		self.assertEqual(sharded_memory, serial_memory)
+		self.assertEqual(sharded_files, serial_files)
+		self.assertEqual(sharded_counts['rows'], 25)
+
+	def run_kinds(self, processes):
+		with open(os.path.join(self.input_path, 'kinds_1.csv'), 'w', newline='') as fh:
+			w = csv.writer(fh)
+			for i in range(20):
+				w.writerow([str(i), 'cat', 'Auction' if i == 0 else 'Private'])
+		g = bonobo.Graph()
+		g.add_chain(
+			MatchingFiles(path='/', pattern='kinds_*.csv', fs='fs.data.test'),
+			CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'group', 'kind']),
+			FirstKind(),
+		)
+		services = {'fs.data.test': bonobo.open_fs(self.input_path), 'kinds': {}, 'results': []}
+		e = ShardedGraphExecutor(g, services, processes=processes, shared_state={'kinds': services['kinds'], 'results': services['results']})
+		e.run()
+		return services['kinds'], services['results']
+
+	def test_order_dependent_state_runs_serially(self):
+		serial_kinds, serial_results = self.run_kinds(1)
+		self.assertEqual(serial_kinds, {'cat': 'Auction'})
+		self.assertEqual({kind for _, kind in serial_results}, {'Auction'})
+		with self.assertWarns(UserWarning):
+			sharded_kinds, sharded_results = self.run_kinds(2)
+		self.assertEqual(sharded_kinds, serial_kinds)
+		self.assertEqual(sharded_results, serial_results)
+
+	def test_dead_letters(self):
+		filename = os.path.join(self.tmp.name, 'dead-letters.jsonl')
+		queue = DeadLetterQueue(filename)
+		queue.start_graph()
+		g = bonobo.Graph()
+		g.add_chain(
+			MatchingFiles(path='/', pattern='rows_*.csv', fs='fs.data.test'),
+			CurriedCSVReader(fs='fs.data.test', limit=0, field_names=['id', 'name', 'group']),
+			fail_on_bad_rows,
+			CountRows(),
+		)
+		services = {'fs.data.test': bonobo.open_fs(self.input_path), 'counts': defaultdict(int)}
+		e = ShardedGraphExecutor(g, services, processes=3, shared_state={'counts': services['counts']}, dead_letters=queue)
+		e.run()
+		queue.close()
+		self.assertEqual(services['counts']['rows'], 23)
+		self.assertEqual(queue.count, 2)
+		entries = DeadLetterQueue.load(filename)[1]
+		self.assertEqual([entry['record']['id'] for entry in entries], ['3', '20'])
+		self.assertEqual({entry['source_name'] for entry in entries}, {'CurriedCSVReader'})
+
+	def test_state_conflicts(self):
+		target = {'map': {'a': 'x', 'n': {'b': 1}}, 'counts': defaultdict(int, {'a': 1})}
+		self.assertEqual(state_conflicts(target, {'map': {'a': 'x', 'c': 'y', 'n': {'b': 1, 'd': 2}}}), [])
+		self.assertEqual(state_conflicts(target, {'map': {'a': 'y', 'n': {'b': 2}}}), [('map', 'a'), ('map', 'n', 'b')])
+		self.assertEqual(state_conflicts(target['counts'], {'a': 5}), [])
+
+	def test_state_merge(self):
+		before = {'counts': defaultdict(int, {'a': 2}), 'seen': {'x'}, 'map': {'k': [1]}}
+		after = {'counts': defaultdict(int, {'a': 5, 'b': 1}), 'seen': {'x', 'y'}, 'map': {'k': [1, 2], 'j': [3]}}
+		delta = {k: state_delta(before[k], after[k]) for k in before}
+		self.assertEqual(delta, {'counts': {'a': 3, 'b': 1}, 'seen': {'y'}, 'map': {'k': [2], 'j': [3]}})
+
+		target = {'counts': defaultdict(int, {'a': 4}), 'seen': {'z'}, 'map': {'k': [0]}}
+		for k in target:
+			merge_state(target[k], delta[k])
+		self.assertEqual(target['counts'], {'a': 7, 'b': 1})
+		self.assertEqual(target['seen'], {'y', 'z'})
+		self.assertEqual(target['map'], {'k': [0, 2], 'j': [3]})
+
+
+if __name__ == '__main__':
+	unittest.main()
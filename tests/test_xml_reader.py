@@ -0,0 +1,92 @@
+import io
+import os
+import json
+import unittest
+
+import bonobo
+import lxml.etree
+import xmltodict
+
+from pipeline.io.xml import CurriedXMLReader, iterparse_xpath, xml_element_to_dict
+
+AATA_FILES = (
+	('/AATA_XML/record', 'core-1/AATA_1-10000.xml'),
+	('/journal_XML/record', 'journal/AATA Pub Journal.xml'),
+	('/series_XML/record', 'series/AATA Pub Series.xml'),
+	('/auth_person_XML/record', 'person/Auth_person.xml'),
+	('/auth_corp_XML/record', 'corp/Auth_corp.xml'),
+	('/auth_geog_XML/record', 'geog/Auth_geog.xml'),
+	('/empty_XML/record', 'empty.xml'),
+)
+
+def xmltodict_element_to_dict(e):
+	# the conversion previously used by the AATA pipeline
+	chunk = lxml.etree.tostring(e).decode('utf-8')
+	return json.loads(json.dumps(xmltodict.parse(chunk)))
+
+class XMLReaderTests(unittest.TestCase):
+	def setUp(self):
+		self.path = os.path.join(os.path.dirname(__file__), 'data', 'aata')
+		self.fs = bonobo.open_fs(self.path)
+
+	def read(self, xpath, filename, **kwargs):
+		reader = CurriedXMLReader(xpath=xpath, fs='fs.data.aata', limit=0, **kwargs)
+		return [lxml.etree.tostring(e) for e in reader(filename, fs=self.fs)]
+
+	def test_stream_matches_parse(self):
+		for xpath, filename in AATA_FILES:
+			with self.subTest(filename=filename):
+				expected = self.read(xpath, filename, stream=False)
+				self.assertEqual(self.read(xpath, filename), expected)
+		self.assertTrue(self.read('/AATA_XML/record', 'core-1/AATA_1-10000.xml'))
+
+	def test_limit(self):
+		reader = CurriedXMLReader(xpath='/journal_XML/record', fs='fs.data.aata', limit=1)
+		records = list(reader('journal/AATA Pub Journal.xml', fs=self.fs))
+		records += list(reader('series/AATA Pub Series.xml', fs=self.fs))
+		self.assertEqual(len(records), 1)
+
+	def test_streaming(self):
+		data = b'<a><b><c>1</c><c>2</c><d><c>x</c></d></b><b><c>3</c></b><c>y</c></a>'
+		values = []
+		for e in iterparse_xpath(io.BytesIO(data), '/a/b/c'):
+			values.append(e.text)
+			# elements are removed from the document once they have been processed
+			self.assertIsNone(e.getprevious())
+		self.assertEqual(values, ['1', '2', '3'])
+
+class XMLElementToDictTests(unittest.TestCase):
+	def test_aata_records(self):
+		fs = bonobo.open_fs(os.path.join(os.path.dirname(__file__), 'data', 'aata'))
+		for xpath, filename in AATA_FILES:
+			with self.subTest(filename=filename):
+				reader = CurriedXMLReader(xpath=xpath, fs='fs.data.aata', limit=0, stream=False)
+				elements = list(reader(filename, fs=fs))
+				for e in elements:
+					self.assertEqual(xml_element_to_dict(e), xmltodict_element_to_dict(e))
+				reader = CurriedXMLReader(xpath=xpath, fs='fs.data.aata', limit=0)
+				streamed = [xml_element_to_dict(e) for e in reader(filename, fs=fs)]
+				self.assertEqual(streamed, [xmltodict_element_to_dict(e) for e in elements])
+
+	def test_structure(self):
+		documents = (
+			'<a/>',
+			'<a>  </a>',
+			'<a> text </a>',
+			'<a x="1"/>',
+			'<a x="1">text</a>',
+			'<a><b/><b>1</b><c x="2"/><b><d>3</d></b></a>',
+			'<a>one <b>1</b> two <!-- comment --> three<?pi data?> four</a>',
+			'<a xmlns:p="urn:p" p:x="1" xml:lang="en"><p:b>1</p:b><c xmlns="urn:c">2</c></a>',
+			'<a><![CDATA[<b>]]> &amp; &#233;</a>',
+		)
+		for doc in documents:
+			with self.subTest(doc=doc):
+				e = lxml.etree.fromstring(doc)
+				self.assertEqual(xml_element_to_dict(e), xmltodict_element_to_dict(e))
+		e = lxml.etree.fromstring(documents[5])
+		self.assertEqual(xml_element_to_dict(e), {'a': {'b': [None, '1', {'d': '3'}], 'c': {'@x': '2'}}})
+
+
+if __name__ == '__main__':
+	unittest.main()